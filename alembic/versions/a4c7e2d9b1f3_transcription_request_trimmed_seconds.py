@@ -0,0 +1,24 @@
+"""transcription request trimmed seconds
+
+Revision ID: a4c7e2d9b1f3
+Revises: f1a9d3c6b5e7
+Create Date: 2026-10-19 18:12:05.417302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2d9b1f3'
+down_revision = 'f1a9d3c6b5e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transcription_requests', sa.Column('trimmed_seconds', sa.Float))
+
+
+def downgrade():
+    pass
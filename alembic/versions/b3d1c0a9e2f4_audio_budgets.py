@@ -0,0 +1,36 @@
+"""audio budgets
+
+Revision ID: b3d1c0a9e2f4
+Revises: 7a7e415c6b89
+Create Date: 2026-10-19 15:02:11.417305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d1c0a9e2f4'
+down_revision = '7a7e415c6b89'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('audio_budget_hourly', sa.Integer))
+    op.add_column('chats', sa.Column('audio_budget_daily', sa.Integer))
+    op.add_column('users', sa.Column('audio_budget_hourly', sa.Integer))
+    op.add_column('users', sa.Column('audio_budget_daily', sa.Integer))
+
+    op.create_table(
+        'audio_usage',
+        sa.Column('kind', sa.String, primary_key=True),
+        sa.Column('entity_id', sa.Integer, primary_key=True),
+        sa.Column('bucket', sa.Integer, primary_key=True),
+        sa.Column('seconds', sa.Integer, nullable=False, default=0),
+        sa.Column('requests', sa.Integer, nullable=False, default=0),
+    )
+
+
+def downgrade():
+    op.drop_table('audio_usage')
@@ -0,0 +1,25 @@
+"""on demand mode
+
+Revision ID: d5e2a7c4f1b8
+Revises: b3d1c0a9e2f4
+Create Date: 2026-10-19 15:41:52.208731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e2a7c4f1b8'
+down_revision = 'b3d1c0a9e2f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('on_demand', sa.Boolean, server_default=sa.false()))
+    op.add_column('chats', sa.Column('on_demand_auto_max_duration', sa.Integer))
+
+
+def downgrade():
+    pass
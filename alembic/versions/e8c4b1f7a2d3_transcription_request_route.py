@@ -0,0 +1,27 @@
+"""transcription request route
+
+Revision ID: e8c4b1f7a2d3
+Revises: d5e2a7c4f1b8
+Create Date: 2026-10-19 17:02:13.514260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4b1f7a2d3'
+down_revision = 'd5e2a7c4f1b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transcription_requests', sa.Column('route', sa.String))
+    op.add_column('transcription_requests', sa.Column('file_size', sa.Integer))
+    op.add_column('transcription_requests', sa.Column('download_time', sa.Float))
+    op.add_column('transcription_requests', sa.Column('total_time', sa.Float))
+
+
+def downgrade():
+    pass
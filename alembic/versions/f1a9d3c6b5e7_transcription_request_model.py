@@ -0,0 +1,26 @@
+"""transcription request model
+
+Revision ID: f1a9d3c6b5e7
+Revises: e8c4b1f7a2d3
+Create Date: 2026-10-19 17:31:48.093115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a9d3c6b5e7'
+down_revision = 'e8c4b1f7a2d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transcription_requests', sa.Column('model', sa.String))
+    op.add_column('transcription_requests', sa.Column('model_rule', sa.String))
+    op.add_column('transcription_requests', sa.Column('confidence', sa.Float))
+
+
+def downgrade():
+    pass
@@ -1,4 +1,8 @@
 import logging
+import time
+from typing import Optional
+
+LAUNCH_TIME = time.perf_counter()
 
 # noinspection PyUnresolvedReferences,PyPackageRequirements
 import os
@@ -7,29 +11,50 @@ import os
 from telegram.utils.request import Request
 
 from .utilities import utilities
+from .utilities import jobs_queue
 from .database import base
 from .bot import VoiceMessagesBot
 from config import config
 
 logger = logging.getLogger(__name__)
 
-sttbot = VoiceMessagesBot(
-    token=config.telegram.token,
-    use_context=True,
-    workers=config.telegram.get("workers", 4),
-    persistence=utilities.persistence_object(config.telegram.persistence) if config.telegram.persistence else None,
-)
+# built by main(), not on import: the transcription workers are spawned processes that import this package too, and
+# they don't need an Updater (whose Dispatcher would load the whole persistence). Handlers and jobs are imported
+# after it has been built
+sttbot: Optional[VoiceMessagesBot] = None
 
 
 def main():
+    global sttbot
+
     utilities.load_logging_config('logging.json')
 
-    sttbot.import_handlers(r'bot/handlers/')
+    sttbot = VoiceMessagesBot(
+        token=config.telegram.token,
+        use_context=True,
+        workers=config.telegram.get("workers", 4),
+        persistence=utilities.persistence_object(config.telegram.persistence) if config.telegram.persistence else None,
+    )
+
+    with utilities.timed_phase("handlers import"):
+        sttbot.import_handlers(r'bot/handlers/')
+        sttbot.import_handlers(r'bot/jobs/')
+
+    if jobs_queue.ENABLED:
+        from .utilities.workers import workers
+        workers.start()
+
+    # with [catchup] enabled, pending updates are not dropped: see VoiceMessagesBot.run()
     sttbot.run(
         drop_pending_updates=True,
-        allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"]
+        allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"],
+        launch_time=LAUNCH_TIME
     )
 
+    if jobs_queue.ENABLED:
+        # the updater is stopped: no new job will be enqueued
+        workers.stop()
+
 
 if __name__ == '__main__':
     main()
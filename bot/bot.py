@@ -2,6 +2,10 @@ import logging
 import os
 import importlib
 import re
+import threading
+import time
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # noinspection PyPackageRequirements
@@ -10,10 +14,16 @@ from telegram.ext import Updater, ConversationHandler
 # noinspection PyPackageRequirements
 from telegram import BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats, BotCommandScopeChat
 
+from bot.utilities import utilities
+from bot.utilities.backpressure import controller as backpressure
+from bot.utilities.catchup import CATCHUP_CONFIG, catchup
+from bot.utilities.webhook import WebhookServer
 from config import config
 
 logger = logging.getLogger(__name__)
 
+WEBHOOK_CONFIG = config.get("webhook", {})
+
 
 class AdminPermission:
     CAN_MANAGE_CHAT = "can_manage_chat"
@@ -53,6 +63,7 @@ class VoiceMessagesBot(Updater):
         BotCommand("ti", "testa se un vocale dovrebbe essere ignorato in un gruppo"),
         BotCommand("mi", "output di mediainfo per un vocale"),
         BotCommand("config", "mostra config.toml[behavior]"),
+        BotCommand("stats", "mostra le statistiche interne (filtro opzionale per prefisso)"),
     ]
 
     @staticmethod
@@ -125,29 +136,134 @@ class VoiceMessagesBot(Updater):
             logger.debug('importing module: %s', import_path)
             importlib.import_module(import_path)
 
-    def set_commands(self):
-        self.bot.set_my_commands(self.USERS_COMMANDS, scope=BotCommandScopeAllPrivateChats())
-        self.bot.set_my_commands([], scope=BotCommandScopeAllGroupChats())
-
+    def _set_admin_commands(self, admin_id: int, admin_commands):
+        try:
+            self.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id))
+        except BadRequest as e:
+            if "chat not found" in e.message.lower():
+                logger.warning("make sure admin <%d> started me!", admin_id)
+            else:
+                raise
+
+    def set_commands(self, max_workers=4):
         admin_commands = self.USERS_COMMANDS + self.ADMINS_COMMANDS
-        for admin_id in config.telegram.admins:
-            try:
-                self.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id))
-            except BadRequest as e:
-                if "chat not found" in e.message.lower():
-                    logger.warning("make sure admin <%d> started me!", admin_id)
-                else:
-                    raise
-
-    def run(self, *args, **kwargs):
-        logger.info('updating commands list...')
-        self.set_commands()
 
+        # every scope is independent from the others: send the requests concurrently
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="set_commands") as executor:
+            futures = [
+                executor.submit(self.bot.set_my_commands, self.USERS_COMMANDS, scope=BotCommandScopeAllPrivateChats()),
+                executor.submit(self.bot.set_my_commands, [], scope=BotCommandScopeAllGroupChats()),
+            ]
+            for admin_id in config.telegram.admins:
+                futures.append(executor.submit(self._set_admin_commands, admin_id, admin_commands))
+
+            for future in futures:
+                future.result()  # raise exceptions, if any
+
+    @staticmethod
+    def warm_up():
+        """Do what the first voice message would otherwise need to do: import the google cloud
+        libraries, build the clients, open the first db connection"""
+
+        from bot.database.base import engine
+        from google import clients
+
+        with utilities.timed_phase("warm-up speech-to-text import"):
+            # noinspection PyUnresolvedReferences
+            from google.speechtotext import stt
+
+        with utilities.timed_phase("warm-up google clients"):
+            clients.get_speech_client()
+            clients.get_storage_client()
+
+        with utilities.timed_phase("warm-up db connection"):
+            engine.connect().close()
+
+    def _after_polling_started(self):
+        # noinspection PyBroadException
+        try:
+            with utilities.timed_phase("commands update"):
+                self.set_commands()
+        except Exception:
+            logger.error("error while updating the commands list", exc_info=True)
+
+        # noinspection PyBroadException
+        try:
+            self.warm_up()
+        except Exception:
+            logger.error("error during warm-up", exc_info=True)
+
+    def start_webhook_server(self, drop_pending_updates: bool = False, allowed_updates: [list, None] = None):
+        """Like start_webhook(), but with our own http server (secret token validation, bounded queue)"""
+
+        if self.running:
+            return
+
+        self.running = True
+
+        self.job_queue.start()
+        dispatcher_ready = Event()
+        self._init_thread(self.dispatcher.start, "dispatcher", ready=dispatcher_ready)
+
+        self.httpd = WebhookServer(
+            listen=WEBHOOK_CONFIG.get("listen", "127.0.0.1"),
+            port=WEBHOOK_CONFIG.get("port", 8443),
+            url_path=WEBHOOK_CONFIG.get("url_path", "/"),
+            bot=self.bot,
+            update_queue=self.update_queue,
+            secret_token=WEBHOOK_CONFIG.get("secret_token") or None,
+            max_queue_size=WEBHOOK_CONFIG.get("max_queue_size", 100),
+            max_body_size=WEBHOOK_CONFIG.get("max_body_size", 1024 * 1024),
+        )
+        self._init_thread(self.httpd.serve_forever, "webhook")
+        dispatcher_ready.wait()
+
+        logger.info("webhook server listening on %s:%d%s", *self.httpd.server_address[:2], self.httpd.url_path)
+
+        webhook_url = WEBHOOK_CONFIG.get("url")
+        if not webhook_url:
+            logger.warning("webhook url not set: updates must be POSTed to the webhook server manually")
+            return
+
+        self.bot.set_webhook(
+            url=webhook_url,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=drop_pending_updates,
+            max_connections=WEBHOOK_CONFIG.get("max_connections", 40),
+            # not supported by this version of the library
+            api_kwargs={"secret_token": WEBHOOK_CONFIG["secret_token"]} if WEBHOOK_CONFIG.get("secret_token") else None,
+        )
+
+    def run(self, *args, launch_time: [float, None] = None, **kwargs):
         logger.info("allowed updates: %s", ", ".join(kwargs["allowed_updates"] if "allowed_updates" in kwargs else "?"))
 
-        self.start_polling(*args, **kwargs)
-        logger.info("stopping job queue's thread...")
-        self.job_queue.stop()
+        catchup_enabled = CATCHUP_CONFIG.get("enabled", False)
+        if catchup_enabled:
+            # we pull the pending updates ourselves, polling will start after them
+            kwargs["drop_pending_updates"] = False
+            with utilities.timed_phase("backlog fetch"):
+                self.last_update_id = catchup.fetch(self.bot, kwargs.get("allowed_updates"))
+
+        backpressure.watch_update_queue(self.update_queue)
+
+        # the job queue is started by start_polling()/start_webhook_server(): we need it for background jobs (eg.
+        # administrators refresh)
+        if WEBHOOK_CONFIG.get("enabled", False):
+            with utilities.timed_phase("webhook start"):
+                self.start_webhook_server(*args, **kwargs)
+        else:
+            with utilities.timed_phase("polling start"):
+                self.start_polling(*args, **kwargs)
+
+        if launch_time:
+            logger.info("accepting updates %.3f s after launch", time.perf_counter() - launch_time)
+
+        if catchup_enabled:
+            catchup.start(self.update_queue, lambda: self.running)
+
+        # nothing of this is needed to receive updates: do it in the background
+        threading.Thread(target=self._after_polling_started, name="after_polling_started", daemon=True).start()
+
         logger.info('running as @%s', self.bot.username)
         self.idle()
 
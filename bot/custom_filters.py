@@ -1,7 +1,13 @@
 # noinspection PyPackageRequirements
+from telegram import Chat
+# noinspection PyPackageRequirements
 from telegram.ext import MessageFilter
 
+from bot.utilities import metrics
 from bot.utilities import utilities
+from bot.utilities import gcs_streaming
+from bot.utilities.chat_settings import cache as chat_settings_cache
+from bot.utilities.transcoder import transcoder
 from config import config
 
 
@@ -13,15 +19,51 @@ class FromAdmin(MessageFilter):
 class VoiceTooLarge(MessageFilter):
     def filter(self, message):
         voice = message.voice or message.audio
-        return voice.file_size and voice.file_size > config.behavior.voice_max_size
+        return voice.file_size and voice.file_size > gcs_streaming.max_file_size()
 
 
 class Voice(MessageFilter):
     def filter(self, message):
+        if message.audio and transcoder.enabled and message.chat.type == Chat.PRIVATE:
+            # any audio: it is converted before the recognition. Not in groups, where music and podcasts are shared
+            return True
+
         return message.voice or (message.audio and utilities.is_whatsapp_voice(message.audio))
 
 
+class GroupVoiceAdmission(MessageFilter):
+    """Cheap checks on group voices, using only the message and the chat settings cache: voices that
+    don't pass them are ignored before any db session or thread is used"""
+
+    def filter(self, message):
+        voice = message.voice or message.audio
+        if not voice:
+            return False
+
+        if voice.file_size and voice.file_size > config.behavior.voice_max_size:
+            metrics.increment("admission_rejected_size")
+            return False
+
+        settings = chat_settings_cache.get(message.chat.id)
+        if not settings:
+            return True
+
+        if not settings.enabled:
+            metrics.increment("admission_rejected_disabled")
+            return False
+
+        if voice.duration is not None and (
+                (settings.ignore_if_shorter_than and voice.duration < settings.ignore_if_shorter_than)
+                or (settings.ignore_if_longer_than and voice.duration > settings.ignore_if_longer_than)
+        ):
+            metrics.increment("admission_rejected_duration")
+            return False
+
+        return True
+
+
 class CFilters:
     from_admin = FromAdmin()
     voice_too_large = VoiceTooLarge()
     voice = Voice()
+    group_voice_admission = GroupVoiceAdmission()
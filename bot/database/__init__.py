@@ -3,6 +3,7 @@ from .models.user import User
 from .models.transcription_request import TranscriptionRequest
 from .models.chat_administrator import ChatAdministrator
 from .models.message_to_delete import MessageToDelete
+from .models.audio_usage import AudioUsage
 from .base import Base, engine
 
 Base.metadata.create_all(engine)
@@ -1,7 +1,7 @@
 from typing import cast
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.orm import scoped_session
@@ -35,4 +35,35 @@ def get_session(connection=None) -> Session:
     return cast(Session, session)
 
 
+@event.listens_for(Session, "after_flush")
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _flag_written(session_or_context, *args):
+    # 'after_bulk_*' events receive a context object instead of the session
+    session = getattr(session_or_context, "session", session_or_context)
+    session.info["written"] = True
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _reset_written(session: Session):
+    session.info.pop("written", None)
+
+
+def flag_written(session: Session):
+    """mark the session as containing writes that did not go through the unit of work (eg. session.execute())"""
+
+    session.info["written"] = True
+
+
+def session_has_writes(session: Session) -> bool:
+    """True if the session has changes to flush, or flushed changes that still need to be committed"""
+
+    if session.new or session.deleted or session.info.get("written"):
+        return True
+
+    # objects in 'dirty' might have had an attribute set to its current value
+    return any(session.is_modified(instance) for instance in session.dirty)
+
+
 Base = declarative_base()
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, String
+
+from ..base import Base, engine
+
+
+class AudioUsage(Base):
+    """Audio seconds and requests of a chat/user in a time bucket, flushed periodically from the in-memory
+    counters of bot.utilities.budgets"""
+
+    __tablename__ = 'audio_usage'
+
+    kind = Column(String, primary_key=True)  # "chat" or "user"
+    entity_id = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)  # unix time of the beginning of the bucket
+    seconds = Column(Integer, default=0, nullable=False)
+    requests = Column(Integer, default=0, nullable=False)
+
+    def __init__(self, kind: str, entity_id: int, bucket: int, seconds: int = 0, requests: int = 0):
+        self.kind = kind
+        self.entity_id = entity_id
+        self.bucket = bucket
+        self.seconds = seconds
+        self.requests = requests
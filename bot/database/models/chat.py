@@ -18,6 +18,10 @@ class Chat(Base):
     ignore_if_longer_than = Column(Integer, default=None)
     left = Column(Boolean, default=None)
     last_administrators_fetch = Column(DateTime(timezone=True), default=None, nullable=True)
+    audio_budget_hourly = Column(Integer, default=None, nullable=True)  # seconds, overrides [budgets] when set
+    audio_budget_daily = Column(Integer, default=None, nullable=True)
+    on_demand = Column(Boolean, default=False)  # voices are transcribed only when someone presses the button
+    on_demand_auto_max_duration = Column(Integer, default=None, nullable=True)  # on_demand: shorter voices are transcribed anyway
 
     chat_administrators = relationship("ChatAdministrator", back_populates="chat", cascade="all, delete, delete-orphan, save-update")
     messages_to_delete = relationship("MessageToDelete", back_populates="chat", cascade="all, delete, delete-orphan, save-update")
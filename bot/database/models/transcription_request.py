@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Boolean, String
+from sqlalchemy import Column, Integer, Boolean, String, Float
 
 from ..base import Base, engine
 
@@ -11,12 +11,23 @@ class TranscriptionRequest(Base):
     sample_rate = Column(Integer, default=None, nullable=True)
     response_time = Column(Integer, default=None, nullable=True)
     success = Column(Boolean, default=None, nullable=True)
+    route = Column(String, default=None, nullable=True)  # see bot.utilities.router
+    file_size = Column(Integer, default=None, nullable=True)
+    download_time = Column(Float, default=None, nullable=True)  # seconds to download (or stream to GCS) the file
+    total_time = Column(Float, default=None, nullable=True)  # seconds from the beginning of the download to the transcript
+    model = Column(String, default=None, nullable=True)  # recognition model, see bot.utilities.recognition_models
+    model_rule = Column(String, default=None, nullable=True)
+    confidence = Column(Float, default=None, nullable=True)
+    trimmed_seconds = Column(Float, default=None, nullable=True)  # silence removed before the recognition
 
-    def __init__(self, audio_duration, sample_rate=None):
+    def __init__(self, audio_duration, sample_rate=None, route=None, file_size=None):
         self.audio_duration = audio_duration
         self.sample_rate = sample_rate
+        self.route = route
+        self.file_size = file_size
 
-    def successful(self, response_time: float, sample_rate: [int, None] = None):
+    def successful(self, response_time: float, sample_rate: [int, None] = None, confidence: [float, None] = None):
         self.sample_rate = sample_rate
         self.response_time = response_time
+        self.confidence = confidence
         self.success = True
@@ -12,6 +12,8 @@ class User(Base):
     enabled = Column(Boolean, default=True)
     opted_out = Column(Boolean, default=False)
     superuser = Column(Boolean, default=False)
+    audio_budget_hourly = Column(Integer, default=None, nullable=True)  # seconds, overrides [budgets] when set
+    audio_budget_daily = Column(Integer, default=None, nullable=True)
 
     chats_administrator = relationship("ChatAdministrator", back_populates="user")
 
@@ -0,0 +1,21 @@
+from typing import Iterable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from bot.database.models.audio_usage import AudioUsage
+
+
+def load_since(session: Session, since: int) -> List[AudioUsage]:
+    return session.query(AudioUsage).filter(AudioUsage.bucket >= since).all()
+
+
+def store(session: Session, rows: Iterable[Tuple[str, int, int, int, int]]):
+    """rows: (kind, entity_id, bucket, seconds, requests). The counters are absolute values, so the rows are
+    just overwritten"""
+
+    for kind, entity_id, bucket, seconds, requests in rows:
+        session.merge(AudioUsage(kind, entity_id, bucket, seconds=seconds, requests=requests))
+
+
+def delete_older_than(session: Session, before: int) -> int:
+    return session.query(AudioUsage).filter(AudioUsage.bucket < before).delete(synchronize_session=False)
@@ -1,26 +1,104 @@
 import datetime
-from typing import List
+import logging
+from typing import List, Tuple
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, inspect, select, and_, bindparam
 # noinspection PyPackageRequirements
 from telegram import ChatMember
 
+from bot.database.base import flag_written
 from bot.database.models.chat import Chat
 from bot.database.models.chat_administrator import ChatAdministrator, chat_members_to_dict
+from bot.utilities import metrics
 
+logger = logging.getLogger(__name__)
 
-def update_administrators(session: Session, chat: Chat, administrators: List[ChatMember]):
-    current_chat_administrators_dict = chat_members_to_dict(chat.chat_id, administrators)
+chat_administrators_table = ChatAdministrator.__table__
 
-    chat_administrators = []
-    for _, chat_member_dict in current_chat_administrators_dict.items():
-        chat_administrator = ChatAdministrator(**chat_member_dict)
-        chat_administrators.append(chat_administrator)
+# the columns we compare to decide whether a stored administrator changed
+SYNCED_COLUMNS = (
+    "status",
+    "is_anonymous",
+    "is_bot",
+    "can_manage_chat",
+    "can_manage_voice_chats",
+    "can_change_info",
+    "can_delete_messages",
+    "can_invite_users",
+    "can_restrict_members",
+    "can_pin_messages",
+    "can_promote_members",
+)
 
-    # this also deletes the instances of ChatAdministrator currently not in 'current_chat_administrators_dict'
-    chat.chat_administrators = chat_administrators
-    chat.last_administrators_fetch = datetime.datetime.utcnow()
 
+def update_administrators(session: Session, chat: Chat, administrators: List[ChatMember]) -> Tuple[int, int, int]:
+    """Sync the stored administrators of the chat with the fetched list. Only what changed is written,
+    with at most one INSERT, one UPDATE (executemany) and one DELETE statement
 
-    session.add(chat)  # https://docs.sqlalchemy.org/en/13/orm/cascades.html#save-update
+    :return: (inserted, updated, deleted) rows count
+    """
+
+    now = datetime.datetime.utcnow()
+    fetched = chat_members_to_dict(chat.chat_id, administrators)
+
+    stored_rows = session.execute(
+        select([chat_administrators_table.c.user_id] + [chat_administrators_table.c[c] for c in SYNCED_COLUMNS])
+        .where(chat_administrators_table.c.chat_id == chat.chat_id)
+    ).fetchall()
+    stored = {row["user_id"]: {c: row[c] for c in SYNCED_COLUMNS} for row in stored_rows}
+
+    to_insert = []
+    to_update = []
+    for user_id, chat_member_dict in fetched.items():
+        if user_id not in stored:
+            to_insert.append(dict(chat_member_dict, updated_on=now))
+            continue
+
+        if any(stored[user_id][c] != chat_member_dict[c] for c in SYNCED_COLUMNS):
+            values = {c: chat_member_dict[c] for c in SYNCED_COLUMNS}
+            values.update(updated_on=now, b_user_id=user_id, b_chat_id=chat.chat_id)
+            to_update.append(values)
+
+    to_delete = [user_id for user_id in stored if user_id not in fetched]
+
+    if to_insert:
+        session.execute(chat_administrators_table.insert(), to_insert)
+
+    if to_update:
+        session.execute(
+            chat_administrators_table.update().where(and_(
+                chat_administrators_table.c.user_id == bindparam("b_user_id"),
+                chat_administrators_table.c.chat_id == bindparam("b_chat_id")
+            )),
+            to_update
+        )
+
+    if to_delete:
+        session.execute(
+            chat_administrators_table.delete().where(and_(
+                chat_administrators_table.c.chat_id == chat.chat_id,
+                chat_administrators_table.c.user_id.in_(to_delete)
+            ))
+        )
+
+    if to_insert or to_update or to_delete:
+        flag_written(session)
+
+        if inspect(chat).persistent:
+            # the relationship has been loaded before the statements above: it's stale now
+            session.expire(chat, ["chat_administrators"])
+
+    chat.last_administrators_fetch = now
+    session.add(chat)
+
+    logger.info(
+        "chat %d administrators synced: %d inserted, %d updated, %d deleted, %d unchanged",
+        chat.chat_id, len(to_insert), len(to_update), len(to_delete),
+        len(fetched) - len(to_insert) - len(to_update)
+    )
+    metrics.increment("admins_rows_inserted", len(to_insert))
+    metrics.increment("admins_rows_updated", len(to_update))
+    metrics.increment("admins_rows_deleted", len(to_delete))
+
+    return len(to_insert), len(to_update), len(to_delete)
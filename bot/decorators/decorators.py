@@ -3,6 +3,7 @@ import logging
 from functools import wraps
 from typing import List
 
+from sqlalchemy import inspect
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import func as sql_func
 # noinspection PyPackageRequirements
@@ -13,10 +14,15 @@ from telegram.error import TimedOut
 from telegram.ext import CallbackContext
 
 from bot.markups import InlineKeyboard
-from bot.database.base import get_session
+from bot.database.base import get_session, session_has_writes
 from bot.database.models.user import User
 from bot.database.models.chat import Chat
 from bot.database.queries import chat as chat_queries
+from bot.utilities import administrators as administrators_utilities
+from bot.utilities import metrics
+from bot.utilities.administrators import registry as admins_registry
+from bot.utilities.chat_settings import cache as chat_settings_cache
+from bot.utilities.outbox import outbox
 from bot.utilities import utilities
 from config import config
 
@@ -27,7 +33,8 @@ def action(chat_action):
     def real_decorator(func):
         @wraps(func)
         def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
-            context.bot.send_chat_action(update.effective_chat.id, chat_action)
+            # don't wait for it: the handler can start right away
+            outbox.send_chat_action(context.bot, update.effective_chat.id, chat_action)
             return func(update, context, *args, **kwargs)
 
         return wrapped
@@ -66,19 +73,40 @@ def catchexceptions(force_message_on_exception=False):
     return real_decorator
 
 
+def _transient_instance(model, primary_key: int):
+    # the python-side column defaults are applied only on INSERT: we set them explicitly,
+    # so the handler reads the same values it would read from a row that already exists
+    instance = model(primary_key)
+    for column in model.__table__.columns:
+        if getattr(instance, column.key) is None and column.default is not None and column.default.is_scalar:
+            setattr(instance, column.key, column.default.arg)
+
+    return instance
+
+
+def _columns_snapshot(instance) -> dict:
+    return {column.key: getattr(instance, column.key) for column in instance.__table__.columns}
+
+
 def pass_session(
         pass_user=False,
         pass_chat=False,
         create_if_not_existing=True,
         rollback_on_exception=False,
-        commit_on_exception=False
+        commit_on_exception=False,
+        read_only=False
 ):
     # 'rollback_on_exception' should be false by default because we might want to commit
     # what has been added (session.add()) to the session until the exception has been raised anyway.
     # For the same reason, we might want to commit anyway when an exception happens using 'commit_on_exception'
+    # 'read_only' handlers never commit: anything added to the session is discarded.
+    # Users/chats not in the db are created lazily: they are added to the session only if the handler
+    # writes one of their attributes (or adds them to the session itself)
 
     if all([rollback_on_exception, commit_on_exception]):
         raise ValueError("'rollback_on_exception' and 'commit_on_exception' are mutually exclusive")
+    elif read_only and commit_on_exception:
+        raise ValueError("'read_only' and 'commit_on_exception' are mutually exclusive")
 
     def real_decorator(func):
         @wraps(func)
@@ -86,15 +114,15 @@ def pass_session(
             # we fetch the session once per message at max, cause the decorator is run only if a message passes filters
             session: Session = get_session()
 
-            # user: [User, None] = None
-            # chat: [Chat, None] = None
+            # instances that have been created but not yet added to the session, with their columns' initial values
+            lazy_instances = []
 
             if pass_user:
                 user = session.query(User).filter(User.user_id == update.effective_user.id).one_or_none()
 
                 if not user and create_if_not_existing:
-                    user = User(user_id=update.effective_user.id)
-                    session.add(user)
+                    user = _transient_instance(User, update.effective_user.id)
+                    lazy_instances.append((user, _columns_snapshot(user)))
 
                 kwargs['user'] = user
 
@@ -105,27 +133,42 @@ def pass_session(
                 chat = session.query(Chat).filter(Chat.chat_id == update.effective_chat.id).one_or_none()
 
                 if not chat and create_if_not_existing:
-                    chat = Chat(chat_id=update.effective_chat.id)
-                    session.add(chat)
+                    chat = _transient_instance(Chat, update.effective_chat.id)
+                    lazy_instances.append((chat, _columns_snapshot(chat)))
 
                 kwargs['chat'] = chat
 
+            metrics.increment("sessions_opened")
+
             # noinspection PyBroadException
             try:
-                result = func(update, context, session=session, *args, **kwargs)
-            except Exception:
-                if rollback_on_exception:
-                    logger.warning("exception while running an handler callback: rolling back")
-                    session.rollback()
-
-                if commit_on_exception:
-                    logger.warning("exception while running an handler callback: committing")
-                    session.commit()
-
-                # raise the exception anyway, so outher decorators can catch it
-                raise
-
-            session.commit()
+                try:
+                    result = func(update, context, session=session, *args, **kwargs)
+                except Exception:
+                    if rollback_on_exception:
+                        logger.warning("exception while running an handler callback: rolling back")
+                        session.rollback()
+
+                    if commit_on_exception:
+                        logger.warning("exception while running an handler callback: committing")
+                        _commit_if_needed(session, lazy_instances)
+
+                    # raise the exception anyway, so outher decorators can catch it
+                    raise
+
+                if pass_chat and kwargs["chat"] is not None:
+                    # keep the admission filters up to date with what the handler saw/changed
+                    chat_settings_cache.set_chat(kwargs["chat"])
+
+                if read_only:
+                    if session_has_writes(session):
+                        logger.warning("read-only handler %s modified the session: discarding changes", func.__name__)
+                        session.rollback()
+                else:
+                    _commit_if_needed(session, lazy_instances)
+            finally:
+                # release the connection even when there was nothing to commit
+                session.close()
 
             return result
 
@@ -134,6 +177,20 @@ def pass_session(
     return real_decorator
 
 
+def _commit_if_needed(session: Session, lazy_instances: List):
+    for instance, snapshot in lazy_instances:
+        if inspect(instance).transient and _columns_snapshot(instance) != snapshot:
+            logger.debug("lazily creating %s row", instance.__tablename__)
+            session.add(instance)
+
+    if not session_has_writes(session):
+        metrics.increment("sessions_commit_skipped")
+        return
+
+    session.commit()
+    metrics.increment("sessions_committed")
+
+
 def administrator(
         permissions: [None, List] = None,
         _any: bool = True,
@@ -149,25 +206,29 @@ def administrator(
             if "chat" not in kwargs or "session" not in kwargs:
                 raise ValueError("decorator must be wrapped in 'pass_session', and must receive a Chat object")
 
+            chat_id = update.effective_chat.id
             user_id = update.effective_user.id
 
             chat: Chat = kwargs["chat"]
             session: Session = kwargs["session"]
 
-            if chat.last_administrators_fetch:
-                admins_fetch_elapsed_seconds = (datetime.datetime.utcnow() - chat.last_administrators_fetch).total_seconds()
-            else:
-                # if not set, force the refresh
-                admins_fetch_elapsed_seconds = (config.behavior.chat_admins_refresh * 3600) + 1
+            if not admins_registry.is_loaded(chat_id) and chat.chat_administrators:
+                # first time we need this chat since the bot started: index what we have in the db
+                admins_registry.load(chat_id, chat.chat_administrators, chat.last_administrators_fetch)
 
-            cache_expired = admins_fetch_elapsed_seconds > config.behavior.chat_admins_refresh * 3600
-            if (cache_expired and not skip_refresh) or not chat.chat_administrators:
-                logger.info("updating administrators, elapsed seconds: %d", admins_fetch_elapsed_seconds)
+            if not admins_registry.count(chat_id):
+                # nothing we can check the user against: this is the only case we fetch the list while the user waits
+                logger.info("no administrators saved for chat %d: fetching them", chat_id)
 
                 administrators: [ChatMember] = update.effective_chat.get_administrators()
                 chat_queries.update_administrators(session, chat, administrators)
+                admins_registry.load_chat_members(chat_id, administrators)
+            elif not skip_refresh and admins_registry.expired(chat_id):
+                # answer with what we have, the list will be updated in the background
+                logger.info("chat %d administrators cache expired: scheduling refresh", chat_id)
+                administrators_utilities.schedule_refresh(context.job_queue, chat_id)
 
-            if not chat.is_admin(user_id, permissions, any_permission=_any, all_permissions=_all):
+            if not admins_registry.is_admin(chat_id, user_id, permissions, any_permission=_any, all_permissions=_all):
                 logger.info("access to decorator-wrapped function forbidden for anauthorized user")
                 return
             else:
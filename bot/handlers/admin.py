@@ -10,11 +10,9 @@ from sqlalchemy import inspect
 from telegram.ext import MessageHandler, Filters, CommandHandler, CallbackContext
 # noinspection PyPackageRequirements
 from telegram import ChatAction, Update, User as TelegramUser, Message, ParseMode
-from pymediainfo import MediaInfo
 
 from bot import sttbot
 from bot.custom_filters import CFilters
-from google.speechtotext import VoiceMessageLocal
 from bot.database.models.chat import Chat
 from bot.database.models.user import User
 from bot.database.models.transcription_request import TranscriptionRequest
@@ -22,7 +20,11 @@ from bot.database.queries import transcription_request
 from bot.database.queries import user as quser
 from bot.decorators import decorators
 from bot.utilities import helpers
+from bot.utilities import metrics
+from bot.utilities import scheduler as scheduler_utilities
 from bot.utilities import utilities
+from bot.utilities.janitor import janitor
+from bot.utilities.scheduler import scheduler
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -109,7 +111,7 @@ def on_superuser_command_private(update: Update, _, session: Session):
 
 
 @decorators.catchexceptions()
-@decorators.pass_session()
+@decorators.pass_session(read_only=True)
 def on_list_superusers_command(update: Update, _, session: Session):
     logger.info("/superusers command")
 
@@ -123,7 +125,7 @@ def on_list_superusers_command(update: Update, _, session: Session):
 
 
 @decorators.catchexceptions()
-@decorators.pass_session()
+@decorators.pass_session(read_only=True)
 def on_forwarded_message(update: Update, _, session: Session):
     logger.info("forwarded message from admin")
 
@@ -153,25 +155,23 @@ def on_forwarded_message(update: Update, _, session: Session):
     update.message.reply_text("\n".join([f"{k}: {v}" for k, v in columns]))
 
 
-@decorators.catchexceptions()
-def on_cleandl_command(update: Update, _):
-    logger.info("/cleandl command")
+def cleandl_job(context: CallbackContext):
+    chat_id = context.job.context
 
-    dir_path = r"downloads/"
+    deleted_files, deleted_bytes = janitor.clean()
 
-    deleted_count = 0
-    for file_name in os.listdir(dir_path):
-        if file_name.startswith("."):
-            continue
+    context.bot.send_message(chat_id, f"Deleted {deleted_files} files ({utilities.human_readable_size(deleted_bytes)})")
 
-        file_path = os.path.join(dir_path, file_name)
-        if os.path.isdir(file_name):
-            continue
 
-        os.remove(file_path)
-        deleted_count += 1
+@decorators.catchexceptions()
+def on_cleandl_command(update: Update, context: CallbackContext):
+    logger.info("/cleandl command")
 
-    update.message.reply_html(f"Deleted {deleted_count} files")
+    # the directory might be huge: files are deleted in the background, we will receive the result when done
+    context.job_queue.run_once(cleandl_job, 0, context=update.effective_chat.id, name="cleandl")
+
+    files_count, total_bytes = janitor.usage()
+    update.message.reply_html(f"Deleting up to {files_count} files ({utilities.human_readable_size(total_bytes)})...")
 
 
 @decorators.catchexceptions(force_message_on_exception=True)
@@ -184,10 +184,10 @@ def on_r_command(update: Update, context: CallbackContext, session: Session):
         return
 
     if not context.args:
-        voice = VoiceMessageLocal.from_message(update.message.reply_to_message)
+        voice = helpers.voice_from_message(update.message.reply_to_message)
     else:
         sample_rate = int(context.args[0])
-        voice = VoiceMessageLocal.from_message(update.message.reply_to_message, force_sample_rate=sample_rate)
+        voice = helpers.voice_from_message(update.message.reply_to_message, force_sample_rate=sample_rate)
 
     avg_response_time = transcription_request.estimated_duration(session, voice.duration)
 
@@ -201,7 +201,8 @@ def on_r_command(update: Update, context: CallbackContext, session: Session):
     request = TranscriptionRequest(audio_duration=voice.duration)
     start = datetime.datetime.now()
 
-    raw_transcript, confidence = voice.recognize(punctuation=config.behavior.punctuation)
+    with scheduler.slot(update.effective_chat.id, scheduler_utilities.CLASS_ADMIN, voice.duration):
+        raw_transcript, confidence = voice.recognize(punctuation=config.behavior.punctuation)
 
     end = datetime.datetime.now()
     elapsed = round((end - start).total_seconds(), 1)
@@ -223,9 +224,11 @@ def on_r_command(update: Update, context: CallbackContext, session: Session):
         parse_mode=ParseMode.HTML
     )
 
+    janitor.release(voice.file_path)
+
 
 @decorators.catchexceptions(force_message_on_exception=True)
-@decorators.pass_session()
+@decorators.pass_session(read_only=True)
 def on_parse_command(update: Update, context: CallbackContext, session: Session):
     logger.info("/parse command, args: %s", context.args)
 
@@ -233,10 +236,11 @@ def on_parse_command(update: Update, context: CallbackContext, session: Session)
         update.message.reply_html("Rispondi ad un messaggio vocale", quote=True)
         return
 
-    voice = VoiceMessageLocal.from_message(update.message.reply_to_message)
+    voice = helpers.voice_from_message(update.message.reply_to_message)
 
     voice.parse_sample_rate()
     voice.cleanup()
+    janitor.release(voice.file_path)
 
     avg_response_time = transcription_request.estimated_duration(session, voice.duration) or '-'
 
@@ -276,7 +280,7 @@ def on_testignore_command(update: Update, context: CallbackContext, session: Ses
 
 
 @decorators.catchexceptions(force_message_on_exception=True)
-@decorators.pass_session()
+@decorators.pass_session(read_only=True)
 def on_mediainfo_command(update: Update, context: CallbackContext, session: Session):
     logger.info("/mediainfo command, args: %s", context.args)
 
@@ -284,6 +288,9 @@ def on_mediainfo_command(update: Update, context: CallbackContext, session: Sess
         update.message.reply_html("Rispondi ad un messaggio vocale/file audio", quote=True)
         return
 
+    # imported here because it's needed only by this command
+    from pymediainfo import MediaInfo
+
     if not MediaInfo.can_parse():
         logger.info("libmediainfo not found")
         update.message.reply_html("libmediainfo non trovata", quote=True)
@@ -309,6 +316,8 @@ def on_mediainfo_command(update: Update, context: CallbackContext, session: Sess
     except FileNotFoundError:
         pass
 
+    janitor.release(file_path)
+
 
 @decorators.catchexceptions(force_message_on_exception=True)
 def on_config_command(update: Update, context: CallbackContext):
@@ -317,6 +326,16 @@ def on_config_command(update: Update, context: CallbackContext):
     update.message.reply_html(f"<code>config.behavior:\n\n{json.dumps(config.behavior, indent=2)}</code>")
 
 
+@decorators.catchexceptions(force_message_on_exception=True)
+def on_stats_command(update: Update, context: CallbackContext):
+    logger.info("/stats command, args: %s", context.args)
+
+    prefix = context.args[0] if context.args else None
+    stats = metrics.snapshot(prefix=prefix)
+
+    update.message.reply_html(f"<code>{utilities.escape_html(utilities.kv_dict_to_string(stats, return_if_empty='-'))}</code>")
+
+
 sttbot.add_handler(CommandHandler(["superuser", "su"], on_superuser_command_group, filters=Filters.chat_type.groups & CFilters.from_admin))
 sttbot.add_handler(CommandHandler(["superuser", "su"], on_superuser_command_private, filters=Filters.chat_type.private & CFilters.from_admin))
 sttbot.add_handler(CommandHandler(["superusers", "sus"], on_list_superusers_command, filters=Filters.chat_type.private & CFilters.from_admin))
@@ -327,3 +346,4 @@ sttbot.add_handler(CommandHandler(["parse", "p"], on_parse_command, filters=Filt
 sttbot.add_handler(CommandHandler(["testignore", "ti"], on_testignore_command, filters=Filters.chat_type.groups & Filters.reply & CFilters.from_admin))
 sttbot.add_handler(CommandHandler(["mediainfo", "mi"], on_mediainfo_command, filters=Filters.reply & CFilters.from_admin))
 sttbot.add_handler(CommandHandler(["config", "conf"], on_config_command, filters=Filters.chat_type.private & CFilters.from_admin))
+sttbot.add_handler(CommandHandler("stats", on_stats_command, filters=Filters.chat_type.private & CFilters.from_admin))
@@ -11,6 +11,7 @@ from bot.bot import AdminPermission
 from bot.database.models.chat import Chat
 from bot.database.queries import chat as chat_queries
 from bot.decorators import decorators
+from bot.utilities.administrators import registry as admins_registry
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -24,8 +25,9 @@ def on_refresh_administrators_command(update: Update, _, session: Session, chat:
 
     administrators: [ChatMember] = update.effective_chat.get_administrators()
     chat_queries.update_administrators(session, chat, administrators)
+    admins_registry.load_chat_members(chat.chat_id, administrators)
 
-    update.message.reply_html(f"Fatto, {len(chat.chat_administrators)} amministratori salvati")
+    update.message.reply_html(f"Fatto, {admins_registry.count(chat.chat_id)} amministratori salvati")
 
 
 @decorators.catchexceptions()
@@ -51,5 +53,38 @@ def on_punctuation_command(update: Update, context: CallbackContext, session: Se
     update.message.reply_html(answer)
 
 
+@decorators.catchexceptions()
+@decorators.pass_session(pass_chat=True)
+@decorators.administrator()
+@decorators.ensure_args(min_number=1)
+def on_mode_command(update: Update, context: CallbackContext, session: Session, chat: Chat):
+    logger.info("/mode %s", context.args)
+
+    mode = context.args[0].lower()
+    if mode == "auto":
+        chat.on_demand = False
+        chat.on_demand_auto_max_duration = None
+        answer = "Tutti i vocali verranno trascritti automaticamente"
+    elif mode == "ondemand":
+        chat.on_demand = True
+        chat.on_demand_auto_max_duration = None
+        answer = "I vocali verranno trascritti solo su richiesta, tramite il tasto sotto ogni vocale"
+    elif mode == "hybrid" and len(context.args) > 1 and context.args[1].isdigit():
+        chat.on_demand = True
+        chat.on_demand_auto_max_duration = int(context.args[1])
+        answer = f"I vocali fino a {chat.on_demand_auto_max_duration} secondi verranno trascritti automaticamente, " \
+                 f"gli altri solo su richiesta"
+    else:
+        update.message.reply_html(
+            "Utilizzo: <code>/mode auto</code>, <code>/mode ondemand</code> oppure <code>/mode hybrid [secondi]</code>"
+        )
+        return
+
+    session.add(chat)
+
+    update.message.reply_html(answer)
+
+
 sttbot.add_handler(CommandHandler(["punctuation", "punct"], on_punctuation_command, filters=Filters.chat_type.groups))
 sttbot.add_handler(CommandHandler(["refreshadmins"], on_refresh_administrators_command, filters=Filters.chat_type.groups))
+sttbot.add_handler(CommandHandler(["mode"], on_mode_command, filters=Filters.chat_type.groups))
@@ -9,9 +9,12 @@ from telegram import Update, ChatMember
 from bot import sttbot
 from bot.bot import AdminPermission
 from bot.database.models.chat import Chat
-from bot.database.models.chat_administrator import ChatAdministrator, chat_member_to_dict
-from bot.database.queries import chat as chat_queries
 from bot.decorators import decorators
+from bot.utilities import administrators as administrators_utilities
+from bot.utilities.administrators import registry as admins_registry
+from bot.utilities import cancellation
+from bot.utilities import jobs_queue
+from bot.utilities.cancellation import running_transcriptions
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -20,7 +23,7 @@ logger = logging.getLogger(__name__)
 @decorators.catchexceptions()
 @decorators.pass_session(pass_chat=True)
 @decorators.administrator(skip_refresh=True)
-def on_chat_member_update(update: Update, _, session: Session, chat: Chat):
+def on_chat_member_update(update: Update, context: CallbackContext, session: Session, chat: Chat):
     logger.info("chat member update")
 
     new_chat_member: ChatMember = update.chat_member.new_chat_member if update.chat_member else update.my_chat_member.new_chat_member
@@ -28,17 +31,35 @@ def on_chat_member_update(update: Update, _, session: Session, chat: Chat):
     user_id = new_chat_member.user.id
 
     if old_chat_member.status in ("administrator", "creator") and new_chat_member.status in ("member", "kicked"):
-        chat_administrator = chat.get_administrator(user_id)
-        if chat_administrator:
-            session.delete(chat_administrator)
-            logger.info("chat member: deleted db record")
-        else:
-            logger.info("no record to delete")
+        admins_registry.remove_administrator(chat.chat_id, user_id)
     elif new_chat_member.status in ("administrator", "creator"):
-        new_chat_member_dict = chat_member_to_dict(new_chat_member, update.effective_chat.id)
-        chat_administrator = ChatAdministrator(**new_chat_member_dict)
-        session.merge(chat_administrator)
-        logger.info("chat member: updated/inserted db record")
+        admins_registry.set_administrator(chat.chat_id, new_chat_member)
+    else:
+        return
+
+    # the in-memory index is already up to date: the db is synced with a delay, once per burst of updates and at
+    # most once every chat_admins_sync_min_interval seconds
+    logger.info("chat member: in-memory index updated, scheduling db sync")
+    administrators_utilities.schedule_refresh(
+        context.job_queue,
+        chat.chat_id,
+        when=administrators_utilities.sync_delay(chat.chat_id)
+    )
+
+
+@decorators.catchexceptions()
+def on_bot_removed(update: Update, *args, **kwargs):
+    if update.my_chat_member.new_chat_member.status not in ("left", "kicked"):
+        return
+
+    # there's nobody to send the transcriptions to anymore
+    cancelled = running_transcriptions.cancel_chat(update.effective_chat.id, cancellation.REASON_BOT_REMOVED)
+    if jobs_queue.ENABLED:
+        # the jobs processed by the worker processes, and the ones still waiting
+        cancelled += jobs_queue.get_queue().cancel_chat(update.effective_chat.id, cancellation.REASON_BOT_REMOVED)
+    logger.info("bot removed from chat %d: %d transcriptions cancelled", update.effective_chat.id, cancelled)
 
 
 sttbot.add_handler(ChatMemberHandler(on_chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
+# a different group, so it runs together with on_chat_member_update
+sttbot.add_handler(ChatMemberHandler(on_bot_removed, ChatMemberHandler.MY_CHAT_MEMBER), group=1)
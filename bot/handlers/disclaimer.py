@@ -121,7 +121,7 @@ def on_optin_command(update: Update, _, session: [Session, None], user: [User, N
 
 
 @decorators.catchexceptions()
-@decorators.pass_session(pass_user=True)
+@decorators.pass_session(pass_user=True, read_only=True)
 def on_opt_command(update: Update, _, session: [Session, None], user: [User, None]):
     logger.info('/opt')
 
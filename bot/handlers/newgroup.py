@@ -15,11 +15,15 @@ from bot.database.models.chat_administrator import ChatAdministrator
 from bot.database.queries import chat as chat_queries
 from bot.decorators import decorators
 from bot.utilities import utilities
+from bot.utilities.administrators import registry as admins_registry
 from config import config
 
 logger = logging.getLogger(__name__)
 
-DEEPLINK_OPTOUT = ptb_helpers.create_deep_linked_url(sttbot.bot.username, "optout")
+
+def deeplink_optout() -> str:
+    # not built on import: sttbot.bot.username needs a getMe request, which would delay the startup
+    return ptb_helpers.create_deep_linked_url(sttbot.bot.username, "optout")
 
 
 class NewGroup(MessageFilter):
@@ -46,13 +50,14 @@ def on_new_group_chat(update: Update, _, session: Session, user: User, chat: Cha
         return
 
     update.message.reply_html(
-        "<i>Promemoria: se non vuoi che trascriva i tuoi vocali, puoi fare l'opt-out</i> <a href=\"{}\">da qui</a>".format(DEEPLINK_OPTOUT),
+        "<i>Promemoria: se non vuoi che trascriva i tuoi vocali, puoi fare l'opt-out</i> <a href=\"{}\">da qui</a>".format(deeplink_optout()),
         quote=False
     )
     chat.left = None
 
     administrators: [ChatMember] = update.effective_chat.get_administrators()
     chat_queries.update_administrators(session, chat, administrators)
+    admins_registry.load_chat_members(chat.chat_id, administrators)
 
 
 sttbot.add_handler(MessageHandler(new_group, on_new_group_chat))
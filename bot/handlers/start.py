@@ -28,7 +28,7 @@ vengono gestiti i tuoi dati. Usa /optout se vuoi che il bot non trascriva i voca
 
 
 @decorators.catchexceptions()
-@decorators.pass_session(pass_user=True)
+@decorators.pass_session(pass_user=True, read_only=True)
 def on_start_command(update: Update, _, session: [Session, None], user: [User, None]):
     logger.info("/start")
 
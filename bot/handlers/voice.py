@@ -1,23 +1,39 @@
 import logging
+import threading
 
 from sqlalchemy.orm import Session
 # noinspection PyPackageRequirements
-from telegram.ext import Filters, MessageHandler
+from telegram.ext import Filters, MessageHandler, CallbackQueryHandler
 # noinspection PyPackageRequirements
-from telegram import ChatAction, Update, ParseMode
+from telegram import ChatAction, ParseMode, Update
 
 from bot import sttbot
 from bot.custom_filters import CFilters
 from bot.decorators import decorators
 from bot.database.models.chat import Chat
 from bot.database.models.user import User
+from bot.markups import InlineKeyboard
 from bot.utilities import utilities
+from bot.utilities import backpressure
+from bot.utilities import budgets
 from bot.utilities import helpers
-from google.speechtotext import VoiceMessageLocal
-from config import config
+from bot.utilities import jobs_queue
+from bot.utilities import cancellation
+from bot.utilities.administrators import registry as admins_registry
+from bot.utilities.cancellation import running_transcriptions
+from bot.utilities.outbox import outbox
+from bot.utilities.transcripts_cache import transcripts_cache
 
 logger = logging.getLogger(__name__)
 
+# (chat_id, message_id) of the buttons that have been pressed and whose voice is being transcribed
+_on_demand_in_progress = set()
+_on_demand_lock = threading.Lock()
+
+TEXT_OVER_BUDGET = """Mi dispiace, hai raggiunto il limite di vocali che posso trascrivere per te: riprova più tardi"""
+
+TEXT_ON_DEMAND = """<i>Premi il tasto per trascrivere questo vocale</i>"""
+
 TEXT_HIDDEN_SENDER = """Mi dispiace, il mittente di questo messaggio vocale ha reso il proprio account non \
 accessibile tramite i messaggi inoltrati, quindi non posso verificare che abbia accettato i termini di servizio"""
 
@@ -25,17 +41,19 @@ accessibile tramite i messaggi inoltrati, quindi non posso verificare che abbia
 @decorators.action(ChatAction.TYPING)
 @decorators.catchexceptions()
 @decorators.pass_session(pass_user=True)
-def on_voice_message_private_chat(update: Update, _, session: Session, *args, **kwargs):
+def on_voice_message_private_chat(update: Update, _, session: Session, user: User, *args, **kwargs):
     logger.info("voice message in a private chat")
 
-    voice = VoiceMessageLocal.from_message(update.message)
+    charge = budgets.admit_message(update.message, user)
+    if not charge:
+        update.message.reply_html(TEXT_OVER_BUDGET, quote=True)
+        return
 
-    result: helpers.RecogResult = helpers.recognize_voice(voice, update, session)
+    if jobs_queue.ENABLED:
+        jobs_queue.enqueue(update.message, charge=charge)
+        return
 
-    if not result.success:
-        result.message_to_edit.edit_text("<i>Impossibile trascrivere messaggio vocale</i>", parse_mode=ParseMode.HTML)
-    else:
-        helpers.send_transcription(result)
+    helpers.transcribe(update, session, charge=charge)
 
 
 @decorators.catchexceptions()
@@ -62,14 +80,16 @@ def on_voice_message_private_chat_forwarded(update: Update, _, session: Session,
             )
             return
 
-    voice = VoiceMessageLocal.from_message(update.message)
+    charge = budgets.admit_message(update.message, user)
+    if not charge:
+        update.message.reply_html(TEXT_OVER_BUDGET, quote=True)
+        return
 
-    result: helpers.RecogResult = helpers.recognize_voice(voice, update, session)
+    if jobs_queue.ENABLED:
+        jobs_queue.enqueue(update.message, charge=charge)
+        return
 
-    if not result.success:
-        result.message_to_edit.edit_text("<i>Impossibile trascrivere messaggio vocale</i>", parse_mode=ParseMode.HTML)
-    else:
-        helpers.send_transcription(result)
+    helpers.transcribe(update, session, charge=charge)
 
 
 @decorators.catchexceptions()
@@ -82,20 +102,125 @@ def on_voice_message_group_chat(update: Update, _, session: Session, user: User,
     if ignore_message:
         return
 
-    if update.message.voice.file_size and update.message.voice.file_size > config.behavior.voice_max_size:
-        logger.info("voice message is too large (%d bytes)", update.message.voice.file_size)
+    media = update.message.voice or update.message.audio
+    on_demand = chat.on_demand and (
+        not chat.on_demand_auto_max_duration or media.duration > chat.on_demand_auto_max_duration
+    )
+
+    decision, level = backpressure.controller.admit_group_voice(media.duration)
+    if decision != backpressure.DECISION_ADMIT and not utilities.is_admin(update.effective_user):
+        logger.info("voice not transcribed because of backpressure (level %d): %s", level, decision)
+        if decision != backpressure.DECISION_DEFER:
+            return
+
+        on_demand = True
+
+    if on_demand:
+        logger.info("on demand: sending the transcribe button")
+        update.message.reply_html(TEXT_ON_DEMAND, reply_markup=InlineKeyboard.TRANSCRIBE, disable_notification=True, quote=True)
+        return
+
+    charge = budgets.admit_message(update.message, user, chat)
+    if not charge:
+        return
+
+    outbox.send_chat_action(update.message.bot, update.message.chat_id, ChatAction.TYPING)
+
+    if jobs_queue.ENABLED:
+        jobs_queue.enqueue(update.message, punctuation=chat.punctuation, delete_on_failure=True, charge=charge)
         return
 
-    update.message.chat.send_chat_action(ChatAction.TYPING)
+    helpers.transcribe(update, session, punctuation=chat.punctuation, delete_on_failure=True, charge=charge)
 
-    voice = VoiceMessageLocal.from_message(update.message, download=True)
 
-    result: helpers.RecogResult = helpers.recognize_voice(voice, update, session, punctuation=chat.punctuation)
+@decorators.catchexceptions()
+@decorators.pass_session(pass_user=True, pass_chat=True)
+def on_transcribe_button(update: Update, _, session: Session, user: User, chat: Chat, *args, **kwargs):
+    logger.info("transcribe button")
+
+    button_message = update.callback_query.message
+    voice_message = button_message.reply_to_message
+    if not voice_message or not (voice_message.voice or voice_message.audio):
+        # the voice has been deleted
+        update.callback_query.answer()
+        button_message.edit_text("<i>Vocale non trovato</i>", parse_mode=ParseMode.HTML)
+        return
+
+    key = (button_message.chat.id, button_message.message_id)
+    with _on_demand_lock:
+        if key in _on_demand_in_progress:
+            update.callback_query.answer("Trascrizione già in corso...")
+            return
 
-    if not result.success:
-        result.message_to_edit.delete()
+        _on_demand_in_progress.add(key)
+
+    try:
+        media = voice_message.voice or voice_message.audio
+        cached = transcripts_cache.get(media.file_unique_id)
+        if cached:
+            logger.info("on demand: transcript found in cache")
+            update.callback_query.answer()
+
+            raw_transcript, confidence, elapsed = cached
+            result = helpers.RecogResult(button_message, raw_transcript, confidence, elapsed)
+            result.format_transcript()
+            result.success = True
+            helpers.send_transcription(result)
+            return
+
+        # whoever asked for the transcription pays for it
+        charge = budgets.admit_message(voice_message, user, chat, payer=update.callback_query.from_user)
+        if not charge:
+            update.callback_query.answer(TEXT_OVER_BUDGET, show_alert=True)
+            return
+
+        update.callback_query.answer()
+
+        helpers.transcribe(
+            update,
+            session,
+            punctuation=chat.punctuation,
+            message=voice_message,
+            message_to_edit=button_message,
+            charge=charge
+        )
+    finally:
+        with _on_demand_lock:
+            _on_demand_in_progress.discard(key)
+
+
+@decorators.catchexceptions()
+def on_cancel_button(update: Update, *args, **kwargs):
+    logger.info("cancel button")
+
+    query = update.callback_query
+    token = running_transcriptions.get_by_placeholder(query.message.chat.id, query.message.message_id)
+
+    job = None
+    if not token and jobs_queue.ENABLED:
+        # transcribed by a worker process: the cancellation goes through the queue
+        job = jobs_queue.get_queue().get_by_placeholder(query.message.chat.id, query.message.message_id)
+
+    if job:
+        sender_id = job.payload["message"].get("from", {}).get("id")
+    elif token and not token.cancelled:
+        sender_id = token.user_id
     else:
-        helpers.send_transcription(result)
+        query.answer("Questa trascrizione non è più in corso")
+        return
+
+    user_id = query.from_user.id
+    if user_id != sender_id and not utilities.is_admin(query.from_user) \
+            and not (query.message.chat.type != "private" and admins_registry.is_admin(query.message.chat.id, user_id)):
+        query.answer("Solo chi ha inviato il vocale o un amministratore può annullare la trascrizione", show_alert=True)
+        return
+
+    if job:
+        jobs_queue.get_queue().cancel(job, cancellation.REASON_BUTTON)
+    else:
+        token.cancel(cancellation.REASON_BUTTON)
+
+    query.answer("Trascrizione annullata")
 
 
 sttbot.add_handler(MessageHandler(
@@ -112,4 +237,10 @@ sttbot.add_handler(MessageHandler(
     on_voice_message_private_chat_forwarded,
     run_async=True
 ))
-sttbot.add_handler(MessageHandler(Filters.chat_type.groups & CFilters.voice, on_voice_message_group_chat, run_async=True))
+sttbot.add_handler(MessageHandler(
+    Filters.chat_type.groups & CFilters.voice & CFilters.group_voice_admission,
+    on_voice_message_group_chat,
+    run_async=True
+))
+sttbot.add_handler(CallbackQueryHandler(on_transcribe_button, pattern=r"^transcribe$", run_async=True))
+sttbot.add_handler(CallbackQueryHandler(on_cancel_button, pattern=r"^transcription:cancel$"))
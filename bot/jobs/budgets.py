@@ -0,0 +1,36 @@
+import logging
+
+# noinspection PyPackageRequirements
+from telegram.ext import CallbackContext
+
+from bot import sttbot
+from bot.database.base import session_scope
+from bot.utilities import budgets
+from bot.utilities import jobs_queue
+from bot.utilities.budgets import usage_tracker
+
+logger = logging.getLogger(__name__)
+
+
+def budgets_load_job(_: CallbackContext):
+    with session_scope() as session:
+        usage_tracker.load(session)
+
+
+def budgets_flush_job(_: CallbackContext):
+    if jobs_queue.ENABLED:
+        # voices enqueued for the workers that have not been transcribed
+        for charge in jobs_queue.get_queue().pop_refunds():
+            budgets.refund(budgets.Charge.from_dict(charge))
+
+    with session_scope() as session:
+        usage_tracker.flush(session)
+
+
+if budgets.ENABLED:
+    sttbot.job_queue.run_once(budgets_load_job, 0, name="budgets_load")
+    sttbot.job_queue.run_repeating(
+        budgets_flush_job,
+        interval=budgets.BUDGETS_CONFIG.get("flush_interval", 60),
+        name="budgets_flush"
+    )
@@ -0,0 +1,24 @@
+import logging
+
+# noinspection PyPackageRequirements
+from telegram.ext import CallbackContext
+
+from bot import sttbot
+from bot.database.base import session_scope
+from bot.utilities.chat_settings import cache as chat_settings_cache
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def chat_settings_job(_: CallbackContext):
+    with session_scope() as session:
+        chat_settings_cache.load(session)
+
+
+sttbot.job_queue.run_repeating(
+    chat_settings_job,
+    interval=config.behavior.get("chat_settings_refresh", 300),
+    first=0,
+    name="chat_settings_refresh"
+)
@@ -0,0 +1,22 @@
+import logging
+
+# noinspection PyPackageRequirements
+from telegram.ext import CallbackContext
+
+from bot import sttbot
+from bot.utilities.janitor import janitor
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def downloads_janitor_job(_: CallbackContext):
+    janitor.enforce()
+
+
+sttbot.job_queue.run_repeating(
+    downloads_janitor_job,
+    interval=config.get("janitor", {}).get("interval", 60),
+    first=0,
+    name="downloads_janitor"
+)
@@ -0,0 +1,21 @@
+import logging
+
+# noinspection PyPackageRequirements
+from telegram.ext import CallbackContext
+
+from bot import sttbot
+from bot.utilities import jobs_queue
+from bot.utilities import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def jobs_queue_metrics_job(_: CallbackContext):
+    # the workers run in other processes: their metrics are not visible from here, the queue is
+    queue = jobs_queue.get_queue()
+    metrics.set_gauge("jobs_queue_size", queue.size())
+    metrics.set_gauge("jobs_queue_dead_size", queue.dead_size())
+
+
+if jobs_queue.ENABLED:
+    sttbot.job_queue.run_repeating(jobs_queue_metrics_job, interval=60, first=0, name="jobs_queue_metrics")
@@ -10,3 +10,5 @@ class InlineKeyboard:
     DISCLAIMER_HIDE = InlineKeyboardMarkup([[InlineKeyboardButton('riduci', callback_data='disclaimer:hide')]])
     OPTOUT = InlineKeyboardMarkup([[InlineKeyboardButton('richiedi opt-out', callback_data='optout')]])
     OPTIN = InlineKeyboardMarkup([[InlineKeyboardButton('richiedi opt-in', callback_data='optin')]])
+    TRANSCRIBE = InlineKeyboardMarkup([[InlineKeyboardButton('trascrivi', callback_data='transcribe')]])
+    CANCEL = InlineKeyboardMarkup([[InlineKeyboardButton('annulla', callback_data='transcription:cancel')]])
@@ -0,0 +1,241 @@
+import datetime
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Union
+
+# noinspection PyPackageRequirements
+from telegram import ChatMember
+# noinspection PyPackageRequirements
+from telegram.ext import CallbackContext, JobQueue
+
+from bot.bot import AdminPermission
+from bot.database.base import session_scope
+from bot.database.models.chat import Chat
+from bot.database.models.chat_administrator import ChatAdministrator, chat_member_to_dict
+from bot.database.queries import chat as chat_queries
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+REFRESH_SCHEDULED = 1
+REFRESH_RUNNING = 2
+REFRESH_RUNNING_STALE = 3
+
+PERMISSIONS_BITS = {
+    permission: 1 << i for i, permission in enumerate([
+        AdminPermission.CAN_MANAGE_CHAT,
+        AdminPermission.CAN_MANAGE_VOICE_CHAT,
+        AdminPermission.CAN_CHANGE_INFO,
+        AdminPermission.CAN_DELETE_MESSAGES,
+        AdminPermission.CAN_INVITE_USERS,
+        AdminPermission.CAN_RESTRICT_MEMBERS,
+        AdminPermission.CAN_PIN_MESSAGES,
+        AdminPermission.CAN_PROMOTE_MEMBERS,
+    ])
+}
+
+
+def permissions_bitmask(administrator: Union[ChatAdministrator, dict]) -> int:
+    """Accepts both a ChatAdministrator row and a dict built by chat_member_to_dict()"""
+
+    bitmask = 0
+    for permission, bit in PERMISSIONS_BITS.items():
+        if isinstance(administrator, dict):
+            value = administrator.get(permission)
+        else:
+            value = getattr(administrator, permission)
+
+        if value:
+            bitmask |= bit
+
+    return bitmask
+
+
+class ChatAdministratorsRegistry:
+    """In-memory index of the administrators of every chat: {chat_id: {user_id: permissions bitmask}}
+
+    It is populated from the db the first time a chat is needed, then kept up to date by chat_member updates
+    and by the refresh jobs. Every method is thread safe"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._administrators: Dict[int, Dict[int, int]] = {}
+        self._fetched_on: Dict[int, Optional[datetime.datetime]] = {}
+        self._refreshing: Dict[int, int] = {}
+
+    def is_loaded(self, chat_id: int) -> bool:
+        with self._lock:
+            return chat_id in self._administrators
+
+    def load(
+            self,
+            chat_id: int,
+            administrators: Iterable[Union[ChatAdministrator, dict]],
+            fetched_on: Optional[datetime.datetime] = None
+    ):
+        index = {administrator_user_id(a): permissions_bitmask(a) for a in administrators}
+
+        with self._lock:
+            self._administrators[chat_id] = index
+            self._fetched_on[chat_id] = fetched_on
+
+        logger.debug("chat %d: %d administrators indexed", chat_id, len(index))
+
+    def load_chat_members(self, chat_id: int, chat_members: List[ChatMember]):
+        self.load(
+            chat_id,
+            [chat_member_to_dict(chat_member) for chat_member in chat_members],
+            fetched_on=datetime.datetime.utcnow()
+        )
+
+    def set_administrator(self, chat_id: int, chat_member: ChatMember):
+        with self._lock:
+            if chat_id not in self._administrators:
+                # we will load the full list from the db when needed
+                return
+
+            self._administrators[chat_id][chat_member.user.id] = permissions_bitmask(chat_member_to_dict(chat_member))
+
+    def remove_administrator(self, chat_id: int, user_id: int):
+        with self._lock:
+            if chat_id in self._administrators:
+                self._administrators[chat_id].pop(user_id, None)
+
+    def forget(self, chat_id: int):
+        with self._lock:
+            self._administrators.pop(chat_id, None)
+            self._fetched_on.pop(chat_id, None)
+
+    def count(self, chat_id: int) -> int:
+        with self._lock:
+            return len(self._administrators.get(chat_id, {}))
+
+    def seconds_since_fetch(self, chat_id: int) -> Optional[float]:
+        with self._lock:
+            fetched_on = self._fetched_on.get(chat_id)
+
+        if not fetched_on:
+            return None
+
+        return (datetime.datetime.utcnow() - fetched_on).total_seconds()
+
+    def expired(self, chat_id: int) -> bool:
+        elapsed_seconds = self.seconds_since_fetch(chat_id)
+        if elapsed_seconds is None:
+            return True
+
+        return elapsed_seconds > config.behavior.chat_admins_refresh * 3600
+
+    def is_admin(
+            self,
+            chat_id: int,
+            user_id: int,
+            permissions: [None, List] = None,
+            any_permission: bool = True,
+            all_permissions: bool = False
+    ) -> bool:
+        if any_permission == all_permissions:
+            raise ValueError("only one between any_permission and all_permissions can be True or False")
+
+        with self._lock:
+            bitmask = self._administrators.get(chat_id, {}).get(user_id)
+
+        if bitmask is None:
+            return False
+
+        if not permissions:
+            return True
+
+        required = 0
+        for permission in permissions:
+            required |= PERMISSIONS_BITS[permission]
+
+        if all_permissions:
+            return bitmask & required == required
+        else:
+            return bitmask & required != 0
+
+    def start_refresh(self, chat_id: int) -> bool:
+        """Returns False if a refresh for this chat is already scheduled. If it is already running,
+        another one will be needed once it's done, because it might have fetched the list too early"""
+
+        with self._lock:
+            status = self._refreshing.get(chat_id)
+            if status == REFRESH_RUNNING:
+                self._refreshing[chat_id] = REFRESH_RUNNING_STALE
+
+            if status:
+                return False
+
+            self._refreshing[chat_id] = REFRESH_SCHEDULED
+            return True
+
+    def refresh_running(self, chat_id: int):
+        with self._lock:
+            self._refreshing[chat_id] = REFRESH_RUNNING
+
+    def end_refresh(self, chat_id: int) -> bool:
+        """Returns True if the chat received updates while the refresh was running"""
+
+        with self._lock:
+            return self._refreshing.pop(chat_id, None) == REFRESH_RUNNING_STALE
+
+
+def administrator_user_id(administrator: Union[ChatAdministrator, dict]) -> int:
+    return administrator["user_id"] if isinstance(administrator, dict) else administrator.user_id
+
+
+registry = ChatAdministratorsRegistry()
+
+# seconds to wait before syncing the db after a chat_member update, so bursts of updates result in one sync
+SYNC_DELAY = config.behavior.get("chat_admins_sync_delay", 10)
+# seconds, min time between two syncs of the same chat triggered by chat_member updates
+SYNC_MIN_INTERVAL = config.behavior.get("chat_admins_sync_min_interval", 300)
+
+
+def sync_delay(chat_id: int) -> float:
+    """How long to wait before syncing the chat's administrators after a chat_member update"""
+
+    elapsed_seconds = registry.seconds_since_fetch(chat_id)
+    if elapsed_seconds is None:
+        return SYNC_DELAY
+
+    return max(SYNC_DELAY, SYNC_MIN_INTERVAL - elapsed_seconds)
+
+
+def refresh_administrators_job(context: CallbackContext):
+    chat_id = context.job.context
+    registry.refresh_running(chat_id)
+
+    try:
+        logger.info("background refresh of chat %d administrators", chat_id)
+
+        administrators: [ChatMember] = context.bot.get_chat_administrators(chat_id)
+
+        with session_scope() as session:
+            chat = session.query(Chat).filter(Chat.chat_id == chat_id).one_or_none()
+            if not chat:
+                logger.info("chat %d not in the db anymore", chat_id)
+                return
+
+            chat_queries.update_administrators(session, chat, administrators)
+
+        registry.load_chat_members(chat_id, administrators)
+        metrics.increment("admins_background_refreshes")
+    finally:
+        if registry.end_refresh(chat_id):
+            logger.debug("chat %d received chat_member updates during the refresh: scheduling another one", chat_id)
+            schedule_refresh(context.job_queue, chat_id, when=sync_delay(chat_id))
+
+
+def schedule_refresh(job_queue: JobQueue, chat_id: int, when: float = 0):
+    """Refresh the administrators list of the chat in the background. Requests received while a refresh
+    is already scheduled are coalesced into it"""
+
+    if not registry.start_refresh(chat_id):
+        logger.debug("refresh of chat %d administrators already scheduled", chat_id)
+        metrics.increment("admins_refreshes_coalesced")
+        return
+
+    job_queue.run_once(refresh_administrators_job, when, context=chat_id, name=f"admins_refresh:{chat_id}")
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from queue import Queue
+from typing import List, Optional, Tuple
+
+from bot.utilities import jobs_queue
+from bot.utilities import metrics
+from bot.utilities.scheduler import scheduler
+from config import config
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_CONFIG = config.get("backpressure", {})
+
+# degradation levels
+LEVEL_NORMAL = 0
+LEVEL_NO_PUNCTUATION = 1
+LEVEL_SKIP_LONG_GROUP_VOICES = 2
+LEVEL_DEFER_GROUP_VOICES = 3
+
+DECISION_ADMIT = "admit"
+DECISION_SKIP = "skip"
+DECISION_DEFER = "defer"
+
+
+class BackpressureController:
+    """Sheds load step by step when we can't keep up. The pressure is the highest of:
+
+    - waiting voices / 'max_queue_depth' (the scheduler's waiting voices, the updates the dispatcher has not
+      processed yet, and the jobs waiting for a worker when the jobs queue is enabled)
+    - seconds the oldest voice has been waiting / 'max_oldest_age'
+    - bytes of the voices being processed / 'max_inflight_bytes'
+
+    Every time the pressure goes past one of 'thresholds', we degrade one more level: first punctuation is
+    disabled, then long group voices are skipped, then every group voice is deferred (not transcribed unless
+    someone asks for it). Private chats and admins are always served"""
+
+    def __init__(
+            self,
+            max_queue_depth: int,
+            max_oldest_age: float,
+            max_inflight_bytes: int,
+            long_voice_duration: int,
+            thresholds: List[float],
+            enabled: bool = True
+    ):
+        self.max_queue_depth = max_queue_depth
+        self.max_oldest_age = max_oldest_age
+        self.max_inflight_bytes = max_inflight_bytes
+        self.long_voice_duration = long_voice_duration
+        self.thresholds = sorted(thresholds)
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._inflight_bytes = 0
+        self._level = LEVEL_NORMAL
+        self._level_computed_on = 0.0
+        self._update_queue: Optional[Queue] = None
+
+    def watch_update_queue(self, update_queue: Queue):
+        """Count the updates waiting for the dispatcher as waiting voices: when it's saturated, the scheduler's
+        queue looks short just because voices don't reach it"""
+
+        self._update_queue = update_queue
+
+    @contextmanager
+    def track(self, size: Optional[int]):
+        """Count the bytes of a voice as in flight until the block exits"""
+
+        size = size or 0
+        with self._lock:
+            self._inflight_bytes += size
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._inflight_bytes -= size
+
+    def pressure(self) -> float:
+        waiting, _, oldest_age = scheduler.load()
+        if self._update_queue is not None:
+            waiting += self._update_queue.qsize()
+        if jobs_queue.ENABLED:
+            queued_jobs, oldest_job_age = jobs_queue.get_queue().load()
+            waiting += queued_jobs
+            oldest_age = max(oldest_age, oldest_job_age)
+
+        with self._lock:
+            inflight_bytes = self._inflight_bytes
+
+        metrics.set_gauge("backpressure_inflight_bytes", inflight_bytes)
+
+        return max(
+            waiting / self.max_queue_depth,
+            oldest_age / self.max_oldest_age,
+            inflight_bytes / self.max_inflight_bytes
+        )
+
+    def level(self) -> int:
+        if not self.enabled:
+            return LEVEL_NORMAL
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._level_computed_on < 1:
+                # computed at most once per second
+                return self._level
+
+            self._level_computed_on = now
+
+        pressure = self.pressure()
+        level = sum(1 for threshold in self.thresholds if pressure >= threshold)
+
+        with self._lock:
+            previous_level, self._level = self._level, level
+
+        if level != previous_level:
+            logger.warning("backpressure: level %d -> %d (pressure: %.2f)", previous_level, level, pressure)
+            metrics.set_gauge("backpressure_level", level)
+
+        return level
+
+    def punctuation_allowed(self) -> bool:
+        allowed = self.level() < LEVEL_NO_PUNCTUATION
+        if not allowed:
+            metrics.increment("backpressure_punctuation_disabled")
+
+        return allowed
+
+    def admit_group_voice(self, duration: int) -> Tuple[str, int]:
+        """Returns the decision for a group voice, and the current level"""
+
+        level = self.level()
+        if level >= LEVEL_DEFER_GROUP_VOICES:
+            metrics.increment("backpressure_deferred")
+            return DECISION_DEFER, level
+        elif level >= LEVEL_SKIP_LONG_GROUP_VOICES and duration > self.long_voice_duration:
+            metrics.increment("backpressure_skipped")
+            return DECISION_SKIP, level
+
+        return DECISION_ADMIT, level
+
+
+controller = BackpressureController(
+    max_queue_depth=BACKPRESSURE_CONFIG.get("max_queue_depth", 20),
+    max_oldest_age=BACKPRESSURE_CONFIG.get("max_oldest_age", 120),
+    max_inflight_bytes=BACKPRESSURE_CONFIG.get("max_inflight_bytes", 100 * 1024 * 1024),
+    long_voice_duration=BACKPRESSURE_CONFIG.get("long_voice_duration", 60),
+    thresholds=BACKPRESSURE_CONFIG.get("thresholds", [1.0, 1.5, 2.0]),
+    enabled=BACKPRESSURE_CONFIG.get("enabled", True),
+)
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from contextlib import AbstractContextManager
+from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from google.speechtotext.exceptions import RecognitionCancelled
+from bot.utilities import metrics
+from config import config
+
+if TYPE_CHECKING:
+    from google.speechtotext import VoiceMessage
+
+logger = logging.getLogger(__name__)
+
+BATCHER_CONFIG = config.get("batcher", {})
+
+# a callable that receives the duration of the batch and returns the scheduler slot to send it in
+SlotFactory = Callable[[int], AbstractContextManager]
+
+
+class _Item:
+    def __init__(self, voice: "VoiceMessage"):
+        self.voice = voice
+        self.joined_on = time.monotonic()
+        self.done = threading.Event()
+        self.result: Optional[Tuple[str, float]] = None  # None: the voice must be transcribed on its own
+
+
+class _Batch:
+    def __init__(self, key: Tuple):
+        self.key = key
+        self.items: List[_Item] = []
+        self.duration = 0.0
+        self.closed = threading.Event()
+        self.closed_on: Optional[float] = None  # when the leader stopped waiting for other voices
+        self.sent = False  # from now on, the items can't leave the batch
+
+
+class ShortVoiceBatcher:
+    """Transcribes bursts of short voices with a single request (see google.speechtotext.batch).
+
+    The first voice of a batch waits up to 'max_wait' seconds for other voices of the same chat with the same
+    recognition settings (language, sample rate, punctuation, model), then sends them all together from its own
+    thread, in the scheduler slot of that chat. A batch is sent
+    earlier when it has 'max_voices' voices, or when the next voice would take it over 'max_duration' seconds (the
+    limit of synchronous requests). If the batch can't be split back, or it fails, every voice is transcribed on its
+    own: recognize() returns None and the caller goes on as if the batcher didn't exist"""
+
+    def __init__(
+            self,
+            enabled: bool = False,
+            max_wait: float = 0.3,
+            max_voice_duration: int = 10,
+            max_duration: int = 55,
+            max_voices: int = 8,
+            gap: float = 1.0
+    ):
+        self.enabled = enabled
+        self.max_wait = max_wait
+        self.max_voice_duration = max_voice_duration
+        self.max_duration = min(max_duration, 59)
+        self.max_voices = max_voices
+        self.gap = gap
+
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple, _Batch] = {}
+
+    def accepts(self, voice: "VoiceMessage") -> bool:
+        from google.speechtotext import VoiceMessageLocal
+
+        # only local Ogg Opus voices can be concatenated (not the ones stored on GCS, nor converted to FLAC)
+        return (
+            self.enabled
+            and type(voice) is VoiceMessageLocal
+            and voice.ogg_opus
+            and voice.short
+            and voice.duration <= self.max_voice_duration
+        )
+
+    def _join(self, item: _Item, key: Tuple) -> Tuple[_Batch, bool]:
+        """Add the item to the pending batch of its key, or to a new one. Returns the batch, and whether the caller
+        has to send it"""
+
+        duration = item.voice.duration
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch and batch.duration + self.gap + duration > self.max_duration:
+                # full: let its leader send it right away
+                self._pending.pop(key)
+                batch.closed.set()
+                batch = None
+
+            leader = batch is None
+            if leader:
+                batch = _Batch(key)
+                self._pending[key] = batch
+            else:
+                batch.duration += self.gap
+
+            batch.items.append(item)
+            batch.duration += duration
+
+            if len(batch.items) >= self.max_voices:
+                self._pending.pop(key)
+                batch.closed.set()
+
+        return batch, leader
+
+    def _take_items(self, batch: _Batch) -> List[_Item]:
+        with self._lock:
+            batch.sent = True
+            return list(batch.items)
+
+    def _send(self, batch: _Batch, slot: SlotFactory, punctuation: bool, model: Optional[str], use_enhanced: bool, timeout: float):
+        from google.speechtotext import batch as speech_batch
+
+        batch.closed_on = time.monotonic()
+
+        items: List[_Item] = []
+        results = None
+        try:
+            if len(batch.items) > 1:
+                with slot(int(batch.duration)):
+                    # followers whose wait ran out while we were waiting for the slot have left the batch
+                    items = self._take_items(batch)
+                    if len(items) > 1:
+                        voices = [item.voice for item in items]
+                        results = speech_batch.recognize_batch(voices, self.gap, punctuation, model, use_enhanced, timeout)
+
+                if len(items) > 1 and results is None:
+                    logger.info("batch of %d voices can't be split: transcribing them one by one", len(items))
+                    metrics.increment("batcher_fallbacks")
+                elif results is not None:
+                    metrics.increment("batcher_batches")
+                    metrics.increment("batcher_batched_voices", len(items))
+        except RecognitionCancelled:
+            logger.info("batch cancelled while waiting for a slot: transcribing its voices one by one")
+        except Exception as e:
+            logger.error("batch of %d voices failed, transcribing them one by one: %s", len(items), str(e), exc_info=True)
+            metrics.increment("batcher_errors")
+        finally:
+            for i, item in enumerate(self._take_items(batch)):
+                item.result = results[i] if results else None
+                item.done.set()
+
+    def _leave(self, batch: _Batch, item: _Item) -> bool:
+        """Remove the item from the batch, unless the batch has already been sent"""
+
+        with self._lock:
+            if batch.sent:
+                return False
+
+            batch.items.remove(item)
+            batch.duration -= item.voice.duration + (self.gap if batch.items else 0)
+            return True
+
+    def recognize(
+            self,
+            voice: "VoiceMessage",
+            chat_id: int,
+            slot: SlotFactory,
+            punctuation: bool = True,
+            model: Optional[str] = None,
+            use_enhanced: bool = False,
+            timeout: float = 60,
+            cancel_event: Optional[threading.Event] = None
+    ) -> Optional[Tuple[str, float, float]]:
+        """Returns the (transcript, confidence) of the voice, plus the seconds it waited for the other voices of the
+        batch, which are not part of the recognition time. Returns None if it must be transcribed on its own"""
+
+        if voice.sample_rate is None:
+            voice.parse_sample_rate()
+
+        key = (chat_id, voice.LANGUAGE, voice.forced_sample_rate or voice.sample_rate, punctuation, model, use_enhanced)
+        item = _Item(voice)
+        batch, leader = self._join(item, key)
+
+        if leader:
+            batch.closed.wait(self.max_wait)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    self._pending.pop(key)
+
+            self._send(batch, slot, punctuation, model, use_enhanced, timeout)
+        elif not item.done.wait(self.max_wait + timeout):
+            if self._leave(batch, item):
+                # the leader is still waiting for a slot: transcribe this voice on its own, it won't be sent twice
+                logger.info("batch not sent after %s s: transcribing the voice on its own", timeout)
+                metrics.increment("batcher_wait_timeouts")
+                return None
+
+            # the batch request is in progress, and it has its own timeout
+            item.done.wait(timeout)
+
+        # the batch is sent anyway, for the other voices
+        if cancel_event and cancel_event.is_set():
+            raise RecognitionCancelled("cancelled while the batch was in progress")
+
+        if item.result is None:
+            return None
+
+        transcript, confidence = item.result
+        return transcript, confidence, max(0.0, (batch.closed_on or item.joined_on) - item.joined_on)
+
+
+batcher = ShortVoiceBatcher(
+    enabled=BATCHER_CONFIG.get("enabled", False),
+    max_wait=BATCHER_CONFIG.get("max_wait", 0.3),
+    max_voice_duration=BATCHER_CONFIG.get("max_voice_duration", 10),
+    max_duration=BATCHER_CONFIG.get("max_duration", 55),
+    max_voices=BATCHER_CONFIG.get("max_voices", 8),
+    gap=BATCHER_CONFIG.get("gap", 1.0),
+)
@@ -0,0 +1,246 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+# noinspection PyPackageRequirements
+from telegram import Message, User as TelegramUser
+
+from bot.database.models.chat import Chat
+from bot.database.models.user import User
+from bot.database.queries import audio_usage
+from bot.utilities import metrics
+from bot.utilities import utilities
+from config import config
+
+logger = logging.getLogger(__name__)
+
+BUDGETS_CONFIG = config.get("budgets", {})
+
+ENABLED = BUDGETS_CONFIG.get("enabled", False)
+
+KIND_CHAT = "chat"
+KIND_USER = "user"
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class Limits:
+    """0 means no limit"""
+
+    def __init__(self, hourly_seconds: int = 0, daily_seconds: int = 0, hourly_requests: int = 0, daily_requests: int = 0):
+        self.hourly_seconds = hourly_seconds
+        self.daily_seconds = daily_seconds
+        self.hourly_requests = hourly_requests
+        self.daily_requests = daily_requests
+
+
+class Charge:
+    """The usage counted when a voice is admitted: it is given back with refund() if the voice is not transcribed"""
+
+    def __init__(self, keys: List[Tuple[str, int]], bucket: int, duration: int):
+        self.keys = keys
+        self.bucket = bucket
+        self.duration = duration
+
+    def to_dict(self) -> dict:
+        # stored in the payload of the jobs, see jobs_queue.enqueue()
+        return dict(keys=[list(key) for key in self.keys], bucket=self.bucket, duration=self.duration)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Charge":
+        return cls([tuple(key) for key in data["keys"]], data["bucket"], data["duration"])
+
+
+# voices of admins, or with budgets disabled
+NO_CHARGE = Charge([], 0, 0)
+
+
+class UsageTracker:
+    """Audio seconds and requests per chat and per user, over sliding windows of one hour and one day.
+
+    Counters are kept in memory, in buckets of 'bucket_size' seconds: the windows slide one bucket at a time.
+    Changed buckets are flushed to the db periodically, and the last day is loaded back on startup, so a restart
+    doesn't reset the budgets"""
+
+    def __init__(self, chat_limits: Limits, user_limits: Limits, bucket_size: int = 300):
+        self.chat_limits = chat_limits
+        self.user_limits = user_limits
+        self.bucket_size = bucket_size
+
+        self._lock = threading.Lock()
+        # {(kind, entity_id): {bucket: [seconds, requests]}}
+        self._usage: Dict[Tuple[str, int], Dict[int, List[int]]] = {}
+        self._dirty: Set[Tuple[str, int, int]] = set()
+
+    def _bucket(self, now: float) -> int:
+        return int(now // self.bucket_size * self.bucket_size)
+
+    def _totals(self, key: Tuple[str, int], since: float) -> Tuple[int, int]:
+        # must be called while holding the lock
+        seconds, requests = 0, 0
+        for bucket, (bucket_seconds, bucket_requests) in self._usage.get(key, {}).items():
+            if bucket + self.bucket_size > since:
+                seconds += bucket_seconds
+                requests += bucket_requests
+
+        return seconds, requests
+
+    def _exceeded(self, key: Tuple[str, int], duration: int, limits: Limits, entity, now: float) -> Optional[str]:
+        # must be called while holding the lock
+        hourly_seconds = getattr(entity, "audio_budget_hourly", None) or limits.hourly_seconds
+        daily_seconds = getattr(entity, "audio_budget_daily", None) or limits.daily_seconds
+
+        seconds, requests = self._totals(key, now - HOUR)
+        if hourly_seconds and seconds + duration > hourly_seconds:
+            return "hourly audio budget"
+        if limits.hourly_requests and requests + 1 > limits.hourly_requests:
+            return "hourly requests limit"
+
+        seconds, requests = self._totals(key, now - DAY)
+        if daily_seconds and seconds + duration > daily_seconds:
+            return "daily audio budget"
+        if limits.daily_requests and requests + 1 > limits.daily_requests:
+            return "daily requests limit"
+
+        return None
+
+    def admit(
+            self,
+            user_id: int,
+            chat_id: int,
+            duration: int,
+            user: Optional[User] = None,
+            chat: Optional[Chat] = None,
+            now: Optional[float] = None
+    ) -> Tuple[Optional[Charge], Optional[str]]:
+        """Check the budgets of both the user and the chat. If the voice is admitted, its duration is counted
+        right away, so concurrent voices can't exceed the budgets: the returned Charge must be refunded if the voice
+        is not transcribed in the end. Returns (None, reason) if a budget is exceeded"""
+
+        now = now or time.time()
+
+        checks = [((KIND_USER, user_id), self.user_limits, user)]
+        if chat_id != user_id:
+            # private chats have the same id of the user
+            checks.append(((KIND_CHAT, chat_id), self.chat_limits, chat))
+
+        bucket = self._bucket(now)
+        with self._lock:
+            for key, limits, entity in checks:
+                reason = self._exceeded(key, duration, limits, entity, now)
+                if reason:
+                    return None, f"{key[0]} {reason}"
+
+            for key, _, _ in checks:
+                counters = self._usage.setdefault(key, {}).setdefault(bucket, [0, 0])
+                counters[0] += duration
+                counters[1] += 1
+                self._dirty.add(key + (bucket,))
+
+        return Charge([key for key, _, _ in checks], bucket, duration), None
+
+    def refund(self, charge: Charge):
+        with self._lock:
+            for key in charge.keys:
+                counters = self._usage.get(key, {}).get(charge.bucket)
+                if not counters:
+                    # already out of the daily window
+                    continue
+
+                counters[0] = max(0, counters[0] - charge.duration)
+                counters[1] = max(0, counters[1] - 1)
+                self._dirty.add(key + (charge.bucket,))
+
+    def load(self, session: Session):
+        rows = audio_usage.load_since(session, self._bucket(time.time() - DAY))
+        with self._lock:
+            for row in rows:
+                counters = self._usage.setdefault((row.kind, row.entity_id), {}).setdefault(row.bucket, [0, 0])
+                counters[0] += row.seconds
+                counters[1] += row.requests
+
+        logger.info("budgets: %d usage rows loaded", len(rows))
+
+    def flush(self, session: Session):
+        """Store the changed buckets, and forget the ones that fell out of the daily window"""
+
+        oldest_bucket = self._bucket(time.time() - DAY)
+
+        with self._lock:
+            rows = []
+            for kind, entity_id, bucket in self._dirty:
+                seconds, requests = self._usage.get((kind, entity_id), {}).get(bucket, (0, 0))
+                rows.append((kind, entity_id, bucket, seconds, requests))
+            self._dirty = set()
+
+            for key in list(self._usage.keys()):
+                buckets = {b: c for b, c in self._usage[key].items() if b >= oldest_bucket}
+                if buckets:
+                    self._usage[key] = buckets
+                else:
+                    self._usage.pop(key)
+
+            metrics.set_gauge("budgets_tracked_entities", len(self._usage))
+
+        try:
+            audio_usage.store(session, rows)
+            audio_usage.delete_older_than(session, oldest_bucket)
+            session.flush()
+        except Exception:
+            # try again with the next flush
+            with self._lock:
+                self._dirty.update((kind, entity_id, bucket) for kind, entity_id, bucket, _, _ in rows)
+            raise
+
+        logger.debug("budgets: %d usage rows flushed", len(rows))
+
+
+usage_tracker = UsageTracker(
+    chat_limits=Limits(
+        hourly_seconds=BUDGETS_CONFIG.get("chat_hourly_seconds", 0),
+        daily_seconds=BUDGETS_CONFIG.get("chat_daily_seconds", 0),
+        hourly_requests=BUDGETS_CONFIG.get("chat_hourly_requests", 0),
+        daily_requests=BUDGETS_CONFIG.get("chat_daily_requests", 0),
+    ),
+    user_limits=Limits(
+        hourly_seconds=BUDGETS_CONFIG.get("user_hourly_seconds", 0),
+        daily_seconds=BUDGETS_CONFIG.get("user_daily_seconds", 0),
+        hourly_requests=BUDGETS_CONFIG.get("user_hourly_requests", 0),
+        daily_requests=BUDGETS_CONFIG.get("user_daily_requests", 0),
+    ),
+)
+
+
+def admit_message(
+        message: Message,
+        user: Optional[User],
+        chat: Optional[Chat] = None,
+        payer: Optional[TelegramUser] = None
+) -> Optional[Charge]:
+    """Returns the Charge of the voice in the message, or None if it can't be transcribed. The voice is charged to
+    'payer' (default: its sender), whose row is 'user'. Admins are not subject to budgets"""
+
+    payer = payer or message.from_user
+    if not ENABLED or utilities.is_admin(payer):
+        return NO_CHARGE
+
+    media = message.voice or message.audio
+    charge, reason = usage_tracker.admit(payer.id, message.chat.id, media.duration or 0, user=user, chat=chat)
+    if not charge:
+        logger.info("voice rejected: %s exceeded", reason)
+        metrics.increment("budgets_rejected")
+
+    return charge
+
+
+def refund(charge: Optional[Charge]):
+    """Give back the usage of a voice that has not been transcribed: it failed, or it has been cancelled"""
+
+    if not charge or not charge.keys:
+        return
+
+    usage_tracker.refund(charge)
+    metrics.increment("budgets_refunded")
@@ -0,0 +1,121 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DEADLINES_CONFIG = config.get("deadlines", {})
+
+# why a transcription has been cancelled
+REASON_BUTTON = "button"
+REASON_BOT_REMOVED = "bot removed from the chat"
+REASON_PLACEHOLDER_DELETED = "placeholder deleted"
+
+PATH_SHORT = "short"
+PATH_LONG = "long"
+
+DEFAULT_DEADLINES = {
+    PATH_SHORT: {"download": 30, "upload": 30, "recognize": 60, "deliver": 20},
+    PATH_LONG: {"download": 60, "upload": 60, "recognize": 360, "deliver": 60},
+}
+
+
+class StageDeadlines:
+    """Seconds every stage of a transcription can take: download, upload (only for voices stored on GCS),
+    recognize and deliver (how long a transcription can be held to be sent in order)"""
+
+    def __init__(self, download: float, upload: float, recognize: float, deliver: float):
+        self.download = download
+        self.upload = upload
+        self.recognize = recognize
+        self.deliver = deliver
+
+
+def stage_deadlines(duration: int, route: Optional[str] = None) -> StageDeadlines:
+    """The deadlines of the short/long path. If 'route' is passed (see router), its own deadlines, when
+    configured, override them"""
+
+    # same threshold of VoiceMessage.short
+    path = PATH_SHORT if duration <= 59 else PATH_LONG
+    deadlines = dict(DEFAULT_DEADLINES[path], **DEADLINES_CONFIG.get(path, {}))
+    if route:
+        deadlines.update(DEADLINES_CONFIG.get(route, {}))
+
+    return StageDeadlines(**deadlines)
+
+
+class CancellationToken:
+    def __init__(self, chat_id: int, message_id: int, user_id: Optional[int]):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.placeholder_message_id: Optional[int] = None
+        self.event = threading.Event()
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self, reason: str):
+        if self.cancelled:
+            return
+
+        logger.info("transcription of %d/%d cancelled: %s", self.chat_id, self.message_id, reason)
+        metrics.increment("transcriptions_cancelled")
+
+        self.reason = reason
+        self.event.set()
+
+
+class RunningTranscriptions:
+    """The transcriptions in progress, so they can be cancelled: from the "annulla" button on their
+    "Inizio trascrizione..." message, or when the bot is removed from their chat"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Dict[Tuple[int, int], CancellationToken] = {}  # by (chat_id, message_id) of the voice
+
+    def get(self, chat_id: int, message_id: int) -> Optional[CancellationToken]:
+        with self._lock:
+            return self._tokens.get((chat_id, message_id))
+
+    def set_placeholder(self, token: CancellationToken, placeholder_message_id: int):
+        token.placeholder_message_id = placeholder_message_id
+
+    def get_by_placeholder(self, chat_id: int, placeholder_message_id: int) -> Optional[CancellationToken]:
+        with self._lock:
+            for token in self._tokens.values():
+                if token.chat_id == chat_id and token.placeholder_message_id == placeholder_message_id:
+                    return token
+
+        return None
+
+    def cancel_chat(self, chat_id: int, reason: str) -> int:
+        with self._lock:
+            tokens = [t for t in self._tokens.values() if t.chat_id == chat_id]
+
+        for token in tokens:
+            token.cancel(reason)
+
+        return len(tokens)
+
+    @contextmanager
+    def track(self, chat_id: int, message_id: int, user_id: Optional[int]) -> CancellationToken:
+        token = CancellationToken(chat_id, message_id, user_id)
+        with self._lock:
+            self._tokens[(chat_id, message_id)] = token
+
+        try:
+            yield token
+        finally:
+            with self._lock:
+                if self._tokens.get((chat_id, message_id)) is token:
+                    self._tokens.pop((chat_id, message_id))
+
+
+running_transcriptions = RunningTranscriptions()
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from queue import Queue
+from typing import Callable, List, Optional
+
+# noinspection PyPackageRequirements
+from telegram import Bot, Update
+
+from bot.custom_filters import CFilters
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CATCHUP_CONFIG = config.get("catchup", {})
+
+
+class BacklogCatchUp:
+    """Handles the updates received while the bot was offline, instead of dropping them.
+
+    The whole backlog is pulled from Telegram before polling starts, and filtered with cheap checks: voices that
+    are too old or too large are dropped, as every other message (commands are not worth answering late).
+    chat_member/my_chat_member updates are replayed right away, so our chats/admins data is up to date.
+
+    Admitted voices are sorted (private chats first, then most recent first) and fed to the dispatcher at a bounded
+    rate, and only when the update queue is empty: live updates always go first"""
+
+    def __init__(self, max_age: float, max_updates: int, rate: float):
+        self.max_age = max_age
+        self.max_updates = max_updates
+        self.interval = 60 / rate
+
+        self.next_offset = 0
+        self._replay: List[Update] = []
+        self._backlog: List[Update] = []
+
+    def _admit(self, update: Update, now: float) -> bool:
+        message = update.message
+        if not message or not CFilters.voice.filter(message):
+            return False
+
+        if now - message.date.timestamp() > self.max_age:
+            return False
+
+        media = message.voice or message.audio
+        if message.chat.type != "private" and media.file_size and media.file_size > config.behavior.voice_max_size:
+            return False
+
+        return True
+
+    def fetch(self, bot: Bot, allowed_updates: Optional[List[str]] = None) -> int:
+        """Pull the pending updates. Returns the offset polling should start from"""
+
+        # getUpdates doesn't work while a webhook is set
+        bot.delete_webhook(drop_pending_updates=False)
+
+        now = time.time()
+        fetched, dropped = 0, 0
+        while True:
+            # every request confirms the updates received with the previous one
+            updates = bot.get_updates(offset=self.next_offset, timeout=0, allowed_updates=allowed_updates)
+            if not updates:
+                break
+
+            self.next_offset = updates[-1].update_id + 1
+            fetched += len(updates)
+
+            for update in updates:
+                if update.chat_member or update.my_chat_member:
+                    self._replay.append(update)
+                elif self._admit(update, now):
+                    self._backlog.append(update)
+                else:
+                    dropped += 1
+
+        self._backlog.sort(key=lambda u: (u.message.chat.type != "private", -u.message.date.timestamp()))
+        if len(self._backlog) > self.max_updates:
+            dropped += len(self._backlog) - self.max_updates
+            self._backlog = self._backlog[:self.max_updates]
+
+        logger.info(
+            "backlog: %d pending updates, %d voices to transcribe, %d updates to replay, %d dropped",
+            fetched, len(self._backlog), len(self._replay), dropped
+        )
+        metrics.set_gauge("catchup_backlog", len(self._backlog))
+        metrics.increment("catchup_dropped", dropped)
+
+        return self.next_offset
+
+    def _feed(self, update_queue: Queue, is_running: Callable[[], bool]):
+        for update in self._replay:
+            update_queue.put(update)
+
+        self._replay = []
+
+        while self._backlog and is_running():
+            if not update_queue.empty():
+                # live traffic first
+                time.sleep(0.5)
+                continue
+
+            update_queue.put(self._backlog.pop(0))
+            metrics.increment("catchup_fed")
+            metrics.set_gauge("catchup_backlog", len(self._backlog))
+
+            time.sleep(self.interval)
+
+        logger.info("backlog: catch-up completed" if not self._backlog else "backlog: catch-up interrupted")
+
+    def start(self, update_queue: Queue, is_running: Callable[[], bool]):
+        threading.Thread(
+            target=self._feed,
+            args=(update_queue, is_running),
+            name="backlog_catchup",
+            daemon=True
+        ).start()
+
+
+catchup = BacklogCatchUp(
+    max_age=CATCHUP_CONFIG.get("max_age", 6) * 3600,
+    max_updates=CATCHUP_CONFIG.get("max_updates", 500),
+    rate=CATCHUP_CONFIG.get("rate", 20),
+)
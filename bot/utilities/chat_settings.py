@@ -0,0 +1,57 @@
+import logging
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from bot.database.models.chat import Chat
+from bot.utilities import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSettings:
+    __slots__ = ("enabled", "ignore_if_shorter_than", "ignore_if_longer_than")
+
+    def __init__(self, enabled: bool, ignore_if_shorter_than: Optional[int], ignore_if_longer_than: Optional[int]):
+        self.enabled = enabled
+        self.ignore_if_shorter_than = ignore_if_shorter_than
+        self.ignore_if_longer_than = ignore_if_longer_than
+
+
+class ChatSettingsCache:
+    """The chat settings the admission filters need, so they can decide without a db session.
+
+    The whole table is loaded periodically, and a chat is updated every time a handler loads it
+    (see decorators.pass_session). Chats that are not cached are admitted: the handler will check them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settings: Dict[int, ChatSettings] = {}
+
+    def get(self, chat_id: int) -> Optional[ChatSettings]:
+        with self._lock:
+            return self._settings.get(chat_id)
+
+    def set_chat(self, chat: Chat):
+        settings = ChatSettings(chat.enabled is not False, chat.ignore_if_shorter_than, chat.ignore_if_longer_than)
+        with self._lock:
+            self._settings[chat.chat_id] = settings
+
+    def load(self, session: Session):
+        rows = session.query(
+            Chat.chat_id, Chat.enabled, Chat.ignore_if_shorter_than, Chat.ignore_if_longer_than
+        ).all()
+
+        settings = {
+            chat_id: ChatSettings(enabled is not False, shorter_than, longer_than)
+            for chat_id, enabled, shorter_than, longer_than in rows
+        }
+        with self._lock:
+            self._settings = settings
+
+        metrics.set_gauge("chat_settings_cached", len(settings))
+        logger.debug("chat settings cache: %d chats loaded", len(settings))
+
+
+cache = ChatSettingsCache()
@@ -0,0 +1,326 @@
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar, Union
+
+# noinspection PyPackageRequirements
+import certifi
+# noinspection PyPackageRequirements
+from telegram import Voice, Audio, File, Document, VideoNote
+# noinspection PyPackageRequirements
+from telegram.error import BadRequest, NetworkError, RetryAfter, InvalidToken, TimedOut, Unauthorized
+# noinspection PyPackageRequirements
+from telegram.vendor.ptb_urllib3 import urllib3
+
+from bot.utilities import metrics
+from bot.utilities.janitor import janitor
+from config import config
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADS_CONFIG = config.get("downloads", {})
+
+Media = Union[Voice, Audio, Document, VideoNote]
+
+HEAD_SIZE = 512
+FETCH_CHUNK_SIZE = 64 * 1024
+
+T = TypeVar("T")
+
+
+def _call_on_head(on_head: Callable[[bytes], None], head: bytes):
+    try:
+        on_head(head)
+    except Exception as e:
+        # not our business: whoever needs the header will read it again from the file
+        logger.debug("on_head callback raised an exception: %s", str(e))
+
+
+class _InFlightDownload:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class DownloadManager:
+    """Downloads Telegram files through a dedicated, bounded connection pool.
+
+    - failed requests are retried with exponential backoff and full jitter
+    - the File objects returned by getFile are cached for a while (their url is valid for at least one hour),
+      so a retry or a second download of the same file_id does not need another getFile request
+    - simultaneous downloads of the same file_unique_id are coalesced: only the first one hits the network,
+      the others wait for it and copy the result if they asked for a different path
+    """
+
+    def __init__(
+            self,
+            max_connections: int = 4,
+            retries: int = 5,
+            timeout: float = 30,
+            max_time: float = 120,
+            backoff_base: float = 0.5,
+            backoff_cap: float = 10,
+            max_retry_after: float = 10,
+            file_path_ttl: int = 1800
+    ):
+        self.retries = retries
+        self.timeout = timeout
+        self.max_time = max_time
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_after = max_retry_after
+        self.file_path_ttl = file_path_ttl
+
+        # not telegram's Request: its retrieve() reads the whole file in memory
+        self._stream_pool = urllib3.PoolManager(
+            num_pools=1,
+            maxsize=max_connections,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=certifi.where()
+        )
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._files: Dict[str, Tuple[float, File]] = {}
+        self._in_flight: Dict[str, _InFlightDownload] = {}
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _get_file(self, media: Media, timeout: float) -> File:
+        now = time.monotonic()
+        with self._lock:
+            expires_on, telegram_file = self._files.get(media.file_id, (0, None))
+
+        if telegram_file and expires_on > now:
+            metrics.increment("downloads_file_path_cache_hits")
+            return telegram_file
+
+        telegram_file = media.get_file(timeout=timeout)
+        with self._lock:
+            # drop expired entries while we are here, so the cache doesn't grow forever
+            self._files = {k: v for k, v in self._files.items() if v[0] > now}
+            self._files[media.file_id] = (now + self.file_path_ttl, telegram_file)
+
+        return telegram_file
+
+    def _forget_file(self, media: Media):
+        with self._lock:
+            self._files.pop(media.file_id, None)
+
+    def _fetch(self, media: Media, file_path: str, timeout: float, on_head: Optional[Callable[[bytes], None]]):
+        response = self._open_stream(media, timeout)
+
+        # write to a temporary file first, so nobody reads a partial file from 'file_path'
+        tmp_file_path = file_path + ".part"
+        head = bytearray()
+        try:
+            with open(tmp_file_path, "wb") as f:
+                for data in response.stream(FETCH_CHUNK_SIZE):
+                    f.write(data)
+
+                    if on_head and len(head) < HEAD_SIZE:
+                        head.extend(data[:HEAD_SIZE - len(head)])
+                        if len(head) == HEAD_SIZE:
+                            # while the rest of the file is still being received
+                            _call_on_head(on_head, bytes(head))
+        except urllib3.exceptions.TimeoutError as e:
+            raise TimedOut() from e
+        except urllib3.exceptions.HTTPError as e:
+            raise NetworkError(f"urllib3 HTTPError {e}") from e
+        finally:
+            response.release_conn()
+            self._slots.release()
+
+        if on_head and len(head) < HEAD_SIZE:
+            # the whole file is shorter than that
+            _call_on_head(on_head, bytes(head))
+
+        os.replace(tmp_file_path, file_path)
+
+    def _retry(self, media: Media, request: Callable[[], T], max_time: float) -> T:
+        """Call 'request' until it succeeds, backing off between attempts, for at most 'retries' attempts and
+        'max_time' seconds. This blocks the calling thread: a RetryAfter longer than 'max_retry_after' is not waited
+        for, and neither is a delay that would end after the deadline"""
+
+        deadline = time.monotonic() + max_time
+
+        attempt = 0
+        while True:
+            try:
+                return request()
+            except RetryAfter as e:
+                error, delay = e, e.retry_after
+            except InvalidToken as e:
+                # the file url returned 404: most likely the cached file_path expired
+                self._forget_file(media)
+                error, delay = e, 0
+            except BadRequest as e:
+                if "temporarily unavailable" not in e.message.lower():
+                    raise
+                error, delay = e, self._backoff(attempt)
+            except NetworkError as e:
+                # includes TimedOut
+                error, delay = e, self._backoff(attempt)
+
+            attempt += 1
+            if attempt >= self.retries or delay > self.max_retry_after or time.monotonic() + delay > deadline:
+                logger.error("giving up downloading %s after %d attempts", media.file_id, attempt)
+                metrics.increment("downloads_failed")
+                raise error
+
+            logger.warning("downloading %s failed (attempt %d), retrying in %.1f s", media.file_id, attempt, delay)
+            metrics.increment("downloads_retries")
+            time.sleep(delay)
+
+    def _download(self, media: Media, file_path: str, timeout: float, max_time: float, on_head=None):
+        self._retry(media, lambda: self._fetch(media, file_path, timeout, on_head), max_time)
+
+    def download(
+            self,
+            media: Media,
+            file_path: str,
+            timeout: Optional[float] = None,
+            max_time: Optional[float] = None,
+            on_head: Optional[Callable[[bytes], None]] = None
+    ) -> str:
+        """'timeout' is the timeout of every request, 'max_time' the time after which we stop retrying.
+        'on_head' receives the first HEAD_SIZE bytes of the file before it's written to disk"""
+
+        timeout = timeout or self.timeout
+        max_time = max_time or self.max_time
+        key = media.file_unique_id
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = _InFlightDownload(file_path)
+                self._in_flight[key] = in_flight
+
+        if not leader:
+            logger.debug("download of %s already in progress: waiting for it", key)
+            metrics.increment("downloads_coalesced")
+            in_flight.done.wait(max_time)
+
+            if in_flight.error:
+                raise in_flight.error
+
+            if in_flight.file_path == file_path:
+                janitor.register(file_path)
+                return file_path
+
+            try:
+                shutil.copyfile(in_flight.file_path, file_path)
+                janitor.register(file_path)
+                return file_path
+            except FileNotFoundError:
+                # the other download's file has already been cleaned up: download it again
+                logger.debug("coalesced download %s not found, downloading again", in_flight.file_path)
+                return self.download(media, file_path, timeout=timeout, max_time=max_time, on_head=on_head)
+
+        logger.debug("downloading %s to %s", media.file_id, file_path)
+        start = time.monotonic()
+        try:
+            self._download(media, file_path, timeout, max_time, on_head)
+            janitor.register(file_path)
+            metrics.increment("downloads")
+            metrics.observe("downloads_seconds", time.monotonic() - start)
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+            in_flight.done.set()
+
+        return file_path
+
+    def _open_stream(self, media: Media, timeout: float):
+        """Send the GET request of the file and return the response, before reading its body: the caller must
+        release both the connection and the slot. Errors are raised as telegram.utils.request does, so they are
+        retried by _retry()"""
+
+        telegram_file = self._get_file(media, timeout)
+
+        self._slots.acquire()
+        try:
+            response = self._stream_pool.request(
+                "GET",
+                telegram_file.file_path,
+                preload_content=False,
+                timeout=urllib3.Timeout(connect=timeout, read=timeout)
+            )
+        except urllib3.exceptions.TimeoutError as e:
+            self._slots.release()
+            raise TimedOut() from e
+        except urllib3.exceptions.HTTPError as e:
+            self._slots.release()
+            raise NetworkError(f"urllib3 HTTPError {e}") from e
+
+        if 200 <= response.status <= 299:
+            return response
+
+        response.release_conn()
+        self._slots.release()
+
+        message = f"streaming {media.file_id}: unexpected HTTP status {response.status}"
+        if response.status == 404:
+            raise InvalidToken()
+        if response.status == 400:
+            raise BadRequest(message)
+        if response.status in (401, 403):
+            raise Unauthorized(message)
+        raise NetworkError(message)
+
+    def stream(
+            self,
+            media: Media,
+            chunk_size: int,
+            timeout: Optional[float] = None,
+            max_time: Optional[float] = None
+    ) -> Iterator[bytes]:
+        """Yield the file in chunks of 'chunk_size' bytes (the last one can be shorter), without writing it to disk.
+
+        The connection slot is held until the generator is exhausted or closed. Only the requests before the first
+        chunk are retried: if the transfer breaks halfway, the exception is raised to the caller"""
+
+        timeout = timeout or self.timeout
+        max_time = max_time or self.max_time
+
+        response = self._retry(media, lambda: self._open_stream(media, timeout), max_time)
+        try:
+            metrics.increment("downloads_streamed")
+            yield from self._read_chunks(response, chunk_size)
+        finally:
+            response.release_conn()
+            self._slots.release()
+
+    @staticmethod
+    def _read_chunks(response, chunk_size: int) -> Iterator[bytes]:
+        # urllib3 can return shorter reads: re-assemble chunks of exactly 'chunk_size' bytes
+        buffer = bytearray()
+        for data in response.stream(chunk_size):
+            buffer.extend(data)
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+
+        if buffer:
+            yield bytes(buffer)
+
+
+download_manager = DownloadManager(
+    max_connections=DOWNLOADS_CONFIG.get("max_connections", 4),
+    retries=DOWNLOADS_CONFIG.get("retries", 5),
+    timeout=DOWNLOADS_CONFIG.get("timeout", 30),
+    max_time=DOWNLOADS_CONFIG.get("max_time", 120),
+    backoff_base=DOWNLOADS_CONFIG.get("backoff_base", 0.5),
+    backoff_cap=DOWNLOADS_CONFIG.get("backoff_cap", 10),
+    max_retry_after=DOWNLOADS_CONFIG.get("max_retry_after", 10),
+    file_path_ttl=DOWNLOADS_CONFIG.get("file_path_ttl", 1800),
+)
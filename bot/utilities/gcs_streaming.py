@@ -0,0 +1,64 @@
+import logging
+import time
+from typing import Iterator
+
+# noinspection PyPackageRequirements
+from telegram import Message
+
+from bot.utilities import metrics
+from bot.utilities.downloader import download_manager
+from config import config
+
+logger = logging.getLogger(__name__)
+
+GCS_STREAMING_CONFIG = config.get("gcs_streaming", {})
+
+BUCKET_NAME = config.google.get("bucket_name", "")
+ENABLED = GCS_STREAMING_CONFIG.get("enabled", False) and bool(BUCKET_NAME)
+
+# resumable uploads want chunks that are a multiple of 256 KB
+CHUNK_SIZE = max(1, GCS_STREAMING_CONFIG.get("chunk_size", 1024 * 1024) // (256 * 1024)) * 256 * 1024
+
+# the Bot API can't download larger files anyway
+MAX_SIZE = GCS_STREAMING_CONFIG.get("max_size", 20 * 1024 * 1024)
+
+
+def max_file_size() -> int:
+    """The largest voice we can transcribe: large files are streamed to GCS (see router)"""
+
+    if ENABLED:
+        return max(MAX_SIZE, config.behavior.voice_max_size)
+
+    return config.behavior.voice_max_size
+
+
+def _with_deadline(chunks: Iterator[bytes], deadline: float) -> Iterator[bytes]:
+    try:
+        for chunk in chunks:
+            if time.monotonic() > deadline:
+                raise TimeoutError("streaming to GCS took too long")
+
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def voice_from_message(message: Message, max_time: float):
+    """Build a VoiceMessageRemote and pipe the Telegram download straight into its GCS blob, without touching
+    the disk: the Speech request can start as soon as the upload is completed"""
+
+    from google.speechtotext import VoiceMessageRemote
+
+    media = message.voice or message.audio
+    voice = VoiceMessageRemote.from_message(message, download=False, bucket_name=BUCKET_NAME)
+
+    start = time.monotonic()
+    chunks = _with_deadline(download_manager.stream(media, CHUNK_SIZE, max_time=max_time), start + max_time)
+    size = voice.upload_stream(chunks, CHUNK_SIZE, expected_size=media.file_size, timeout=max_time)
+
+    elapsed = time.monotonic() - start
+    logger.info("streamed %d bytes to gs://%s/%s in %.1f s", size, BUCKET_NAME, voice.file_name, elapsed)
+    metrics.increment("gcs_streamed")
+    metrics.observe("gcs_streaming_seconds", elapsed)
+
+    return voice
@@ -1,24 +1,56 @@
+import contextlib
 import datetime
+import functools
 import logging
 import time
-from typing import Tuple, Union, Optional, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Tuple, Union, Optional, List
 
 from sqlalchemy.orm import Session
 # noinspection PyPackageRequirements
-from telegram import Update, Message, MAX_MESSAGE_LENGTH, ParseMode
+from telegram import Update, Message, MAX_MESSAGE_LENGTH, ParseMode, ChatAction
+# noinspection PyPackageRequirements
+from telegram.error import BadRequest
 
 from bot.database.models.chat import Chat
 from bot.database.models.user import User
 from bot.database.models.transcription_request import TranscriptionRequest
 from bot.database.queries import transcription_request
-from google.speechtotext import VoiceMessageLocal
-from google.speechtotext import VoiceMessageRemote
-from google.speechtotext.exceptions import UnsupportedFormat
+from google import speechtotext
+from google.speechtotext.exceptions import UnsupportedFormat, RecognitionCancelled, RecognitionTimeout
+from bot.utilities import metrics
 from bot.utilities import utilities
+from bot.markups import InlineKeyboard
+from bot.utilities import budgets
+from bot.utilities import cancellation
+from bot.utilities import gcs_streaming
+from bot.utilities import router as router_utilities
+from bot.utilities import silence_trimming
+from bot.utilities.backpressure import controller as backpressure
+from bot.utilities.batcher import batcher
+from bot.utilities.cancellation import CancellationToken, StageDeadlines, running_transcriptions
+from bot.utilities.downloader import download_manager
+from bot.utilities.janitor import janitor
+from bot.utilities.outbox import outbox
+from bot.utilities.recognition_models import model_router
+from bot.utilities.router import router
+from bot.utilities.scheduler import scheduler
+from bot.utilities.sequencer import sequencer
+from bot.utilities.transcoder import transcoder
+from bot.utilities.transcripts_cache import transcripts_cache
 from config import config
 
+if TYPE_CHECKING:
+    from google.speechtotext import VoiceMessageLocal, VoiceMessageRemote
+
 logger = logging.getLogger(__name__)
 
+# seconds between two edits of the "Inizio trascrizione..." message with the progress of a long voice
+PROGRESS_INTERVAL = 15
+
+# voices are downloaded here, while the handler's thread sends the "Inizio trascrizione..." message
+_downloads_executor = ThreadPoolExecutor(max_workers=config.telegram.get("workers", 4), thread_name_prefix="voice_download")
+
 SUBSCRIPT = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")  # https://stackoverflow.com/a/24392215
 
 
@@ -95,6 +127,9 @@ class RecogResult:
 
         return self.transcript_slices
 
+    def format_transcript(self):
+        self.transcript = f"\"<i>{self._raw_transcript}</i>\" {self.confidence_subscript} {self.elapsed_subscript}"
+
     @property
     def full_transcription_words_count(self):
         return len(self._raw_transcript.split())
@@ -104,38 +139,200 @@ class RecogResult:
         return sum([len(t.split()) for t in self.transcript_slices])
 
 
+def voice_from_message(
+        message: Message,
+        voice_class=None,
+        download_max_time: Optional[float] = None,
+        route: Optional[str] = None,
+        **kwargs
+) -> Union["VoiceMessageLocal", "VoiceMessageRemote"]:
+    """Build the VoiceMessage object and download its file through the shared download manager.
+    If 'route' is passed (see router), the VoiceMessage class and the recognition method follow it"""
+
+    if route == router_utilities.ROUTE_GCS_STREAMING:
+        voice = gcs_streaming.voice_from_message(message, max_time=download_max_time or download_manager.max_time)
+    else:
+        if route == router_utilities.ROUTE_GCS:
+            voice_class = speechtotext.VoiceMessageRemote
+            kwargs["bucket_name"] = router.bucket_name
+
+        voice_class = voice_class or speechtotext.VoiceMessageLocal
+        downloader = functools.partial(download_manager.download, max_time=download_max_time)
+
+        if message.audio and transcoder.needs_transcoding(message.audio):
+            voice = transcoder.voice_from_message(message, voice_class, downloader=downloader, **kwargs)
+        else:
+            # the download manager passes the first bytes to VoiceMessage.parse_header() as soon as it receives them
+            voice = voice_class.from_message(message, downloader=downloader, parse_header=True, **kwargs)
+
+    if route:
+        voice.short = route == router_utilities.ROUTE_SYNC_INLINE
+
+    return voice
+
+
+def send_placeholder(
+        session: Session,
+        message: Message,
+        duration: int,
+        message_to_edit: Optional[Message] = None,
+        token: Optional[CancellationToken] = None
+) -> Message:
+    """Send (or edit 'message_to_edit' with) the "Inizio trascrizione..." message. It only needs the duration
+    of the voice, so it can be sent while the voice is still being downloaded"""
+
+    short = duration <= 59  # same threshold of VoiceMessage.short
+    if short:
+        text = "<i>Inizio trascrizione...</i>"
+    else:
+        avg_response_time = transcription_request.estimated_duration(session, duration)
+        text = "<i>Inizio trascrizione... Per i vocali >1 minuto potrebbe volerci un po' di più</i>"
+        if avg_response_time:
+            text = text.replace("</i>", f" (stimato: {round(avg_response_time, 1)} s)</i>")
+
+    # long voices can be cancelled while they are transcribed
+    reply_markup = InlineKeyboard.CANCEL if token and not short else None
+
+    if message_to_edit:
+        message_to_edit.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    else:
+        message_to_edit = message.reply_html(text, disable_notification=True, quote=True, reply_markup=reply_markup)
+
+    if token:
+        running_transcriptions.set_placeholder(token, message_to_edit.message_id)
+
+    return message_to_edit
+
+
 def recognize_voice(
-        voice: Union[VoiceMessageLocal, VoiceMessageRemote],
+        voice: Union["VoiceMessageLocal", "VoiceMessageRemote"],
         update: Update,
         session: Session,
         punctuation: Optional[bool] = None,
+        message: Optional[Message] = None,
+        message_to_edit: Optional[Message] = None,
+        token: Optional[CancellationToken] = None,
+        deadlines: Optional[StageDeadlines] = None,
+        placeholder_sent: bool = False,
+        request: Optional[TranscriptionRequest] = None
+) -> RecogResult:
+    """'message' is the message containing the voice (default: update.message). If 'message_to_edit' is passed,
+    it is used for the "Inizio trascrizione..." text instead of replying to the voice. If 'placeholder_sent'
+    is True, 'message_to_edit' already is the "Inizio trascrizione..." message (see send_placeholder()).
+    'request' is added to the session on success: a new one is created if not passed"""
+
+    message = message or update.message
+    deadlines = deadlines or cancellation.stage_deadlines(voice.duration)
+
+    try:
+        return _recognize_voice(
+            voice, update, session, punctuation, message, message_to_edit, token, deadlines, placeholder_sent, request
+        )
+    finally:
+        # the file is either deleted or kept on purpose: from now on, the janitor can evict it
+        janitor.release(voice.file_path)
+
+
+def _recognize_voice(
+        voice: Union["VoiceMessageLocal", "VoiceMessageRemote"],
+        update: Update,
+        session: Session,
+        punctuation: Optional[bool],
+        message: Message,
+        message_to_edit: Optional[Message],
+        token: Optional[CancellationToken],
+        deadlines: StageDeadlines,
+        placeholder_sent: bool,
+        request: Optional[TranscriptionRequest]
 ) -> RecogResult:
+    if token and token.cancelled:
+        # cancelled while the voice was being downloaded
+        voice.cleanup()
+        return RecogResult(message_to_edit=message_to_edit)
+
+    audio_duration = voice.duration
+    # before anything that depends on the duration: a trimmed voice might take the short path
+    trimmed_seconds = silence_trimming.trim(voice)
+
     if punctuation is None:
         punctuation = config.behavior.punctuation
 
-    if voice.short:
-        text = "<i>Inizio trascrizione...</i>"
-    else:
-        avg_response_time = transcription_request.estimated_duration(session, voice.duration)
-        text = "<i>Inizio trascrizione... Per i vocali >1 minuto potrebbe volerci un po' di più</i>"
-        if avg_response_time:
-            text = text.replace("</i>", f" (stimato: {round(avg_response_time, 1)} s)</i>")
+    if punctuation and not backpressure.punctuation_allowed():
+        logger.info("punctuation disabled because of backpressure")
+        punctuation = False
+
+    # long voices can be cancelled while they are transcribed
+    reply_markup = InlineKeyboard.CANCEL if token and not voice.short else None
 
-    message_to_edit = update.message.reply_html(text, disable_notification=True, quote=True)
+    if not placeholder_sent:
+        message_to_edit = send_placeholder(session, message, voice.duration, message_to_edit, token)
 
     result = RecogResult(message_to_edit=message_to_edit)
 
     start = datetime.datetime.now()
 
-    request = TranscriptionRequest(audio_duration=voice.duration)
+    request = request or TranscriptionRequest(audio_duration=audio_duration)
+    request.trimmed_seconds = round(trimmed_seconds, 1) if trimmed_seconds else None
+
+    priority_class = scheduler.classify(update.effective_chat.type, voice.duration)
+
+    model = model_router.select(voice.duration, update.effective_chat.type, backpressure.level(), punctuation)
+    request.model = model.model  # NULL: the API's default model
+    request.model_rule = model.rule
+
+    cancel_event = token.event if token else None
 
     try:
-        raw_transcript, confidence = voice.recognize(punctuation=punctuation)
+        recognized = None
+        if batcher.accepts(voice):
+            batched = batcher.recognize(
+                voice,
+                update.effective_chat.id,
+                # the batch is sent even if this voice gets cancelled
+                slot=functools.partial(scheduler.slot, update.effective_chat.id, priority_class),
+                punctuation=model.punctuation,
+                model=model.model,
+                use_enhanced=model.use_enhanced,
+                timeout=deadlines.recognize,
+                cancel_event=cancel_event
+            )
+            if batched is not None:
+                raw_transcript, confidence, batch_wait = batched
+                recognized = raw_transcript, confidence
+                # the time spent waiting for the other voices is not recognition time
+                start += datetime.timedelta(seconds=batch_wait)
+
+        if recognized is None:
+            with scheduler.slot(update.effective_chat.id, priority_class, voice.duration, cancel_event=cancel_event):
+                recognized = voice.recognize(
+                    punctuation=model.punctuation,
+                    model=model.model,
+                    use_enhanced=model.use_enhanced,
+                    timeout=deadlines.recognize,
+                    upload_timeout=deadlines.upload,
+                    cancel_event=cancel_event,
+                    progress_callback=_progress_callback(message_to_edit, reply_markup, token)
+                )
+
+        raw_transcript, confidence = recognized
+
         if not raw_transcript:
             logger.info("raw transcript evaluates to None")
             return result
 
         result.success = True
+    except RecognitionCancelled:
+        logger.info("recognition of voice %s cancelled", voice.file_path)
+        voice.cleanup()
+
+        return result
+    except RecognitionTimeout:
+        logger.error("recognition of voice %s exceeded its deadline (%d s)", voice.file_path, deadlines.recognize)
+        metrics.increment("recognitions_timed_out")
+        if not config.behavior.keep_files_on_error:
+            voice.cleanup()
+
+        return result
     except UnsupportedFormat:
         logger.error("unsupported format while transcribing voice %s", voice.file_path)
         if not config.behavior.keep_files_on_error:
@@ -164,12 +361,12 @@ def recognize_voice(
         return result
         # return message_to_edit, None
 
-    request.successful(elapsed, sample_rate=voice.sample_rate)
+    request.successful(elapsed, sample_rate=voice.sample_rate, confidence=confidence)
     session.add(request)  # add the request instance to the session only on success
 
     # print('\n'.join([f"{round(a.confidence, 2)}: {a.transcript}" for a in result]))
 
-    result.transcript = f"\"<i>{raw_transcript}</i>\" {result.confidence_subscript} {result.elapsed_subscript}"
+    result.format_transcript()
 
     if config.behavior.remove_downloaded_files:
         voice.cleanup()
@@ -178,6 +375,153 @@ def recognize_voice(
     # return message_to_edit, transcription
 
 
+def _progress_callback(message_to_edit: Message, reply_markup, token: Optional[CancellationToken]):
+    """Edit the "Inizio trascrizione..." message with the progress of a long voice, at most once every
+    PROGRESS_INTERVAL seconds. We don't get updates when a message is deleted: if the edit fails because
+    the message is gone, the transcription is cancelled"""
+
+    last_edit = {"time": time.monotonic(), "percent": 0}
+
+    def callback(percent: int):
+        now = time.monotonic()
+        if now - last_edit["time"] < PROGRESS_INTERVAL or percent == last_edit["percent"]:
+            return
+
+        last_edit.update(time=now, percent=percent)
+        try:
+            message_to_edit.edit_text(
+                f"<i>Trascrizione in corso... {percent}%</i>",
+                parse_mode=ParseMode.HTML,
+                reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            if "message to edit not found" in e.message.lower() and token:
+                token.cancel(cancellation.REASON_PLACEHOLDER_DELETED)
+            else:
+                logger.warning("error while editing the progress of a transcription: %s", e.message)
+
+    return callback
+
+
+def _timed_voice_from_message(request: TranscriptionRequest, message: Message, download_max_time: float, route: str):
+    start = time.monotonic()
+    voice = voice_from_message(message, download_max_time=download_max_time, route=route)
+    request.download_time = round(time.monotonic() - start, 1)
+
+    return voice
+
+
+def _download_result(download: Future) -> Tuple[Optional[Union["VoiceMessageLocal", "VoiceMessageRemote"]], Optional[Exception]]:
+    try:
+        return download.result(), None
+    except Exception as e:
+        logger.error("error while downloading voice: %s", str(e), exc_info=True)
+        return None, e
+
+
+def _keep_typing(message: Message, duration: int):
+    if duration <= 59:
+        # short voices are transcribed before the chat action expires
+        return contextlib.nullcontext()
+
+    return outbox.keep_chat_action(message.bot, message.chat_id, ChatAction.TYPING)
+
+
+def transcribe(
+        update: Update,
+        session: Session,
+        punctuation: Optional[bool] = None,
+        delete_on_failure: bool = False,
+        message: Optional[Message] = None,
+        message_to_edit: Optional[Message] = None,
+        charge: Optional[budgets.Charge] = None
+) -> RecogResult:
+    """Download, transcribe and send the transcription of the voice in 'message' (default: update.message). If the
+    transcription fails, the "Inizio trascrizione..." message is either edited or deleted.
+    Transcriptions of the same chat are sent in the order of the voices (see sequencer).
+    'charge' (see budgets.admit_message()) is refunded if the voice is not transcribed"""
+
+    try:
+        result = _transcribe(update, session, punctuation, delete_on_failure, message, message_to_edit)
+    except Exception:
+        budgets.refund(charge)
+        raise
+
+    if not result.success:
+        budgets.refund(charge)
+
+    return result
+
+
+def _transcribe(
+        update: Update,
+        session: Session,
+        punctuation: Optional[bool],
+        delete_on_failure: bool,
+        message: Optional[Message],
+        message_to_edit: Optional[Message]
+) -> RecogResult:
+    started_on = time.monotonic()
+
+    message = message or update.message
+    media = message.voice or message.audio
+    route = router.route(media)
+    deadlines = cancellation.stage_deadlines(media.duration, route=route)
+    sender_id = message.from_user.id if message.from_user else None
+
+    request = TranscriptionRequest(audio_duration=media.duration, route=route, file_size=media.file_size)
+
+    with sequencer.sequence(message.chat.id, message.message_id) as wait_turn, \
+            running_transcriptions.track(message.chat.id, message.message_id, sender_id) as token:
+        with backpressure.track(media.file_size), _keep_typing(message, media.duration):
+            # the download doesn't need anything else: the estimate and the "Inizio trascrizione..." message
+            # are taken care of in the meantime
+            download = _downloads_executor.submit(_timed_voice_from_message, request, message, deadlines.download, route)
+            try:
+                message_to_edit = send_placeholder(session, message, media.duration, message_to_edit, token)
+            except Exception:
+                voice, _ = _download_result(download)
+                if voice:
+                    janitor.release(voice.file_path)
+                raise
+
+            voice, download_error = _download_result(download)
+
+            if download_error:
+                result = RecogResult(message_to_edit=message_to_edit)
+            else:
+                result: RecogResult = recognize_voice(
+                    voice,
+                    update,
+                    session,
+                    punctuation=punctuation,
+                    message=message,
+                    message_to_edit=message_to_edit,
+                    token=token,
+                    deadlines=deadlines,
+                    placeholder_sent=True,
+                    request=request
+                )
+
+        if result.success:
+            request.total_time = round(time.monotonic() - started_on, 1)
+            transcripts_cache.set(media.file_unique_id, result)
+
+        if token.cancelled:
+            if token.reason == cancellation.REASON_BUTTON:
+                result.message_to_edit.edit_text("<i>Trascrizione annullata</i>", parse_mode=ParseMode.HTML)
+            # otherwise, there's nothing we can edit
+        elif not result.success and delete_on_failure:
+            outbox.delete_message(result.message_to_edit)
+        elif not result.success:
+            result.message_to_edit.edit_text("<i>Impossibile trascrivere messaggio vocale</i>", parse_mode=ParseMode.HTML)
+        else:
+            wait_turn(max_hold=deadlines.deliver)
+            send_transcription(result)
+
+    return result
+
+
 def ignore_message_group(
         session: Session,
         user: User,
@@ -185,8 +529,14 @@ def ignore_message_group(
         message: Message
 ):
     is_forward_from_user = utilities.is_forward_from_user(message)
+    media = message.voice or message.audio
     if not chat.enabled:
         return True, "chat is disabled"
+    elif media and media.duration is not None and chat.ignore_if_shorter_than and media.duration < chat.ignore_if_shorter_than:
+        # also checked by CFilters.group_voice_admission, but only for the chats in its cache
+        return True, "shorter than the chat's min duration"
+    elif media and media.duration is not None and chat.ignore_if_longer_than and media.duration > chat.ignore_if_longer_than:
+        return True, "longer than the chat's max duration"
     elif not is_forward_from_user and user.opted_out:
         return True, "non-forwarded and sender opted out"
     elif is_forward_from_user and utilities.user_hidden_account(message):
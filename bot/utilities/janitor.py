@@ -0,0 +1,194 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+JANITOR_CONFIG = config.get("janitor", {})
+
+
+class _IndexEntry:
+    __slots__ = ("size", "last_used", "in_use")
+
+    def __init__(self, size: int, last_used: float, in_use: bool):
+        self.size = size
+        self.last_used = last_used
+        self.in_use = in_use
+
+
+class DownloadsJanitor:
+    """Keeps the downloads directory under a bytes and files quota.
+
+    Every file we download is registered here as "in use" until the transcription is over: files that are
+    kept afterwards (eg. because of 'keep_files_on_error') are released and become candidates for eviction.
+    The directory is listed only once, to build the index: after that, we rely on the index only.
+    Files are evicted when they are older than 'max_age', then least recently used first until we are
+    under quota"""
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int, max_age: float, stale_in_use_after: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.stale_in_use_after = stale_in_use_after
+
+        self._lock = threading.Lock()
+        self._index: Dict[str, _IndexEntry] = {}
+        self._bytes = 0
+        self._scanned = False
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        return os.path.normpath(file_path)
+
+    def register(self, file_path: str):
+        try:
+            size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            self._pop(self._key(file_path))
+            self._index[self._key(file_path)] = _IndexEntry(size, time.time(), in_use=True)
+            self._bytes += size
+
+    def _pop(self, key: str):
+        # must be called while holding the lock
+        entry = self._index.pop(key, None)
+        if entry:
+            self._bytes -= entry.size
+
+        return entry
+
+    def release(self, file_path: str):
+        """The file is not needed anymore: if it still exists, it can be evicted"""
+
+        key = self._key(file_path)
+        exists = os.path.exists(key)
+
+        with self._lock:
+            entry = self._index.get(key)
+            if entry and not exists:
+                self._pop(key)
+            elif entry:
+                entry.in_use = False
+                entry.last_used = time.time()
+
+    def usage(self) -> Tuple[int, int]:
+        with self._lock:
+            return len(self._index), self._bytes
+
+    def scan(self):
+        """Build the index from the directory content. Files we don't know about are not in use"""
+
+        index = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+
+                stat = entry.stat(follow_symlinks=False)
+                index[self._key(entry.path)] = _IndexEntry(stat.st_size, stat.st_mtime, in_use=False)
+
+        with self._lock:
+            # keep what has been registered in the meantime
+            index.update(self._index)
+            self._index = index
+            self._bytes = sum(e.size for e in index.values())
+            self._scanned = True
+
+        logger.info("downloads janitor: %d files indexed", len(index))
+
+    def _delete(self, file_path: str) -> Tuple[bool, int]:
+        """Returns whether the file has been deleted, and the size of the removed index entry"""
+
+        with self._lock:
+            entry = self._pop(file_path)
+
+        size = entry.size if entry else 0
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            # already cleaned up by whoever downloaded it
+            return False, size
+
+        return True, size
+
+    def _evictable(self, now: float):
+        with self._lock:
+            candidates = [
+                (path, entry.last_used) for path, entry in self._index.items()
+                if not entry.in_use or now - entry.last_used > self.stale_in_use_after
+            ]
+
+        candidates.sort(key=lambda c: c[1])  # least recently used first
+        return candidates
+
+    def enforce(self) -> Tuple[int, int]:
+        """Evict files until we are under quota. Returns (deleted files, deleted bytes)"""
+
+        if not self._scanned:
+            self.scan()
+
+        now = time.time()
+        deleted_files, deleted_bytes = 0, 0
+        files_count, total_bytes = self.usage()
+
+        for file_path, last_used in self._evictable(now):
+            too_old = self.max_age and now - last_used > self.max_age
+            over_quota = total_bytes > self.max_bytes or files_count > self.max_files
+            if not too_old and not over_quota:
+                # candidates are sorted by age: the ones that follow are more recent than this one
+                break
+
+            deleted, size = self._delete(file_path)
+            files_count -= 1
+            total_bytes -= size
+            if deleted:
+                deleted_files += 1
+                deleted_bytes += size
+
+        self._update_metrics(deleted_files, deleted_bytes)
+
+        return deleted_files, deleted_bytes
+
+    def clean(self) -> Tuple[int, int]:
+        """Delete every file that is not in use"""
+
+        if not self._scanned:
+            self.scan()
+
+        deleted_files, deleted_bytes = 0, 0
+        for file_path, _ in self._evictable(time.time()):
+            deleted, size = self._delete(file_path)
+            if deleted:
+                deleted_files += 1
+                deleted_bytes += size
+
+        self._update_metrics(deleted_files, deleted_bytes)
+
+        return deleted_files, deleted_bytes
+
+    def _update_metrics(self, deleted_files: int, deleted_bytes: int):
+        files_count, total_bytes = self.usage()
+        metrics.set_gauge("janitor_directory_files", files_count)
+        metrics.set_gauge("janitor_directory_bytes", total_bytes)
+        metrics.increment("janitor_evicted_files", deleted_files)
+        metrics.increment("janitor_evicted_bytes", deleted_bytes)
+
+        if deleted_files:
+            logger.info("downloads janitor: deleted %d files (%d bytes), %d files left (%d bytes)", deleted_files, deleted_bytes, files_count, total_bytes)
+
+
+janitor = DownloadsJanitor(
+    directory=JANITOR_CONFIG.get("directory", "downloads"),
+    max_bytes=JANITOR_CONFIG.get("max_bytes", 500 * 1024 * 1024),
+    max_files=JANITOR_CONFIG.get("max_files", 1000),
+    max_age=JANITOR_CONFIG.get("max_age", 72) * 3600,
+    stale_in_use_after=JANITOR_CONFIG.get("stale_in_use_after", 3600),
+)
@@ -0,0 +1,404 @@
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+# noinspection PyPackageRequirements
+from telegram import Message
+
+from bot.utilities import metrics
+from bot.utilities.scheduler import CLASSES, scheduler
+from config import config
+
+if TYPE_CHECKING:
+    from bot.utilities.budgets import Charge
+
+logger = logging.getLogger(__name__)
+
+JOBS_QUEUE_CONFIG = config.get("jobs_queue", {})
+
+ENABLED = JOBS_QUEUE_CONFIG.get("enabled", False)
+
+
+class Job:
+    __slots__ = ("job_id", "chat_id", "message_id", "payload", "attempts", "created_on")
+
+    def __init__(self, job_id: int, chat_id: int, message_id: int, payload: dict, attempts: int, created_on: float):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.payload = payload
+        self.attempts = attempts
+        self.created_on = created_on
+
+    def __repr__(self):
+        return f"Job({self.job_id}, chat {self.chat_id}, message {self.message_id}, attempt {self.attempts})"
+
+
+class TranscriptionJobsQueue:
+    """Durable queue of transcription jobs, stored in a SQLite database shared by the bot process
+    (which enqueues jobs) and by the worker processes (which lease them).
+
+    A leased job is invisible to the other workers until its lease expires: a worker that dies while
+    processing a job doesn't lose it, another worker will lease it again. Failed jobs are retried with
+    exponential backoff, and moved to the 'dead_jobs' table after 'max_attempts'.
+
+    Every process must create its own instance: sqlite3 connections can't be shared between processes"""
+
+    def __init__(
+            self,
+            filename: str,
+            visibility_timeout: float = 600,
+            max_attempts: int = 5,
+            backoff_base: float = 5,
+            backoff_cap: float = 300,
+            priority_aging: float = 60
+    ):
+        self.filename = filename
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.priority_aging = priority_aging
+
+        # the bot process enqueues jobs from many threads: transactions must not interleave
+        self._lock = threading.Lock()
+        # we manage transactions ourselves. The timeout is how long we wait for another process' write lock
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "chat_id INTEGER NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "priority INTEGER NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_on REAL NOT NULL, "  # the job can't be leased before this time (retry backoff)
+            "leased_until REAL, "
+            "leased_by TEXT, "
+            "last_error TEXT, "
+            "created_on REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_available ON jobs (priority, available_on)")
+        self._add_missing_columns(
+            "jobs",
+            # the "Inizio trascrizione..." message sent by the worker, so the bot can find the job of its "annulla" button
+            placeholder_message_id="INTEGER",
+            # set by the bot process, read by the worker processing the job (see cancel())
+            cancelled="TEXT",
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS dead_jobs ("
+            "job_id INTEGER PRIMARY KEY, "
+            "chat_id INTEGER NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "last_error TEXT, "
+            "created_on REAL NOT NULL, "
+            "failed_on REAL NOT NULL)"
+        )
+        # budget charges of the jobs that have not been transcribed: the budgets live in the bot process, which
+        # collects them with pop_refunds()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS budget_refunds ("
+            "refund_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "charge TEXT NOT NULL)"
+        )
+
+    def _delete_and_refund(self, where: str, params: tuple) -> int:
+        # must be called inside a transaction
+        self._connection.execute(
+            "INSERT INTO budget_refunds (charge) SELECT json_extract(payload, '$.budget_charge') FROM jobs "
+            f"WHERE ({where}) AND json_extract(payload, '$.budget_charge') IS NOT NULL",
+            params
+        )
+        return self._connection.execute(f"DELETE FROM jobs WHERE {where}", params).rowcount
+
+    def _add_missing_columns(self, table: str, **columns: str):
+        # CREATE TABLE IF NOT EXISTS doesn't add the columns to the databases created by older versions
+        existing = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def put(self, chat_id: int, message_id: int, payload: dict, priority: int = 0) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (chat_id, message_id, payload, priority, available_on, created_on) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, json.dumps(payload), priority, now, now)
+            )
+        metrics.increment("jobs_queue_enqueued")
+
+        return cursor.lastrowid
+
+    def lease(self, worker: str) -> Optional[Job]:
+        """Lease the next available job, or return None if there's nothing to do. Jobs are leased by priority, but
+        a job gains one priority class every 'priority_aging' seconds it waits: a steady flow of private and short
+        voices can't starve the long group ones"""
+
+        now = time.time()
+
+        # BEGIN IMMEDIATE takes the write lock right away: two workers can't select the same job
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # cancelled jobs whose worker died: nobody is going to complete them
+                self._delete_and_refund("cancelled IS NOT NULL AND leased_until < ?", (now,))
+                row = self._connection.execute(
+                    "SELECT job_id, chat_id, message_id, payload, attempts, created_on FROM jobs "
+                    "WHERE available_on <= ? AND (leased_until IS NULL OR leased_until < ?) AND cancelled IS NULL "
+                    "ORDER BY priority - (? - created_on) / ?, job_id LIMIT 1",
+                    (now, now, now, self.priority_aging)
+                ).fetchone()
+                if row:
+                    self._connection.execute(
+                        "UPDATE jobs SET leased_until = ?, leased_by = ?, attempts = attempts + 1 WHERE job_id = ?",
+                        (now + self.visibility_timeout, worker, row[0])
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        if not row:
+            return None
+
+        job_id, chat_id, message_id, payload, attempts, created_on = row
+
+        if attempts:
+            # the job has been retried, or its previous lease expired
+            metrics.increment("jobs_queue_redelivered")
+
+        metrics.observe("jobs_queue_wait_seconds", now - created_on)
+
+        return Job(job_id, chat_id, message_id, json.loads(payload), attempts + 1, created_on)
+
+    def extend(self, job: Job, worker: str):
+        """Push the lease expiration forward, for jobs that take longer than the visibility timeout"""
+
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET leased_until = ? WHERE job_id = ? AND leased_by = ?",
+                (time.time() + self.visibility_timeout, job.job_id, worker)
+            )
+
+    def set_placeholder(self, job: Job, placeholder_message_id: int):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET placeholder_message_id = ? WHERE job_id = ?",
+                (placeholder_message_id, job.job_id)
+            )
+
+    def get_by_placeholder(self, chat_id: int, placeholder_message_id: int) -> Optional[Job]:
+        """The job still in progress whose "Inizio trascrizione..." message is 'placeholder_message_id'"""
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT job_id, chat_id, message_id, payload, attempts, created_on FROM jobs "
+                "WHERE chat_id = ? AND placeholder_message_id = ? AND cancelled IS NULL",
+                (chat_id, placeholder_message_id)
+            ).fetchone()
+
+        return Job(row[0], row[1], row[2], json.loads(row[3]), row[4], row[5]) if row else None
+
+    def cancel(self, job: Job, reason: str):
+        """Ask the worker processing the job to cancel it: the cancellation goes through the database because the
+        job's CancellationToken lives in the worker process (see workers._LeaseKeeper)"""
+
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET cancelled = ? WHERE job_id = ? AND cancelled IS NULL",
+                (reason, job.job_id)
+            )
+
+    def cancel_chat(self, chat_id: int, reason: str) -> int:
+        """Drop the jobs of the chat that are waiting, and ask the workers to cancel the ones in progress.
+        Returns the number of jobs dropped or cancelled"""
+
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = self._delete_and_refund("chat_id = ? AND (leased_until IS NULL OR leased_until < ?)", (chat_id, now))
+                cancelled = self._connection.execute(
+                    "UPDATE jobs SET cancelled = ? WHERE chat_id = ? AND cancelled IS NULL",
+                    (reason, chat_id)
+                ).rowcount
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return deleted + cancelled
+
+    def cancellation(self, job: Job) -> Optional[str]:
+        """The reason the job has been cancelled, or None"""
+
+        with self._lock:
+            row = self._connection.execute("SELECT cancelled FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+
+        return row[0] if row else None
+
+    def complete(self, job: Job, refund: bool = False):
+        """'refund': the voice has not been transcribed (eg. it has been cancelled), so its budget charge is given
+        back"""
+
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                if refund:
+                    self._delete_and_refund("job_id = ?", (job.job_id,))
+                else:
+                    self._connection.execute("DELETE FROM jobs WHERE job_id = ?", (job.job_id,))
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        metrics.increment("jobs_queue_completed")
+
+    def pop_refunds(self) -> List[dict]:
+        """The budget charges to give back, see budgets.Charge"""
+
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute("SELECT refund_id, charge FROM budget_refunds").fetchall()
+                if rows:
+                    self._connection.execute("DELETE FROM budget_refunds WHERE refund_id <= ?", (rows[-1][0],))
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return [json.loads(charge) for _, charge in rows]
+
+    def release(self, job: Job):
+        """Give the job back without counting the attempt, eg. when the worker is shutting down"""
+
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET leased_until = NULL, leased_by = NULL, attempts = attempts - 1 WHERE job_id = ?",
+                (job.job_id,)
+            )
+
+    def fail(self, job: Job, error: str):
+        now = time.time()
+
+        if job.attempts >= self.max_attempts:
+            logger.error("%s failed %d times, moving it to the dead-letter table: %s", job, job.attempts, error)
+            with self._lock:
+                self._connection.execute("BEGIN IMMEDIATE")
+                try:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO dead_jobs (job_id, chat_id, message_id, payload, attempts, last_error, created_on, failed_on) "
+                        "SELECT job_id, chat_id, message_id, payload, attempts, ?, created_on, ? FROM jobs WHERE job_id = ?",
+                        (error, now, job.job_id)
+                    )
+                    self._delete_and_refund("job_id = ?", (job.job_id,))
+                    self._connection.execute("COMMIT")
+                except Exception:
+                    self._connection.execute("ROLLBACK")
+                    raise
+
+            metrics.increment("jobs_queue_dead")
+            return
+
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** job.attempts))
+        logger.warning("%s failed, retrying in %.1f s: %s", job, delay, error)
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET available_on = ?, leased_until = NULL, leased_by = NULL, last_error = ? WHERE job_id = ?",
+                (now + delay, error, job.job_id)
+            )
+        metrics.increment("jobs_queue_retries")
+
+    def size(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def load(self) -> Tuple[int, float]:
+        """Returns (jobs waiting for a worker, seconds the oldest of them has been waiting). Jobs being processed are
+        not counted"""
+
+        now = time.time()
+        with self._lock:
+            count, oldest = self._connection.execute(
+                "SELECT COUNT(*), MIN(created_on) FROM jobs WHERE (leased_until IS NULL OR leased_until < ?) "
+                "AND cancelled IS NULL",
+                (now,)
+            ).fetchone()
+
+        return count, now - oldest if oldest else 0.0
+
+    def dead_size(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM dead_jobs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_queue() -> TranscriptionJobsQueue:
+    file_path = JOBS_QUEUE_CONFIG.get("file_path", "persistence/jobs.sqlite")
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    return TranscriptionJobsQueue(
+        file_path,
+        visibility_timeout=JOBS_QUEUE_CONFIG.get("visibility_timeout", 600),
+        max_attempts=JOBS_QUEUE_CONFIG.get("max_attempts", 5),
+        backoff_base=JOBS_QUEUE_CONFIG.get("backoff_base", 5),
+        backoff_cap=JOBS_QUEUE_CONFIG.get("backoff_cap", 300),
+        priority_aging=JOBS_QUEUE_CONFIG.get("priority_aging", 60),
+    )
+
+
+_queue: Optional[TranscriptionJobsQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> TranscriptionJobsQueue:
+    """The queue instance of the current process, opened on first use"""
+
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = open_queue()
+
+    return _queue
+
+
+def enqueue(
+        message: Message,
+        punctuation: Optional[bool] = None,
+        delete_on_failure: bool = False,
+        charge: Optional["Charge"] = None
+) -> int:
+    """Persist a transcription job for the voice in 'message'. The whole message is stored, so the worker
+    can rebuild it and reply to it without any other request to Telegram. 'charge' is refunded if the voice is not
+    transcribed. Jobs are leased in the order of the
+    scheduler's priority classes, with aging (see TranscriptionJobsQueue.lease())"""
+
+    media = message.voice or message.audio
+    priority = CLASSES.index(scheduler.classify(message.chat.type, media.duration))
+
+    payload = dict(
+        message=message.to_dict(),
+        punctuation=punctuation,
+        delete_on_failure=delete_on_failure,
+        budget_charge=charge.to_dict() if charge and charge.keys else None,
+    )
+    job_id = get_queue().put(message.chat.id, message.message_id, payload, priority=priority)
+    logger.info("transcription job %d enqueued (chat %d, message %d)", job_id, message.chat.id, message.message_id)
+
+    return job_id
@@ -0,0 +1,47 @@
+import threading
+from collections import defaultdict
+from typing import Optional
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_observations = {}
+
+
+def increment(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float):
+    """Keep count, sum and max of the values observed for 'name' (eg. wait times)"""
+
+    with _lock:
+        count, total, maximum = _observations.get(name, (0, 0.0, None))
+        maximum = value if maximum is None else max(maximum, value)
+        _observations[name] = (count + 1, total + value, maximum)
+
+
+def counter(name: str) -> int:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot(prefix: Optional[str] = None) -> dict:
+    with _lock:
+        result = dict(_counters)
+        result.update(_gauges)
+        for name, (count, total, maximum) in _observations.items():
+            result[f"{name}_count"] = count
+            result[f"{name}_avg"] = round(total / count, 3) if count else None
+            result[f"{name}_max"] = round(maximum, 3) if maximum is not None else None
+
+    if prefix:
+        result = {k: v for k, v in result.items() if k.startswith(prefix)}
+
+    return dict(sorted(result.items()))
@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Set, Tuple
+
+# noinspection PyPackageRequirements
+from telegram import Bot, Message
+# noinspection PyPackageRequirements
+from telegram.error import TelegramError
+# noinspection PyPackageRequirements
+from telegram.utils.request import Request
+
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CONFIG = config.get("outbox", {})
+
+# chat actions last 5 seconds on the client
+CHAT_ACTION_REFRESH = 4.5
+
+
+class _Item:
+    __slots__ = ("key", "call", "expires_on")
+
+    def __init__(self, key: Optional[Tuple], call: Callable, max_age: float):
+        self.key = key
+        self.call = call
+        self.expires_on = time.monotonic() + max_age
+
+
+class Outbox:
+    """Fire-and-forget Bot API calls whose result we don't need: chat actions and deletions.
+
+    Handlers put the call in a queue and move on, instead of waiting a full round trip to Telegram. The calls are
+    sent by 'workers' threads, through their own connection pool (one connection per worker), so they never compete
+    with the requests of the handlers. Calls that waited more than their max age are dropped (a chat action sent
+    too late is useless), and a chat action is not queued if the same one is already waiting for the same chat.
+
+    It also refreshes the chat action of the chats with a long job in progress (see keep_chat_action())"""
+
+    def __init__(self, workers: int = 2, max_size: int = 500, chat_action_max_age: float = 3, delete_max_age: float = 60):
+        self.workers = workers
+        self.chat_action_max_age = chat_action_max_age
+        self.delete_max_age = delete_max_age
+
+        self._queue: "queue.Queue[_Item]" = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._queued_keys: Set[Tuple] = set()
+        self._refresh: Dict[Tuple[int, str], int] = {}  # {(chat_id, action): number of jobs that want it}
+        self._bot: Optional[Bot] = None
+        self._started = False
+
+    def _start(self, token: str):
+        # must be called while holding the lock
+        self._bot = Bot(token, request=Request(con_pool_size=self.workers))
+
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"outbox_{i}", daemon=True).start()
+        threading.Thread(target=self._refresh_chat_actions, name="outbox_refresh", daemon=True).start()
+
+        self._started = True
+
+    def _put(self, bot: Bot, key: Optional[Tuple], call: Callable[[Bot], object], max_age: float):
+        with self._lock:
+            if not self._started:
+                self._start(bot.token)
+
+            if key is not None:
+                if key in self._queued_keys:
+                    metrics.increment("outbox_coalesced")
+                    return
+
+                self._queued_keys.add(key)
+
+        try:
+            self._queue.put_nowait(_Item(key, call, max_age))
+        except queue.Full:
+            logger.warning("outbox is full: call dropped")
+            metrics.increment("outbox_dropped_full")
+            with self._lock:
+                self._queued_keys.discard(key)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+
+            with self._lock:
+                self._queued_keys.discard(item.key)
+
+            if time.monotonic() > item.expires_on:
+                metrics.increment("outbox_dropped_stale")
+                continue
+
+            try:
+                item.call(self._bot)
+                metrics.increment("outbox_sent")
+            except TelegramError as e:
+                # nobody is waiting for the result: just take note
+                logger.debug("outbox call failed: %s", e.message)
+                metrics.increment("outbox_failed")
+            except Exception as e:
+                logger.error("outbox call failed: %s", str(e), exc_info=True)
+                metrics.increment("outbox_failed")
+
+    def _refresh_chat_actions(self):
+        while True:
+            time.sleep(CHAT_ACTION_REFRESH)
+
+            with self._lock:
+                chat_actions = list(self._refresh.keys())
+
+            for chat_id, action in chat_actions:
+                self._put(self._bot, ("chat_action", chat_id, action), _chat_action_call(chat_id, action), self.chat_action_max_age)
+
+    def send_chat_action(self, bot: Bot, chat_id: int, action: str):
+        self._put(bot, ("chat_action", chat_id, action), _chat_action_call(chat_id, action), self.chat_action_max_age)
+
+    def delete_message(self, message: Message):
+        chat_id, message_id = message.chat_id, message.message_id
+        self._put(message.bot, None, lambda b: b.delete_message(chat_id, message_id), self.delete_max_age)
+
+    @contextmanager
+    def keep_chat_action(self, bot: Bot, chat_id: int, action: str):
+        """Send the chat action now, and keep it visible until the block exits"""
+
+        self.send_chat_action(bot, chat_id, action)
+
+        key = (chat_id, action)
+        with self._lock:
+            self._refresh[key] = self._refresh.get(key, 0) + 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._refresh[key] -= 1
+                if not self._refresh[key]:
+                    self._refresh.pop(key)
+
+
+def _chat_action_call(chat_id: int, action: str) -> Callable[[Bot], object]:
+    return lambda b: b.send_chat_action(chat_id, action)
+
+
+outbox = Outbox(
+    workers=OUTBOX_CONFIG.get("workers", 2),
+    max_size=OUTBOX_CONFIG.get("max_size", 500),
+    chat_action_max_age=OUTBOX_CONFIG.get("chat_action_max_age", 3),
+    delete_max_age=OUTBOX_CONFIG.get("delete_max_age", 60),
+)
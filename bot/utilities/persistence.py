@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from telegram.ext import BasePersistence
+# noinspection PyPackageRequirements
+from telegram.ext.utils.types import ConversationDict
+
+logger = logging.getLogger(__name__)
+
+KIND_USER = "user"
+KIND_CHAT = "chat"
+KIND_BOT = "bot"
+
+
+class LazyDataDict(defaultdict):
+    """user_data/chat_data dict that loads a key's data from the db the first time it's accessed,
+    so nothing has to be loaded on startup"""
+
+    def __init__(self, loader: Callable[[int], Optional[dict]]):
+        super(LazyDataDict, self).__init__(dict)
+        self._loader = loader
+
+    def __missing__(self, key):
+        data = self._loader(key)
+        if data is None:
+            return super(LazyDataDict, self).__missing__(key)
+
+        self[key] = data
+        return data
+
+    def __copy__(self):
+        # BasePersistence.insert_bot() copies the dict we return from get_user_data()
+        new = LazyDataDict(self._loader)
+        new.update(self)
+        return new
+
+    def copy(self):
+        return self.__copy__()
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence backed by a SQLite database, with one row per user/chat.
+
+    user_data and chat_data are loaded lazily, one key at a time, and only the keys whose data actually
+    changed are written: startup time and flush cost do not depend on the number of stored users"""
+
+    def __init__(
+            self,
+            filename: str,
+            store_user_data: bool = True,
+            store_chat_data: bool = True,
+            store_bot_data: bool = True
+    ):
+        super(SQLitePersistence, self).__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data
+        )
+
+        self.filename = filename
+        self._lock = threading.Lock()
+        # digest of what we last read/wrote for every (kind, key), so unchanged data is not written again
+        self._digests: Dict[Tuple[str, int], bytes] = {}
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS data (kind TEXT NOT NULL, key INTEGER NOT NULL, value BLOB NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, "
+            "PRIMARY KEY (name, key))"
+        )
+
+    @staticmethod
+    def _digest(blob: bytes) -> bytes:
+        return hashlib.blake2b(blob, digest_size=16).digest()
+
+    def _load(self, kind: str, key: int):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM data WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if not row:
+                return None
+
+            self._digests[(kind, key)] = self._digest(row[0])
+
+        return self.insert_bot(pickle.loads(row[0]))
+
+    def _store(self, kind: str, key: int, data):
+        blob = pickle.dumps(data)
+        digest = self._digest(blob)
+
+        with self._lock:
+            if self._digests.get((kind, key)) == digest:
+                return
+
+            if not data and (kind, key) not in self._digests:
+                # new key that has never been written and is still empty: nothing to store
+                return
+
+            self._connection.execute("INSERT OR REPLACE INTO data (kind, key, value) VALUES (?, ?, ?)", (kind, key, blob))
+            self._digests[(kind, key)] = digest
+
+        logger.debug("persistence: stored %s %d (%d bytes)", kind, key, len(blob))
+
+    def get_user_data(self) -> DefaultDict[int, dict]:
+        return LazyDataDict(lambda user_id: self._load(KIND_USER, user_id))
+
+    def get_chat_data(self) -> DefaultDict[int, dict]:
+        return LazyDataDict(lambda chat_id: self._load(KIND_CHAT, chat_id))
+
+    def get_bot_data(self) -> dict:
+        return self._load(KIND_BOT, 0) or {}
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        with self._lock:
+            rows = self._connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        key_str = json.dumps(list(key))
+
+        with self._lock:
+            if new_state is None:
+                self._connection.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key_str))
+            else:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    (name, key_str, pickle.dumps(new_state))
+                )
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._store(KIND_USER, user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self._store(KIND_CHAT, chat_id, data)
+
+    def update_bot_data(self, data: dict):
+        self._store(KIND_BOT, 0, data)
+
+    def import_data(self, kind: str, data: Dict[int, dict]):
+        """Bulk import, used to migrate the data from a PicklePersistence file"""
+
+        rows = [(kind, key, pickle.dumps(value)) for key, value in data.items() if value]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR REPLACE INTO data (kind, key, value) VALUES (?, ?, ?)", rows)
+            self._connection.execute("COMMIT")
+
+        logger.info("persistence: imported %d %s rows", len(rows), kind)
+
+    def flush(self):
+        # every change has already been written: just make sure the WAL is merged into the main db file
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
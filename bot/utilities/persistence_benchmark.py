@@ -0,0 +1,84 @@
+"""Startup and flush time of SQLitePersistence with a small and a large number of stored users.
+
+    python -m bot.utilities.persistence_benchmark [--users 1000000]
+
+Both should stay flat as the number of users grows: user_data is loaded one key at a time, and only the changed
+keys are written"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from bot.utilities.persistence import SQLitePersistence, KIND_USER
+
+SMALL_USERS = 1000
+SAMPLES = 50
+
+
+def _user_data(user_id: int) -> dict:
+    return {"language": "it-IT", "voices": user_id % 100, "last_voice": 1600000000 + user_id}
+
+
+def _fill(file_path: str, users: int):
+    persistence = SQLitePersistence(file_path)
+    batch_size = 100000
+    for start in range(0, users, batch_size):
+        persistence.import_data(KIND_USER, {i: _user_data(i) for i in range(start, min(start + batch_size, users))})
+
+    persistence.flush()
+
+
+def _measure(file_path: str, users: int) -> dict:
+    start = time.perf_counter()
+    persistence = SQLitePersistence(file_path)
+    user_data = persistence.get_user_data()
+    startup = time.perf_counter() - start
+
+    loads, flushes = [], []
+    for i in range(SAMPLES):
+        user_id = (i * 7919) % users
+
+        start = time.perf_counter()
+        data = user_data[user_id]
+        loads.append(time.perf_counter() - start)
+
+        data["voices"] += 1
+        start = time.perf_counter()
+        persistence.update_user_data(user_id, data)
+        flushes.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    persistence.flush()
+    checkpoint = time.perf_counter() - start
+
+    return {
+        "startup": startup,
+        "load": statistics.median(loads),
+        "single key flush": statistics.median(flushes),
+        "checkpoint": checkpoint,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000, help="number of users of the large database")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {}
+        for users in (SMALL_USERS, args.users):
+            file_path = os.path.join(tmp_dir, f"persistence_{users}.sqlite")
+
+            print(f"filling {users} users...", flush=True)
+            _fill(file_path, users)
+            results[users] = _measure(file_path, users)
+
+    print(f"\n{'':<20}{SMALL_USERS:>14} users{args.users:>14} users")
+    for name in results[SMALL_USERS]:
+        print(f"{name:<20}{results[SMALL_USERS][name] * 1000:>17.3f} ms{results[args.users][name] * 1000:>17.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
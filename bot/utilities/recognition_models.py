@@ -0,0 +1,79 @@
+import logging
+from typing import List, Optional
+
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+RECOGNITION_MODELS_CONFIG = config.get("recognition_models", {})
+
+
+class ModelChoice:
+    def __init__(self, rule: str, model: Optional[str], use_enhanced: bool, punctuation: bool):
+        self.rule = rule
+        self.model = model  # None: the API's default model
+        self.use_enhanced = use_enhanced
+        self.punctuation = punctuation
+
+
+class ModelRule:
+    """A voice matches the rule if it matches all of its conditions. A condition set to None always matches"""
+
+    def __init__(
+            self,
+            name: str,
+            min_duration: Optional[int] = None,
+            max_duration: Optional[int] = None,
+            chat_types: Optional[List[str]] = None,
+            min_load_level: Optional[int] = None,
+            model: Optional[str] = None,
+            use_enhanced: bool = False,
+            punctuation: Optional[bool] = None
+    ):
+        self.name = name
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.chat_types = chat_types
+        self.min_load_level = min_load_level
+        self.model = model
+        self.use_enhanced = use_enhanced
+        self.punctuation = punctuation  # False turns punctuation off, otherwise the chat's setting is used
+
+    def matches(self, duration: int, chat_type: str, load_level: int) -> bool:
+        return (
+            (self.min_duration is None or duration >= self.min_duration)
+            and (self.max_duration is None or duration <= self.max_duration)
+            and (self.chat_types is None or chat_type in self.chat_types)
+            and (self.min_load_level is None or load_level >= self.min_load_level)
+        )
+
+
+class ModelRouter:
+    """Chooses the recognition model and its features for a voice, from its duration, the chat type and the current
+    load (the backpressure level). Rules are checked in order, the first one that matches wins. A rule can only
+    turn punctuation off: it is never enabled in chats that didn't ask for it"""
+
+    DEFAULT_RULE = "default"
+
+    def __init__(self, rules: List[ModelRule]):
+        self.rules = rules
+
+    def select(self, duration: int, chat_type: str, load_level: int, punctuation: bool) -> ModelChoice:
+        for rule in self.rules:
+            if rule.matches(duration, chat_type, load_level):
+                metrics.increment(f"recognition_model_{rule.name}")
+                return ModelChoice(
+                    rule=rule.name,
+                    model=rule.model,
+                    use_enhanced=rule.use_enhanced,
+                    punctuation=punctuation and rule.punctuation is not False
+                )
+
+        metrics.increment(f"recognition_model_{self.DEFAULT_RULE}")
+        return ModelChoice(rule=self.DEFAULT_RULE, model=None, use_enhanced=False, punctuation=punctuation)
+
+
+model_router = ModelRouter(
+    rules=[ModelRule(**rule) for rule in RECOGNITION_MODELS_CONFIG.get("rules", [])],
+)
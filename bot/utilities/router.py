@@ -0,0 +1,63 @@
+import logging
+
+from bot.utilities import gcs_streaming
+from bot.utilities import metrics
+from bot.utilities.downloader import Media
+from bot.utilities.transcoder import transcoder
+from config import config
+
+logger = logging.getLogger(__name__)
+
+ROUTER_CONFIG = config.get("router", {})
+
+# how a voice reaches the Speech API
+ROUTE_SYNC_INLINE = "sync_inline"  # recognize(), audio sent in the request
+ROUTE_LONG_INLINE = "long_inline"  # long_running_recognize(), audio sent in the request
+ROUTE_GCS = "gcs"  # downloaded, uploaded to GCS, then long_running_recognize() with its uri
+ROUTE_GCS_STREAMING = "gcs_streaming"  # piped from Telegram into GCS, without touching the disk
+
+ROUTES = (ROUTE_SYNC_INLINE, ROUTE_LONG_INLINE, ROUTE_GCS, ROUTE_GCS_STREAMING)
+
+
+class TranscriptionRouter:
+    """Picks the cheapest way to send a voice to the Speech API, from its duration and file size.
+
+    Voices up to 'sync_max_duration' seconds use a synchronous request, longer ones a long running operation.
+    The audio is sent inline in the request as long as it fits 'inline_max_size', otherwise it goes through GCS:
+    streamed, if gcs_streaming is enabled, or uploaded after the download. The chosen route is stored in
+    TranscriptionRequest together with the measured times, so the thresholds can be tuned"""
+
+    def __init__(self, sync_max_duration: int, inline_max_size: int, bucket_name: str):
+        self.sync_max_duration = sync_max_duration
+        self.inline_max_size = inline_max_size
+        self.bucket_name = bucket_name
+
+    def route(self, media: Media) -> str:
+        file_size = media.file_size or 0
+        duration = media.duration or 0
+
+        # audios that need to be converted can't be piped as they are
+        if file_size > self.inline_max_size and gcs_streaming.ENABLED and not transcoder.needs_transcoding(media):
+            route = ROUTE_GCS_STREAMING
+        elif file_size > self.inline_max_size and self.bucket_name:
+            route = ROUTE_GCS
+        elif file_size > self.inline_max_size:
+            logger.warning("voice of %d bytes is over the inline limit, but no bucket is configured", file_size)
+            route = ROUTE_LONG_INLINE if duration > self.sync_max_duration else ROUTE_SYNC_INLINE
+        elif duration > self.sync_max_duration:
+            route = ROUTE_LONG_INLINE
+        else:
+            route = ROUTE_SYNC_INLINE
+
+        metrics.increment(f"router_{route}")
+
+        return route
+
+
+router = TranscriptionRouter(
+    # the Speech API doesn't accept more than one minute of audio in synchronous requests
+    sync_max_duration=min(ROUTER_CONFIG.get("sync_max_duration", 59), 59),
+    # the Speech API rejects requests with more than 10 mb of inline audio
+    inline_max_size=ROUTER_CONFIG.get("inline_max_size", 10 * 1000 * 1000),
+    bucket_name=config.google.get("bucket_name", ""),
+)
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from bot.utilities import metrics
+from google.speechtotext.exceptions import RecognitionCancelled
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_CONFIG = config.get("scheduler", {})
+
+# priority classes, from the most to the least important
+CLASS_ADMIN = "admin"
+CLASS_PRIVATE = "private"
+CLASS_SHORT_GROUP = "short_group"
+CLASS_LONG_GROUP = "long_group"
+
+CLASSES = (CLASS_ADMIN, CLASS_PRIVATE, CLASS_SHORT_GROUP, CLASS_LONG_GROUP)
+
+DEFAULT_WEIGHTS = {
+    CLASS_ADMIN: 100,
+    CLASS_PRIVATE: 10,
+    CLASS_SHORT_GROUP: 4,
+    CLASS_LONG_GROUP: 1,
+}
+
+
+class _Ticket:
+    __slots__ = ("chat_id", "priority_class", "finish_tag", "enqueued_on", "granted")
+
+    def __init__(self, chat_id: int, priority_class: str, finish_tag: float):
+        self.chat_id = chat_id
+        self.priority_class = priority_class
+        self.finish_tag = finish_tag
+        self.enqueued_on = time.monotonic()
+        self.granted = False
+
+
+class TranscriptionScheduler:
+    """Decides which waiting voice is recognized next, when more voices than 'slots' are waiting.
+
+    It's a weighted fair queue: every voice costs its duration, divided by the weight of its priority class,
+    and gets a virtual finish tag that follows the previous voice of the same chat. The voice with the smallest
+    tag goes first. A chat that sends many long voices only delays its own voices, and voices of heavier classes
+    (admin /r, private chats) overtake the others. Chats can't have more than 'max_per_chat' voices in
+    recognition at the same time.
+
+    Waiting happens in the run_async threads: the dispatcher's workers must be more than 'slots', otherwise
+    voices wait in the dispatcher's queue (FIFO) instead of here"""
+
+    def __init__(self, slots: int, max_per_chat: int, weights: Dict[str, float], short_group_max_duration: int):
+        self.slots = slots
+        self.max_per_chat = max_per_chat
+        self.weights = weights
+        self.short_group_max_duration = short_group_max_duration
+
+        self._lock = threading.Condition()
+        self._waiting: List[_Ticket] = []
+        self._running = 0
+        self._running_per_chat: Dict[int, int] = {}
+        self._last_finish_tag: Dict[int, float] = {}
+        self._virtual_time = 0.0
+
+    def classify(self, chat_type: str, duration: int, admin: bool = False) -> str:
+        if admin:
+            return CLASS_ADMIN
+        elif chat_type == "private":
+            return CLASS_PRIVATE
+        elif duration <= self.short_group_max_duration:
+            return CLASS_SHORT_GROUP
+        else:
+            return CLASS_LONG_GROUP
+
+    def _dispatch(self):
+        # must be called while holding the lock
+        while self._running < self.slots:
+            eligible = [t for t in self._waiting if self._running_per_chat.get(t.chat_id, 0) < self.max_per_chat]
+            if not eligible:
+                break
+
+            ticket = min(eligible, key=lambda t: t.finish_tag)
+            self._waiting.remove(ticket)
+            self._virtual_time = ticket.finish_tag
+            self._running += 1
+            self._running_per_chat[ticket.chat_id] = self._running_per_chat.get(ticket.chat_id, 0) + 1
+            ticket.granted = True
+
+            if self._waiting:
+                logger.debug(
+                    "scheduler: chat %d (%s) goes first, %d voices waiting",
+                    ticket.chat_id, ticket.priority_class, len(self._waiting)
+                )
+
+        self._lock.notify_all()
+
+    def _update_metrics(self):
+        # must be called while holding the lock
+        for priority_class in CLASSES:
+            metrics.set_gauge(
+                f"scheduler_waiting_{priority_class}",
+                sum(1 for t in self._waiting if t.priority_class == priority_class)
+            )
+        metrics.set_gauge("scheduler_running", self._running)
+
+    def acquire(
+            self,
+            chat_id: int,
+            priority_class: str,
+            cost: float,
+            cancel_event: Optional[threading.Event] = None
+    ) -> _Ticket:
+        """Raises RecognitionCancelled if 'cancel_event' is set while the voice is waiting"""
+
+        with self._lock:
+            start_tag = max(self._virtual_time, self._last_finish_tag.get(chat_id, 0.0))
+            finish_tag = start_tag + max(cost, 1) / self.weights.get(priority_class, 1)
+            self._last_finish_tag[chat_id] = finish_tag
+
+            if len(self._last_finish_tag) > 1000:
+                # forget the chats whose last voice is in the past
+                self._last_finish_tag = {c: f for c, f in self._last_finish_tag.items() if f > self._virtual_time}
+
+            ticket = _Ticket(chat_id, priority_class, finish_tag)
+            self._waiting.append(ticket)
+            self._dispatch()
+
+            while not ticket.granted:
+                if cancel_event and cancel_event.is_set():
+                    self._waiting.remove(ticket)
+                    self._update_metrics()
+                    raise RecognitionCancelled("cancelled while waiting for a slot")
+
+                self._lock.wait(1 if cancel_event else None)
+
+            self._update_metrics()
+
+        wait = time.monotonic() - ticket.enqueued_on
+        metrics.increment(f"scheduler_dispatched_{priority_class}")
+        metrics.observe(f"scheduler_wait_seconds_{priority_class}", wait)
+
+        return ticket
+
+    def release(self, ticket: _Ticket):
+        with self._lock:
+            self._running -= 1
+            self._running_per_chat[ticket.chat_id] -= 1
+            if not self._running_per_chat[ticket.chat_id]:
+                self._running_per_chat.pop(ticket.chat_id)
+
+                # forget chats with nothing waiting, once the virtual time went past their last voice
+                if self._last_finish_tag.get(ticket.chat_id, 0.0) <= self._virtual_time \
+                        and not any(t.chat_id == ticket.chat_id for t in self._waiting):
+                    self._last_finish_tag.pop(ticket.chat_id, None)
+
+            self._dispatch()
+            self._update_metrics()
+
+    def load(self) -> Tuple[int, int, float]:
+        """Returns (waiting voices, voices in recognition, seconds the oldest waiting voice has been waiting)"""
+
+        now = time.monotonic()
+        with self._lock:
+            oldest = min((t.enqueued_on for t in self._waiting), default=now)
+            return len(self._waiting), self._running, now - oldest
+
+    @contextmanager
+    def slot(self, chat_id: int, priority_class: str, cost: float, cancel_event: Optional[threading.Event] = None):
+        """Block until it's the turn of this voice"""
+
+        ticket = self.acquire(chat_id, priority_class, cost, cancel_event=cancel_event)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+
+scheduler = TranscriptionScheduler(
+    # by default the scheduler only orders the voices: concurrency is bounded by the dispatcher's workers
+    slots=SCHEDULER_CONFIG.get("slots", config.telegram.get("workers", 4)),
+    max_per_chat=SCHEDULER_CONFIG.get("max_per_chat", 1),
+    weights={c: SCHEDULER_CONFIG.get("weights", {}).get(c, w) for c, w in DEFAULT_WEIGHTS.items()},
+    short_group_max_duration=SCHEDULER_CONFIG.get("short_group_max_duration", 30),
+)
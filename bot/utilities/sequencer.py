@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Set
+
+from bot.utilities import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SEQUENCER_CONFIG = config.get("sequencer", {})
+
+
+class DeliverySequencer:
+    """Sends the transcriptions of a chat in the same order of the voices, while they are recognized in parallel.
+
+    Every voice is registered when its processing starts. Once transcribed, a voice waits until the voices of the
+    same chat with a smaller message_id have been delivered (or have failed), but never longer than 'max_hold'
+    seconds: a long voice can delay the transcription of a short voice sent after it, but not indefinitely"""
+
+    def __init__(self, max_hold: float, enabled: bool = True):
+        self.max_hold = max_hold
+        self.enabled = enabled
+
+        self._lock = threading.Condition()
+        self._pending: Dict[int, Set[int]] = {}
+
+    def register(self, chat_id: int, message_id: int):
+        with self._lock:
+            self._pending.setdefault(chat_id, set()).add(message_id)
+
+    def wait_turn(self, chat_id: int, message_id: int, max_hold: Optional[float] = None) -> bool:
+        """Block until the previous voices of the chat have been delivered. Returns False if 'max_hold' expired
+        ('max_hold' can only be lower than the sequencer's one)"""
+
+        if not self.enabled:
+            return True
+
+        max_hold = min(max_hold, self.max_hold) if max_hold is not None else self.max_hold
+
+        start = time.monotonic()
+        deadline = start + max_hold
+        with self._lock:
+            while min(self._pending.get(chat_id, {message_id})) < message_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self._lock.wait(remaining)
+
+            in_turn = min(self._pending.get(chat_id, {message_id})) >= message_id
+
+        held = time.monotonic() - start
+        if held > 0.1:
+            logger.info("sequencer: transcription of %d/%d held for %.1f s", chat_id, message_id, held)
+            metrics.observe("sequencer_hold_seconds", held)
+
+        if not in_turn:
+            logger.info("sequencer: max hold expired for %d/%d, sending out of order", chat_id, message_id)
+            metrics.increment("sequencer_hold_expired")
+
+        return in_turn
+
+    def done(self, chat_id: int, message_id: int):
+        with self._lock:
+            pending = self._pending.get(chat_id)
+            if pending is not None:
+                pending.discard(message_id)
+                if not pending:
+                    self._pending.pop(chat_id)
+
+            self._lock.notify_all()
+
+    @contextmanager
+    def sequence(self, chat_id: int, message_id: int) -> Callable[..., bool]:
+        """Register the voice until the block exits. Yields the function to call before sending the transcription"""
+
+        self.register(chat_id, message_id)
+        try:
+            yield lambda max_hold=None: self.wait_turn(chat_id, message_id, max_hold=max_hold)
+        finally:
+            self.done(chat_id, message_id)
+
+
+sequencer = DeliverySequencer(
+    max_hold=SEQUENCER_CONFIG.get("max_hold", 20),
+    enabled=SEQUENCER_CONFIG.get("enabled", True),
+)
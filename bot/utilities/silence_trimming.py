@@ -0,0 +1,53 @@
+import logging
+from typing import Union, TYPE_CHECKING
+
+from bot.utilities import metrics
+from bot.utilities.janitor import janitor
+from config import config
+
+if TYPE_CHECKING:
+    from google.speechtotext import VoiceMessageLocal, VoiceMessageRemote
+
+logger = logging.getLogger(__name__)
+
+SILENCE_TRIMMING_CONFIG = config.get("silence_trimming", {})
+
+ENABLED = SILENCE_TRIMMING_CONFIG.get("enabled", False)
+
+TRIM_KWARGS = {
+    k: SILENCE_TRIMMING_CONFIG[k]
+    for k in ("threshold_ratio", "window", "padding", "max_pause", "min_saved")
+    if k in SILENCE_TRIMMING_CONFIG
+}
+
+
+def trim(voice: Union["VoiceMessageLocal", "VoiceMessageRemote"]) -> float:
+    """Trim the silence of the voice, if enabled. Trimming is just an optimization: if it fails, the voice is
+    transcribed as it is. Returns the removed seconds"""
+
+    if not ENABLED:
+        return 0.0
+
+    was_short = voice.short
+    downloaded_file_path = voice.file_path
+    try:
+        trimmed_seconds = voice.trim_silence(**TRIM_KWARGS)
+    except Exception as e:
+        logger.warning("trimming the silence of %s failed: %s", voice.file_path, str(e))
+        metrics.increment("silence_trimming_failed")
+        return 0.0
+
+    if not trimmed_seconds:
+        return 0.0
+
+    # the voice now points to the trimmed file
+    janitor.release(downloaded_file_path)
+    janitor.register(voice.file_path)
+
+    metrics.increment("silence_trimmed_voices")
+    if voice.short and not was_short:
+        metrics.increment("silence_trimming_short_path")
+
+    logger.info("trimmed %.1f s of silence from %s", trimmed_seconds, voice.file_path)
+
+    return trimmed_seconds
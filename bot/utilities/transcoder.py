@@ -0,0 +1,199 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Callable, Optional, Tuple, Union, TYPE_CHECKING
+
+# noinspection PyPackageRequirements
+from telegram import Audio, Message, Voice
+
+from google.speechtotext.exceptions import UnsupportedFormat
+from bot.utilities import metrics
+from bot.utilities import utilities
+from bot.utilities.janitor import janitor
+from config import config
+
+if TYPE_CHECKING:
+    from google.speechtotext import VoiceMessageLocal, VoiceMessageRemote
+
+logger = logging.getLogger(__name__)
+
+TRANSCODER_CONFIG = config.get("transcoder", {})
+
+CODEC_FLAC = "flac"
+CODEC_OPUS = "opus"
+
+# codec: (ffmpeg output options, extension, sample rate). FLAC at 16 kHz is what the Speech API recommends, Opus is
+# used for long audios, so they still fit an inline request
+OUTPUT_FORMATS = {
+    CODEC_FLAC: (["-c:a", "flac", "-ar", "16000", "-sample_fmt", "s16", "-f", "flac"], "flac", 16000),
+    CODEC_OPUS: (["-c:a", "libopus", "-b:a", "32k", "-ar", "48000", "-application", "voip", "-f", "ogg"], "ogg", 48000),
+}
+
+
+class Transcoder:
+    """Converts the audio files the Speech API doesn't accept (mp3, m4a, wav...) to mono FLAC or Ogg Opus.
+
+    Conversions are done by ffmpeg subprocesses, so the CPU work never runs in the bot's threads: at most 'workers'
+    at the same time, and each one is killed after 'timeout' seconds (see share_slots() for the worker processes).
+    The converted files are cached in 'cache_dir' by file_unique_id (the most recent ones, up to 'cache_max_files'
+    and 'cache_max_bytes'), so an audio that is forwarded or transcribed again is neither downloaded nor converted
+    twice"""
+
+    def __init__(
+            self,
+            enabled: bool = False,
+            ffmpeg: str = "ffmpeg",
+            workers: int = 2,
+            timeout: float = 120,
+            max_wait: float = 60,
+            flac_max_duration: int = 240,
+            cache_dir: str = os.path.join("downloads", "transcoded"),
+            cache_max_files: int = 200,
+            cache_max_bytes: int = 200 * 1024 * 1024
+    ):
+        self.enabled = enabled
+        self.ffmpeg = ffmpeg
+        self.workers = workers
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.flac_max_duration = flac_max_duration
+        self.cache_dir = cache_dir
+        self.cache_max_files = cache_max_files
+        self.cache_max_bytes = cache_max_bytes
+
+        self._slots = threading.BoundedSemaphore(workers)
+        self._cache_lock = threading.Lock()
+
+    def share_slots(self, slots):
+        """Use a semaphore shared with other processes (eg. a multiprocessing.BoundedSemaphore of 'workers'), so
+        'workers' caps the conversions of all of them and not of every single process"""
+
+        self._slots = slots
+
+    def needs_transcoding(self, media: Union[Voice, Audio]) -> bool:
+        # voices and WhatsApp voices are already Ogg Opus
+        return self.enabled and isinstance(media, Audio) and not utilities.is_whatsapp_voice(media, check_file_name=False)
+
+    def codec(self, duration: int) -> str:
+        return CODEC_FLAC if duration <= self.flac_max_duration else CODEC_OPUS
+
+    def _cache_path(self, file_unique_id: str, codec: str) -> str:
+        _, extension, _ = OUTPUT_FORMATS[codec]
+        return os.path.join(self.cache_dir, f"{file_unique_id}.{extension}")
+
+    def _evict(self):
+        with self._cache_lock:
+            with os.scandir(self.cache_dir) as entries:
+                files = [e for e in entries if e.is_file(follow_symlinks=False) and not e.name.endswith(".part")]
+
+            files_count = len(files)
+            total_bytes = sum(e.stat().st_size for e in files)
+
+            # least recently used first
+            files.sort(key=lambda e: e.stat().st_mtime)
+            for entry in files:
+                if files_count <= self.cache_max_files and total_bytes <= self.cache_max_bytes:
+                    break
+
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+                files_count -= 1
+                total_bytes -= entry.stat().st_size
+
+    def _run_ffmpeg(self, source: str, destination: str, codec: str):
+        output_options, _, _ = OUTPUT_FORMATS[codec]
+
+        # never leave a partial file where the cache would find it
+        tmp_destination = f"{destination}.{threading.get_ident()}.part"
+        args = [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+            "-i", source,
+            "-vn", "-map_metadata", "-1", "-ac", "1",
+            *output_options,
+            tmp_destination
+        ]
+
+        if not self._slots.acquire(timeout=self.max_wait):
+            metrics.increment("transcoder_busy")
+            raise TimeoutError(f"no transcoder available after {self.max_wait} s")
+
+        start = time.monotonic()
+        try:
+            subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout, check=True)
+            os.replace(tmp_destination, destination)
+        except subprocess.TimeoutExpired:
+            metrics.increment("transcoder_timeouts")
+            raise TimeoutError(f"ffmpeg didn't complete in {self.timeout} s")
+        except subprocess.CalledProcessError as e:
+            metrics.increment("transcoder_errors")
+            raise UnsupportedFormat(f"ffmpeg exited with status {e.returncode}: {e.stderr.decode(errors='replace').strip()}")
+        finally:
+            self._slots.release()
+            if os.path.exists(tmp_destination):
+                os.remove(tmp_destination)
+
+        metrics.observe("transcoder_seconds", time.monotonic() - start)
+
+    def voice_from_message(
+            self,
+            message: Message,
+            voice_class: type,
+            downloader: Optional[Callable] = None,
+            **kwargs
+    ) -> Union["VoiceMessageLocal", "VoiceMessageRemote"]:
+        """Build the VoiceMessage of an audio that needs to be converted: it is downloaded and converted, unless the
+        converted file is cached. The VoiceMessage then points to a copy of the converted file"""
+
+        audio = message.audio
+        codec = self.codec(audio.duration or 0)
+        cache_path = self._cache_path(audio.file_unique_id, codec)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        cached = os.path.isfile(cache_path)
+        metrics.increment("transcoder_cache_hits" if cached else "transcoder_cache_misses")
+
+        voice = voice_class.from_message(message, download=not cached, downloader=downloader, **kwargs)
+
+        if cached:
+            # keep it in the cache
+            os.utime(cache_path)
+        else:
+            try:
+                self._run_ffmpeg(voice.file_path, cache_path, codec)
+            finally:
+                voice.cleanup()
+                janitor.release(voice.file_path)
+
+            self._evict()
+
+        _, extension, sample_rate = OUTPUT_FORMATS[codec]
+        file_name = "{}_converted.{}".format(os.path.splitext(voice.file_name)[0], extension)
+        voice.use_converted_file(file_name, codec, sample_rate)
+
+        # the cached file might be evicted while it's being transcribed
+        shutil.copyfile(cache_path, voice.file_path)
+        janitor.register(voice.file_path)
+
+        logger.debug("audio %s converted to %s (cached: %s)", audio.file_unique_id, codec, cached)
+
+        return voice
+
+
+transcoder = Transcoder(
+    enabled=TRANSCODER_CONFIG.get("enabled", False),
+    ffmpeg=TRANSCODER_CONFIG.get("ffmpeg", "ffmpeg"),
+    workers=TRANSCODER_CONFIG.get("workers", 2),
+    timeout=TRANSCODER_CONFIG.get("timeout", 120),
+    max_wait=TRANSCODER_CONFIG.get("max_wait", 60),
+    flac_max_duration=TRANSCODER_CONFIG.get("flac_max_duration", 240),
+    cache_dir=TRANSCODER_CONFIG.get("cache_dir", os.path.join("downloads", "transcoded")),
+    cache_max_files=TRANSCODER_CONFIG.get("cache_max_files", 200),
+    cache_max_bytes=TRANSCODER_CONFIG.get("cache_max_bytes", 200 * 1024 * 1024),
+)
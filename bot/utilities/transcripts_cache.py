@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from bot.utilities import metrics
+from config import config
+
+# (raw transcript, confidence, elapsed seconds)
+CachedTranscript = Tuple[str, float, float]
+
+
+class TranscriptsCache:
+    """The last 'max_items' transcripts, by file_unique_id, so the same voice is never sent to Google twice
+    (eg. when the "Trascrivi" button is pressed again, or the voice is forwarded)"""
+
+    def __init__(self, max_items: int = 1000):
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, CachedTranscript]" = OrderedDict()
+
+    def get(self, file_unique_id: str) -> Optional[CachedTranscript]:
+        with self._lock:
+            item = self._items.get(file_unique_id)
+            if item:
+                self._items.move_to_end(file_unique_id)
+
+        metrics.increment("transcripts_cache_hits" if item else "transcripts_cache_misses")
+
+        return item
+
+    def set(self, file_unique_id: str, result):
+        """'result' is a helpers.RecogResult"""
+
+        with self._lock:
+            self._items[file_unique_id] = (result.raw_transcript, result.confidence, result.elapsed)
+            self._items.move_to_end(file_unique_id)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+transcripts_cache = TranscriptsCache(max_items=config.behavior.get("transcripts_cache_size", 1000))
@@ -5,6 +5,7 @@ import logging.config
 import pickle
 import re
 import time
+from contextlib import contextmanager
 from pickle import UnpicklingError
 from html import escape
 
@@ -13,8 +14,10 @@ from typing import List
 
 from telegram import User, Message, InlineKeyboardMarkup, ChatMember, TelegramError, Audio
 from telegram.error import BadRequest
-from telegram.ext import PicklePersistence
 
+from bot.utilities import metrics
+from bot.utilities.downloader import download_manager
+from bot.utilities.persistence import SQLitePersistence, KIND_USER
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -27,27 +30,47 @@ def load_logging_config(file_name='logging.json'):
     logging.config.dictConfig(logging_config)
 
 
-def persistence_object(file_path='persistence/data.pickle'):
+@contextmanager
+def timed_phase(name: str):
+    """Log how long the wrapped startup phase took, and save it in the metrics"""
+
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+
+    logger.info("startup phase '%s' took %.3f s", name, elapsed)
+    metrics.set_gauge("startup_{}_seconds".format(re.sub(r"\W+", "_", name)), round(elapsed, 3))
 
-    logger.info('unpickling persistence: %s', file_path)
-    try:
-        # try to load the file
-        try:
-            with open(file_path, "rb") as f:
-                pickle.load(f)
-        except FileNotFoundError:
-            pass
 
-    except (UnpicklingError, EOFError):
-        logger.warning('deserialization failed: removing persistence file and trying again')
-        os.remove(file_path)
+def persistence_object(file_path='persistence/data.sqlite'):
+    if file_path.endswith(".pickle"):
+        # old PicklePersistence file: its content is imported into a sqlite db with the same name, once
+        pickle_file_path = file_path
+        file_path = os.path.splitext(pickle_file_path)[0] + ".sqlite"
+        migrate = os.path.isfile(pickle_file_path) and not os.path.isfile(file_path)
+    else:
+        pickle_file_path = None
+        migrate = False
 
-    return PicklePersistence(
+    logger.info('opening persistence: %s', file_path)
+    persistence = SQLitePersistence(
         filename=file_path,
         store_chat_data=False,
         store_bot_data=False
     )
 
+    if migrate:
+        logger.info('migrating pickle persistence: %s', pickle_file_path)
+        try:
+            with open(pickle_file_path, "rb") as f:
+                data = pickle.load(f)
+
+            persistence.import_data(KIND_USER, data.get("user_data", {}))
+        except (UnpicklingError, EOFError):
+            logger.warning('deserialization failed: nothing to migrate')
+
+    return persistence
+
 
 def escape_html(*args, **kwargs):
     return escape(*args, **kwargs)
@@ -144,21 +167,8 @@ def detect_media(message: Message):
         return message.sticker
 
 
-def download_file(message: Message, file_path, retries=5):
-    retries = retries or 1
-
+def download_file(message: Message, file_path, timeout=None):
     media_object = detect_media(message)
 
     logger.debug("downloading voice message to %s", file_path)
-    while retries > 0:
-        try:
-            telegram_file = media_object.get_file()
-            telegram_file.download(file_path)
-            retries = 0
-        except (BadRequest, TelegramError) as e:
-            if "temporarily unavailable" in e.message.lower():
-                logger.warning("downloading voice %s raised error: %s", media_object.file_id, e.message)
-                time.sleep(2)
-                retries -= 1
-            else:
-                raise
+    return download_manager.download(media_object, file_path, timeout=timeout)
@@ -0,0 +1,101 @@
+import hmac
+import json
+import logging
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+# noinspection PyPackageRequirements
+from telegram import Bot, Update
+
+from bot.utilities import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    # keep the connections Telegram opens alive (see set_webhook's max_connections)
+    protocol_version = "HTTP/1.1"
+    server: "WebhookServer"
+
+    def _reply(self, status: HTTPStatus):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _reject(self, status: HTTPStatus, reason: str):
+        logger.debug("webhook request from %s rejected: %s", self.client_address[0], reason)
+        metrics.increment(f"webhook_rejected_{reason}")
+        self._reply(status)
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.close_connection = True
+            return self._reject(HTTPStatus.NOT_FOUND, "path")
+
+        secret_token = self.server.secret_token
+        if secret_token and not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            self.close_connection = True
+            return self._reject(HTTPStatus.FORBIDDEN, "secret_token")
+
+        content_length = int(self.headers.get("Content-Length") or 0)
+        if not content_length or content_length > self.server.max_body_size:
+            self.close_connection = True
+            return self._reject(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "size")
+
+        body = self.rfile.read(content_length)
+
+        if self.server.update_queue.qsize() >= self.server.max_queue_size:
+            # Telegram will send the update again later
+            return self._reject(HTTPStatus.SERVICE_UNAVAILABLE, "queue_full")
+
+        try:
+            update = Update.de_json(json.loads(body), self.server.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("webhook: invalid update received", exc_info=True)
+            return self._reject(HTTPStatus.BAD_REQUEST, "invalid")
+
+        self.server.update_queue.put(update)
+        metrics.increment("webhook_updates_received")
+        metrics.set_gauge("webhook_queue_size", self.server.update_queue.qsize())
+
+        self._reply(HTTPStatus.OK)
+
+    def log_message(self, format, *args):
+        # route the http.server access log through our loggers
+        logger.debug("webhook: %s - %s", self.client_address[0], format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """Minimal HTTP server that receives the updates POSTed by Telegram and puts them in the dispatcher's
+    update queue. When the queue is longer than 'max_queue_size', requests are refused with a 503,
+    so Telegram keeps the updates and sends them again later"""
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            listen: str,
+            port: int,
+            url_path: str,
+            bot: Bot,
+            update_queue: Queue,
+            secret_token: [str, None] = None,
+            max_queue_size: int = 100,
+            max_body_size: int = 1024 * 1024
+    ):
+        self.url_path = url_path if url_path.startswith("/") else f"/{url_path}"
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+        self.max_queue_size = max_queue_size
+        self.max_body_size = max_body_size
+
+        super(WebhookServer, self).__init__((listen, port), WebhookRequestHandler)
+
+    def shutdown(self):
+        # Updater.stop() only calls shutdown(): also release the socket
+        super(WebhookServer, self).shutdown()
+        self.server_close()
@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from typing import List
+
+# noinspection PyPackageRequirements
+from telegram import Bot, Message, Update
+# noinspection PyPackageRequirements
+from telegram.utils.request import Request
+
+from bot.database.base import session_scope
+from bot.utilities import helpers
+from bot.utilities import jobs_queue
+from bot.utilities import utilities
+from bot.utilities.cancellation import running_transcriptions
+from bot.utilities.transcoder import transcoder
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# worker processes are started with 'spawn': they don't inherit the bot's threads, locks and connections
+_context = multiprocessing.get_context("spawn")
+
+
+class _LeaseKeeper(threading.Thread):
+    """Extends the lease of a job while it's being processed, so long transcriptions are not leased again
+    by another worker.
+
+    It also bridges the cancellation between processes: the "annulla" button and the bot removal are handled by
+    the bot process, which can't see the CancellationTokens of this process. So the placeholder of the job is
+    stored in the queue, the bot marks the job as cancelled there, and this thread polls the job every
+    'cancel_poll_interval' seconds and cancels its token"""
+
+    def __init__(self, queue: jobs_queue.TranscriptionJobsQueue, job: jobs_queue.Job, worker: str, cancel_poll_interval: float = 2):
+        super(_LeaseKeeper, self).__init__(name=f"lease_keeper:{job.job_id}", daemon=True)
+        self.queue = queue
+        self.job = job
+        self.worker = worker
+        self.cancel_poll_interval = cancel_poll_interval
+        self.done = threading.Event()
+
+    def run(self):
+        placeholder_stored = False
+        next_extension = time.monotonic() + self.queue.visibility_timeout / 3
+
+        while not self.done.wait(self.cancel_poll_interval):
+            if time.monotonic() >= next_extension:
+                self.queue.extend(self.job, self.worker)
+                next_extension = time.monotonic() + self.queue.visibility_timeout / 3
+
+            token = running_transcriptions.get(self.job.chat_id, self.job.message_id)
+            if not token:
+                # not started yet, or already completed
+                continue
+
+            if not placeholder_stored and token.placeholder_message_id:
+                self.queue.set_placeholder(self.job, token.placeholder_message_id)
+                placeholder_stored = True
+
+            reason = self.queue.cancellation(self.job)
+            if reason:
+                token.cancel(reason)
+
+
+def process_job(bot: Bot, job: jobs_queue.Job) -> helpers.RecogResult:
+    message = Message.de_json(job.payload["message"], bot)
+    update = Update(0, message=message)  # the update_id is not used by the transcription
+
+    with session_scope() as session:
+        return helpers.transcribe(
+            update,
+            session,
+            punctuation=job.payload.get("punctuation"),
+            delete_on_failure=job.payload.get("delete_on_failure", False)
+        )
+
+
+def worker_main(name: str, stop_event, transcoder_slots):
+    utilities.load_logging_config('logging.json')
+
+    # [transcoder] workers caps the conversions of all the processes together
+    transcoder.share_slots(transcoder_slots)
+
+    draining = threading.Event()
+
+    def on_signal(signum, _):
+        # SIGINT/SIGTERM are also sent to us when the whole process group is stopped: finish the current job
+        logger.info("%s: received signal %d, draining", name, signum)
+        draining.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    workers_config = jobs_queue.JOBS_QUEUE_CONFIG
+    bot = Bot(config.telegram.token, request=Request(con_pool_size=workers_config.get("connections_per_worker", 4)))
+    queue = jobs_queue.get_queue()
+    poll_interval = workers_config.get("poll_interval", 1)
+
+    logger.info("%s: started", name)
+
+    while not draining.is_set() and not stop_event.is_set():
+        job = queue.lease(name)
+        if not job:
+            stop_event.wait(poll_interval)
+            continue
+
+        logger.info("%s: processing %r", name, job)
+
+        lease_keeper = _LeaseKeeper(queue, job, name, cancel_poll_interval=workers_config.get("cancel_poll_interval", 2))
+        lease_keeper.start()
+        try:
+            result = process_job(bot, job)
+            # the budgets live in the bot process: it's the queue that gives the charge back
+            queue.complete(job, refund=not result.success)
+        except Exception as e:
+            logger.error("%s: error while processing %r", name, job, exc_info=True)
+            queue.fail(job, f"{type(e).__name__}: {e}")
+        finally:
+            lease_keeper.done.set()
+
+    queue.close()
+    logger.info("%s: stopped", name)
+
+
+class TranscriptionWorkers:
+    """The pool of worker processes that lease and process the jobs of the transcription queue"""
+
+    def __init__(self, processes: int = 2, drain_timeout: float = 120):
+        self.processes = processes
+        self.drain_timeout = drain_timeout
+
+        self._stop_event = _context.Event()
+        self._transcoder_slots = _context.BoundedSemaphore(transcoder.workers)
+        self._processes: List[multiprocessing.Process] = []
+
+    def start(self):
+        for i in range(self.processes):
+            process = _context.Process(
+                target=worker_main,
+                args=(f"worker-{i}", self._stop_event, self._transcoder_slots),
+                name=f"transcription_worker_{i}"
+            )
+            process.start()
+            self._processes.append(process)
+
+        # audios converted by the bot process take the same slots
+        transcoder.share_slots(self._transcoder_slots)
+
+        logger.info("%d transcription workers started", self.processes)
+
+    def stop(self):
+        """Ask the workers to stop leasing new jobs, and wait for them to finish the current one. Workers that
+        are still running after 'drain_timeout' are killed: their jobs will be leased again once their
+        lease expires"""
+
+        logger.info("waiting for the transcription workers to finish their jobs...")
+        self._stop_event.set()
+
+        deadline = time.monotonic() + self.drain_timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                # SIGTERM would just ask it to drain again
+                logger.warning("%s didn't stop in time: killing it", process.name)
+                process.kill()
+                process.join()
+
+        self._processes = []
+
+
+workers = TranscriptionWorkers(
+    processes=jobs_queue.JOBS_QUEUE_CONFIG.get("workers", 2),
+    drain_timeout=jobs_queue.JOBS_QUEUE_CONFIG.get("drain_timeout", 120),
+)
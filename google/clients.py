@@ -1,9 +1,34 @@
-# noinspection PyPackageRequirements
-from google.cloud.speech import SpeechClient
-from google.cloud.storage import Client as StorageClient
+import threading
 
 from config import config
 
+# clients are built on first use (or by the startup warm-up): importing the google cloud libraries and
+# reading the credentials is slow, and we don't want it to delay the startup of the bot
+_lock = threading.Lock()
+_speech_client = None
+_storage_client = None
 
-speech_client = SpeechClient.from_service_account_json(config.google.service_account_json)
-storage_client = StorageClient.from_service_account_json(config.google.service_account_json)
+
+def get_speech_client():
+    global _speech_client
+
+    with _lock:
+        if _speech_client is None:
+            # noinspection PyPackageRequirements
+            from google.cloud.speech import SpeechClient
+
+            _speech_client = SpeechClient.from_service_account_json(config.google.service_account_json)
+
+        return _speech_client
+
+
+def get_storage_client():
+    global _storage_client
+
+    with _lock:
+        if _storage_client is None:
+            from google.cloud.storage import Client as StorageClient
+
+            _storage_client = StorageClient.from_service_account_json(config.google.service_account_json)
+
+        return _storage_client
@@ -1,2 +1,9 @@
-from .stt import VoiceMessageLocal
-from .stt import VoiceMessageRemote
+def __getattr__(name):
+    # .stt imports the google cloud libraries, which are slow to import: load it only when it's actually needed,
+    # so importing .exceptions (or this package) stays cheap
+    if name in ("VoiceMessage", "VoiceMessageLocal", "VoiceMessageRemote"):
+        from . import stt
+
+        return getattr(stt, name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,153 @@
+import io
+import logging
+import struct
+from typing import List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from google.cloud.speech import RecognitionAudio, RecognizeResponse
+
+from . import ogg
+from . import silence
+from .exceptions import UnsupportedFormat
+from .stt import VoiceMessage
+
+logger = logging.getLogger(__name__)
+
+# a 20 ms CELT frame of digital silence
+SILENCE_PACKET = b'\xf8\xff\xfe'
+SILENCE_PACKET_SAMPLES = 960
+
+# (word, start, end, confidence), times in seconds
+Word = Tuple[str, float, float, float]
+
+
+def _opus_packets(data: bytes) -> Tuple[int, bytes, bytes, List[bytes]]:
+    serial, packets = ogg.read_packets(data)
+    if len(packets) < 3 or not packets[0].startswith(b"OpusHead") or not packets[1].startswith(b"OpusTags"):
+        raise UnsupportedFormat("not an Ogg Opus stream")
+
+    channels = packets[0][9]
+    if channels != 1:
+        raise UnsupportedFormat(f"only mono voices can be concatenated, this one has {channels} channels")
+
+    return serial, packets[0], packets[1], packets[2:]
+
+
+def concatenate(files: List[bytes], gap: float) -> Tuple[bytes, List[Tuple[float, float]]]:
+    """Join Ogg Opus files in a single stream, separated by 'gap' seconds of silence. Headers are taken from the
+    first file. Returns the stream and where every file is in the decoded audio: (start, end) in seconds"""
+
+    gap_packets = [SILENCE_PACKET] * max(1, int(round(gap * silence.OPUS_RATE / SILENCE_PACKET_SAMPLES)))
+
+    serial, head, tags, packets = None, None, None, []
+    granules = []
+    ranges = []
+    position = 0  # samples, pre-skip included
+    pre_skip = 0
+    for data in files:
+        file_serial, file_head, file_tags, audio = _opus_packets(data)
+        if head is None:
+            serial, head, tags = file_serial, file_head, file_tags
+            pre_skip = struct.unpack_from("<H", head, 10)[0]
+        else:
+            for packet in gap_packets:
+                position += SILENCE_PACKET_SAMPLES
+                packets.append(packet)
+                granules.append(position)
+
+        start = position
+        _, samples = silence.packet_samples(audio)
+        packets.extend(audio)
+        granules.extend((position + samples.cumsum()).tolist())
+        position += int(samples.sum())
+
+        ranges.append((max(start - pre_skip, 0) / silence.OPUS_RATE, (position - pre_skip) / silence.OPUS_RATE))
+
+    stream = ogg.write_stream(serial, [head, tags] + packets, [0, 0] + granules, flush_after={0, 1})
+
+    return stream, ranges
+
+
+def _distance(word: Word, voice_range: Tuple[float, float]) -> float:
+    _, start, end, _ = word
+    range_start, range_end = voice_range
+
+    return max(range_start - end, start - range_end, 0.0)
+
+
+def split_words(words: List[Word], ranges: List[Tuple[float, float]], tolerance: float = 0.1) -> Optional[List[List[Word]]]:
+    """Assign every word to the voice it has been said in. Words in the silence between two voices go to the
+    closest one. Returns None if the split is ambiguous: a word overlaps two voices, or it's about halfway
+    between them"""
+
+    split = [[] for _ in ranges]
+    for word in words:
+        distances = sorted((_distance(word, r), i) for i, r in enumerate(ranges))
+        if len(distances) > 1 and distances[1][0] - distances[0][0] <= tolerance:
+            logger.debug("word %s (%.1f-%.1f) can't be assigned to a voice", word[0], word[1], word[2])
+            return None
+
+        split[distances[0][1]].append(word)
+
+    return split
+
+
+def _response_words(response: RecognizeResponse) -> List[Word]:
+    words = []
+    for result in response.results:
+        if not result.alternatives:
+            continue
+
+        for word_info in result.alternatives[0].words:
+            words.append((
+                word_info.word,
+                word_info.start_time.total_seconds(),
+                word_info.end_time.total_seconds(),
+                word_info.confidence
+            ))
+
+    return words
+
+
+def recognize_batch(
+        voices: List[VoiceMessage],
+        gap: float = 1.0,
+        punctuation: bool = True,
+        model: Optional[str] = None,
+        use_enhanced: bool = False,
+        timeout: float = 60
+) -> Optional[List[Tuple[str, float]]]:
+    """Transcribe short voices with a single synchronous request: they are concatenated (see concatenate()), and
+    the transcript is split back by the word time offsets. The voices must share the language and the sample
+    rate, and fit one minute all together. Returns (transcript, confidence) for every voice, or None if they must be
+    transcribed one by one: the split is ambiguous, or some voice got no words"""
+
+    files = []
+    for voice in voices:
+        with io.open(voice.file_path, "rb") as fh:
+            files.append(fh.read())
+
+    data, ranges = concatenate(files, gap)
+
+    recognition_config = voices[0].make_recognition_config(punctuation, model, use_enhanced)
+    recognition_config.enable_word_time_offsets = True
+    recognition_config.enable_word_confidence = True
+
+    # noinspection PyTypeChecker
+    response: RecognizeResponse = voices[0].client.recognize(
+        config=recognition_config,
+        audio=RecognitionAudio(content=data),
+        timeout=timeout
+    )
+
+    split = split_words(_response_words(response), ranges)
+    if split is None or not all(split):
+        return None
+
+    results = []
+    for voice_words in split:
+        transcript = " ".join(word for word, _, _, _ in voice_words)
+        confidence = sum(c for _, _, _, c in voice_words) / len(voice_words)
+        results.append((transcript, round(confidence, 2)))
+
+    return results
@@ -1,2 +1,10 @@
 class UnsupportedFormat(Exception):
     """base exception for unsupported formats"""
+
+
+class RecognitionCancelled(Exception):
+    """the recognition has been cancelled before its completion"""
+
+
+class RecognitionTimeout(Exception):
+    """the recognition didn't complete within its deadline"""
@@ -0,0 +1,157 @@
+import struct
+from typing import Iterable, Iterator, List, Set, Tuple
+
+from .exceptions import UnsupportedFormat
+
+# https://xiph.org/ogg/doc/framing.html
+PAGE_HEADER = struct.Struct('<4sBBqIIiB')
+
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+# granule position of pages where no packet ends
+NO_GRANULE = -1
+
+
+def _crc_table() -> List[int]:
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xFFFFFFFF)
+
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc32(data: bytes) -> int:
+    """The Ogg checksum: polynomial 0x04c11db7, not reflected, no initial/final xor"""
+
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+
+    return crc
+
+
+class OggPage:
+    __slots__ = ("flags", "granule", "serial", "sequence", "lacing", "body")
+
+    def __init__(self, flags: int, granule: int, serial: int, sequence: int, lacing: Tuple[int, ...], body: bytes):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.sequence = sequence
+        self.lacing = lacing
+        self.body = body
+
+    def to_bytes(self) -> bytes:
+        header = PAGE_HEADER.pack(b'OggS', 0, self.flags, self.granule, self.serial, self.sequence, 0, len(self.lacing))
+        page = bytearray(header + bytes(self.lacing) + self.body)
+        struct.pack_into('<I', page, 22, crc32(page))
+
+        return bytes(page)
+
+
+def parse_pages(data: bytes) -> Iterator[OggPage]:
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < PAGE_HEADER.size:
+            raise UnsupportedFormat("truncated ogg page header")
+
+        oggs, version, flags, granule, serial, sequence, _, segments = PAGE_HEADER.unpack_from(data, offset)
+        if oggs != b'OggS' or version != 0:
+            raise UnsupportedFormat("not a valid ogg page (not OggS or version != 0)")
+
+        offset += PAGE_HEADER.size
+        lacing = tuple(data[offset:offset + segments])
+        offset += segments
+
+        body_size = sum(lacing)
+        body = data[offset:offset + body_size]
+        if len(body) < body_size:
+            raise UnsupportedFormat("truncated ogg page body")
+        offset += body_size
+
+        yield OggPage(flags, granule, serial, sequence, lacing, body)
+
+
+def read_packets(data: bytes) -> Tuple[int, List[bytes]]:
+    """Returns the serial number of the logical stream and its packets. Multiplexed or chained streams are
+    not supported"""
+
+    serial = None
+    packets = []
+    packet = bytearray()
+    for page in parse_pages(data):
+        if serial is None:
+            serial = page.serial
+        elif page.serial != serial:
+            raise UnsupportedFormat("more than one logical stream")
+
+        position = 0
+        for lacing_value in page.lacing:
+            packet += page.body[position:position + lacing_value]
+            position += lacing_value
+            if lacing_value < 255:
+                # less than 255 bytes means end of packet
+                packets.append(bytes(packet))
+                packet = bytearray()
+
+    if serial is None:
+        raise UnsupportedFormat("empty ogg stream")
+
+    return serial, packets
+
+
+def write_stream(
+        serial: int,
+        packets: List[bytes],
+        granules: Iterable[int],
+        flush_after: Set[int] = frozenset(),
+        max_page_size: int = 4096
+) -> bytes:
+    """Build an Ogg stream from 'packets', each with the granule position at its end. A page is closed after the
+    packets whose index is in 'flush_after' (eg. codec headers that must be alone in their page), or when it gets
+    larger than 'max_page_size' bytes. Packets that don't fit 255 segments continue in the next page"""
+
+    pages: List[OggPage] = []
+    lacing: List[int] = []
+    body = bytearray()
+    granule = NO_GRANULE
+    continued = False
+
+    def close_page(next_continued: bool):
+        nonlocal lacing, body, granule, continued
+
+        flags = (FLAG_CONTINUED if continued else 0) | (FLAG_BOS if not pages else 0)
+        pages.append(OggPage(flags, granule, serial, len(pages), tuple(lacing), bytes(body)))
+
+        lacing, body, granule, continued = [], bytearray(), NO_GRANULE, next_continued
+
+    for i, (packet, packet_granule) in enumerate(zip(packets, granules)):
+        position = 0
+        for lacing_value in [255] * (len(packet) // 255) + [len(packet) % 255]:
+            if len(lacing) == 255:
+                close_page(next_continued=True)
+
+            lacing.append(lacing_value)
+            body += packet[position:position + lacing_value]
+            position += lacing_value
+
+        granule = packet_granule
+
+        if i in flush_after or len(body) >= max_page_size:
+            close_page(next_continued=False)
+
+    if lacing:
+        close_page(next_continued=False)
+
+    if pages:
+        pages[-1].flags |= FLAG_EOS
+
+    return b"".join(page.to_bytes() for page in pages)
@@ -0,0 +1,147 @@
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from . import ogg
+from .exceptions import UnsupportedFormat
+
+logger = logging.getLogger(__name__)
+
+# Opus timestamps always count 48 kHz samples, whatever the input sample rate was
+OPUS_RATE = 48000
+
+# samples of one frame, by the config number in the TOC byte (https://tools.ietf.org/html/rfc6716#section-3.1)
+FRAME_SAMPLES = np.array(
+    [480, 960, 1920, 2880] * 3  # SILK-only: 10, 20, 40, 60 ms
+    + [480, 960] * 2  # hybrid: 10, 20 ms
+    + [120, 240, 480, 960] * 4,  # CELT-only: 2.5, 5, 10, 20 ms
+    dtype=np.int64
+)
+
+# packets this short carry no audio (DTX, or just the TOC byte)
+DTX_MAX_SIZE = 2
+
+
+class TrimResult:
+    def __init__(self, data: bytes, duration: float, trimmed_duration: float):
+        self.data = data
+        self.duration = duration
+        self.trimmed_duration = trimmed_duration
+
+    @property
+    def trimmed_seconds(self) -> float:
+        return self.duration - self.trimmed_duration
+
+
+def packet_samples(packets: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """Size and samples (at 48 kHz) of every Opus packet, read from their TOC byte without decoding them"""
+
+    count = len(packets)
+    sizes = np.fromiter((len(p) for p in packets), dtype=np.int64, count=count)
+    toc = np.fromiter((p[0] if p else 0 for p in packets), dtype=np.int64, count=count)
+    # with code 3 the number of frames is in the second byte
+    frame_count_byte = np.fromiter((p[1] if len(p) > 1 else 0 for p in packets), dtype=np.int64, count=count)
+
+    code = toc & 0x03
+    frames = np.select([code == 0, code == 3], [1, frame_count_byte & 0x3F], default=2)
+
+    samples = FRAME_SAMPLES[toc >> 3] * frames
+    samples[sizes == 0] = 0
+
+    return sizes, samples
+
+
+def _centered_sum(values: np.ndarray, width: int) -> np.ndarray:
+    # np.convolve(mode="same") returns max(len(values), width) items
+    return np.convolve(values, np.ones(width), mode="full")[(width - 1) // 2:(width - 1) // 2 + len(values)]
+
+
+def speech_mask(sizes: np.ndarray, samples: np.ndarray, threshold_ratio: float, window: float) -> np.ndarray:
+    """True for the packets that contain speech. Opus is VBR: silence is encoded with way less bytes per sample than
+    speech, so a packet is speech if the bytes per sample around it (averaged over 'window' seconds) are at least
+    'threshold_ratio' times the ones of the loudest parts of the voice"""
+
+    frame = np.median(samples[samples > 0])
+    width = max(1, int(round(window * OPUS_RATE / frame)))
+
+    density = sizes / np.maximum(samples, 1)
+    smoothed = _centered_sum(density, width) / width
+    level = np.percentile(smoothed, 90)
+
+    return (smoothed >= level * threshold_ratio) & (sizes > DTX_MAX_SIZE)
+
+
+def keep_mask(
+        speech: np.ndarray,
+        samples: np.ndarray,
+        padding: float,
+        max_pause: float
+) -> np.ndarray:
+    """The packets to keep: speech, 'padding' seconds of silence around it, and the first 'max_pause' seconds
+    of every pause. Leading and trailing silence (except the padding) is dropped"""
+
+    frame = np.median(samples[samples > 0])
+    padding_packets = int(round(padding * OPUS_RATE / frame))
+    keep = _centered_sum(speech.astype(np.int64), 2 * padding_packets + 1) > 0
+
+    # silent runs: [starts[i], ends[i])
+    edges = np.diff(np.concatenate(([1], keep.astype(np.int8), [1])))
+    starts = np.flatnonzero(edges == -1)
+    ends = np.flatnonzero(edges == 1)
+
+    cumulative = np.cumsum(samples)
+    max_pause_samples = max_pause * OPUS_RATE
+    for start, end in zip(starts, ends):
+        if start == 0 or end == len(keep):
+            continue
+
+        keep[start:end] = cumulative[start:end] - cumulative[start - 1] <= max_pause_samples
+
+    return keep
+
+
+def trim(
+        data: bytes,
+        threshold_ratio: float = 0.3,
+        window: float = 0.2,
+        padding: float = 0.3,
+        max_pause: float = 1.0,
+        min_saved: float = 1.0
+) -> Optional[TrimResult]:
+    """Remove the silence from an Ogg Opus file: the packets are analyzed (see speech_mask() and keep_mask()) and
+    the ones to keep are remuxed in a new stream, with the granule positions recomputed. Returns None if less than
+    'min_saved' seconds would be removed, or if no speech is found"""
+
+    serial, packets = ogg.read_packets(data)
+    if len(packets) < 3 or not packets[0].startswith(b"OpusHead") or not packets[1].startswith(b"OpusTags"):
+        raise UnsupportedFormat("not an Ogg Opus stream")
+
+    head, tags, audio = packets[0], packets[1], packets[2:]
+
+    sizes, samples = packet_samples(audio)
+    if not samples.any():
+        return None
+
+    speech = speech_mask(sizes, samples, threshold_ratio, window)
+    if not speech.any():
+        logger.debug("no speech found, nothing to trim")
+        return None
+
+    keep = keep_mask(speech, samples, padding, max_pause)
+
+    duration = samples.sum() / OPUS_RATE
+    trimmed_duration = samples[keep].sum() / OPUS_RATE
+    if duration - trimmed_duration < min_saved:
+        return None
+
+    kept = [packet for packet, k in zip(audio, keep) if k]
+    # the granule position counts the pre-skip samples too: they are decoded, then discarded
+    granules = np.cumsum(samples[keep])
+
+    # OpusHead must be alone in the first page, and the audio must start in a new page after OpusTags
+    trimmed = ogg.write_stream(serial, [head, tags] + kept, [0, 0] + granules.tolist(), flush_after={0, 1})
+
+    logger.debug("trimmed %.1f s of silence (%.1f s -> %.1f s)", duration - trimmed_duration, duration, trimmed_duration)
+
+    return TrimResult(trimmed, duration, trimmed_duration)
@@ -1,10 +1,12 @@
 import io
 import os
 import logging
+import math
 import re
 import struct
+import threading
 import time
-from typing import List, Tuple, Union, Optional
+from typing import Callable, Iterable, List, Tuple, Union, Optional
 
 # noinspection PyPackageRequirements
 from google.cloud.storage import Client as StorageClient
@@ -24,12 +26,18 @@ from google.cloud.speech import (
 from telegram import Message, Voice, TelegramError, Audio
 from telegram.error import BadRequest
 
-from google.clients import speech_client
-from google.clients import storage_client
-from .exceptions import UnsupportedFormat
+from google.clients import get_speech_client
+from google.clients import get_storage_client
+from .exceptions import UnsupportedFormat, RecognitionCancelled, RecognitionTimeout
 
 logger = logging.getLogger(__name__)
 
+# see VoiceMessage.use_converted_file()
+CONVERTED_AUDIO_ENCODINGS = {
+    "flac": RecognitionConfig.AudioEncoding.FLAC,
+    "opus": RecognitionConfig.AudioEncoding.OGG_OPUS,
+}
+
 
 class VoiceMessage:
     LANGUAGE = "it-IT"
@@ -41,6 +49,8 @@ class VoiceMessage:
     OPUS_SAMPLE_RATE_IOS = 48000
     OPUS_SAMPLE_RATE_DESKTOP = 48000
     OPUS_SAMPLE_RATE_MAC = 48000
+    # bytes needed to parse the OpusHead packet
+    HEADER_SIZE = 512
 
     def __init__(
             self,
@@ -63,7 +73,7 @@ class VoiceMessage:
         self.short = True
         self.sample_rate = None
         self.forced_sample_rate = force_sample_rate
-        self.client: SpeechClient = speech_client
+        self.client: SpeechClient = get_speech_client()
         self.max_alternatives = max_alternatives
         self.recognition_audio: Optional[RecognitionAudio] = None
         self.recognition_config: Optional[RecognitionConfig] = None
@@ -76,21 +86,32 @@ class VoiceMessage:
     def download_voice(voice: [Voice, Audio], file_path: str, retries: int = 3):
         logger.debug("downloading voice message to %s", file_path)
 
-        while retries > 0:
+        for attempt in range(1, retries + 1):
             try:
                 telegram_file = voice.get_file()
                 telegram_file.download(file_path)
-                retries = 0
+                return
             except (BadRequest, TelegramError) as e:
-                if "temporarily unavailable" in e.message.lower():
-                    logger.warning("downloading voice %s raised error: %s", voice.file_id, e.message)
-                    time.sleep(2)
-                    retries -= 1
-                else:
+                if "temporarily unavailable" not in e.message.lower() or attempt == retries:
                     raise
 
+                logger.warning("downloading voice %s raised error: %s", voice.file_id, e.message)
+                time.sleep(2)
+
     @classmethod
-    def from_message(cls, message: Message, download=True, *args, **kwargs):
+    def from_message(
+            cls,
+            message: Message,
+            download=True,
+            downloader: Optional[Callable] = None,
+            parse_header=False,
+            *args,
+            **kwargs
+    ):
+        """'downloader' is a callable that receives the Voice/Audio object and the destination path,
+        the default one is VoiceMessage.download_voice(). If 'parse_header' is True, the downloader also
+        receives 'on_head': a callback to pass the first bytes of the file to, as soon as they are received"""
+
         if not message.voice and not message.audio:
             raise AttributeError("Message object must contain a voice message or an audio")
 
@@ -112,11 +133,31 @@ class VoiceMessage:
             **kwargs
         )
 
-        if download:
-            cls.download_voice(telegram_voice, voice.file_path)
+        if download and parse_header:
+            downloader(telegram_voice, voice.file_path, on_head=voice.parse_header)
+        elif download:
+            downloader = downloader or cls.download_voice
+            downloader(telegram_voice, voice.file_path)
 
         return voice
 
+    @property
+    def ogg_opus(self) -> bool:
+        return self.audio_encoding == RecognitionConfig.AudioEncoding.OGG_OPUS
+
+    def use_converted_file(self, file_name: str, codec: str, sample_rate: int):
+        """Transcribe 'file_name' (in the same directory of the downloaded file) instead of the downloaded file,
+        eg. after it has been converted to a format the API accepts. 'codec' is either "flac" or "opus"
+        (in an Ogg container)"""
+
+        self._use_file(file_name)
+        self.audio_encoding = CONVERTED_AUDIO_ENCODINGS[codec]
+        self.sample_rate = sample_rate
+
+    def _use_file(self, file_name: str):
+        self.file_name = file_name
+        self.file_path = os.path.join(os.path.dirname(self.file_path), file_name)
+
     @staticmethod
     def pretty_sample_rate(value):
         if value % 1000 == 0:
@@ -184,9 +225,18 @@ class VoiceMessage:
 
         return transcript.strip(), round(average_confidence, 2)
 
-    def _recognize_short(self, timeout=360) -> Tuple[Optional[str], Optional[float]]:
+    def _recognize_short(
+            self,
+            timeout=360,
+            cancel_event: Optional[threading.Event] = None,
+            progress_callback: Optional[Callable[[int], None]] = None
+    ) -> Tuple[Optional[str], Optional[float]]:
         logger.debug("standard (short) operation, timeout: %d", timeout)
 
+        # a synchronous request can't be interrupted: we can only avoid to send it
+        if cancel_event and cancel_event.is_set():
+            raise RecognitionCancelled("cancelled before the request was sent")
+
         response: RecognizeResponse = self.client.recognize(
             config=self.recognition_config,
             audio=self.recognition_audio,
@@ -199,7 +249,24 @@ class VoiceMessage:
 
         return self._refactor_response_result(response)
 
-    def _recognize_long(self, timeout=360) -> Tuple[Optional[str], Optional[float]]:
+    @staticmethod
+    def _cancel_operation(operation):
+        try:
+            operation.cancel()
+        except Exception as e:
+            # the operation might have completed in the meantime
+            logger.warning("cancelling long running operation failed: %s", str(e))
+
+    def _recognize_long(
+            self,
+            timeout=360,
+            cancel_event: Optional[threading.Event] = None,
+            progress_callback: Optional[Callable[[int], None]] = None,
+            poll_interval: float = 3
+    ) -> Tuple[Optional[str], Optional[float]]:
+        """The operation is polled every 'poll_interval' seconds, so it can be cancelled when 'cancel_event' is set.
+        'progress_callback' receives the progress percentage after every poll"""
+
         logger.debug("long running operation, timeout: %d", timeout)
 
         operation = self.client.long_running_recognize(
@@ -207,15 +274,24 @@ class VoiceMessage:
             audio=self.recognition_audio
         )
 
-        """print(dir(operation))
+        deadline = time.monotonic() + timeout
+        while not operation.done():
+            if cancel_event and cancel_event.is_set():
+                self._cancel_operation(operation)
+                raise RecognitionCancelled("long running operation cancelled")
+            elif time.monotonic() >= deadline:
+                self._cancel_operation(operation)
+                raise RecognitionTimeout(f"long running operation not completed after {timeout} s")
+
+            if progress_callback and operation.metadata:
+                progress_callback(operation.metadata.progress_percent)
 
-        for i in range(12):
-            time.sleep(2)
-            print(operation_current_status.metadata, operation_current_status.done)
-            if operation_current_status.done is True:
-                break"""
+            if cancel_event:
+                cancel_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
 
-        response: LongRunningRecognizeResponse = operation.result(timeout=timeout)
+        response: LongRunningRecognizeResponse = operation.result()
 
         if not response:
             logger.warning("no response")
@@ -233,73 +309,151 @@ class VoiceMessage:
 
     def parse_sample_rate(self):
         with io.open(self.file_path, "rb") as fh:
-            header_data = fh.read(27)
-            header = struct.unpack('<4sBBqIIiB', header_data)
-            # https://xiph.org/ogg/doc/framing.html
-            oggs, version, flags, pos, serial, pageseq, crc, segments = header
-            # print(oggs, version, flags, pos, serial, pageseq, crc, segments)
-            # self._max_samplenum = max(self._max_samplenum, pos)
-
-            if oggs != b'OggS' or version != 0:
-                raise UnsupportedFormat('not a valid ogg file (not OggS or version != 0)')
-
-            segsizes = struct.unpack('B' * segments, fh.read(segments))
-
-            packet = b""  # also called "first page"
-
-            total = 0
-            for segsize in segsizes:  # read all segments
-                total += segsize
-                if total < 255:  # less than 255 bytes means end of page
-                    packet = fh.read(total)
-                    break
-
-            # packet[0:8] -> first 64 bits (8 bytes)
-            if packet[0:8] != b"OpusHead":
-                raise ValueError("packet must be OpusHead")
-
-            walker = io.BytesIO(packet)
-
-            # https://www.videolan.org/developers/vlc/modules/codec/opus_header.c
-            # https://mf4.xiph.org/jenkins/view/opus/job/opusfile-unix/ws/doc/html/structOpusHead.html
-            walker.seek(8, os.SEEK_CUR)  # jump over header name's 8 bytes
-            # - version number (8 bits, 1 byte -> "B")
-            # - Channels C (8 bits, 1 byte -> "B")
-            # - Pre - skip (16 bits, 2 bytes -> "H")
-            # - Sampling rate (32 bits, 4 bytes -> "I")
-            # - Gain in dB (16 bits, S7 .8, 2 bytes -> "H")
-            # - Mapping type (8 bits, 1 byte -> "B")
-            # total: 11 bytes
-            (version, channels, pre_skip, sample_rate, gain, mapping_type) = struct.unpack("<BBHIHB", walker.read(11))
-
-            if (version & 0xF0) != 0:
-                raise ValueError("only major version 0 supported")
-
-            self.sample_rate = sample_rate
-            self.parsed_header_data = {
-                "version": version,
-                "channels": channels,
-                "pre_skip": pre_skip,
-                "sample_rate": sample_rate,
-                "gain": gain,
-                "mapping_type": mapping_type
-            }
-
-    def recognize(self, max_alternatives: Optional[int] = None, punctuation: bool = True, *args, **kwargs) -> Tuple[Optional[str], Optional[float]]:
-        self._generate_recognition_audio()
+            self.parse_header(fh.read(self.HEADER_SIZE))
+
+    def parse_header(self, data: bytes):
+        """Read the sample rate from the OpusHead packet in the first Ogg page. 'data' are the first bytes of the
+        file: the first page is way shorter than HEADER_SIZE"""
+
+        fh = io.BytesIO(data)
+
+        header_data = fh.read(27)
+        if len(header_data) < 27:
+            raise UnsupportedFormat('not a valid ogg file (too short)')
+
+        header = struct.unpack('<4sBBqIIiB', header_data)
+        # https://xiph.org/ogg/doc/framing.html
+        oggs, version, flags, pos, serial, pageseq, crc, segments = header
+        # print(oggs, version, flags, pos, serial, pageseq, crc, segments)
+        # self._max_samplenum = max(self._max_samplenum, pos)
+
+        if oggs != b'OggS' or version != 0:
+            raise UnsupportedFormat('not a valid ogg file (not OggS or version != 0)')
+
+        segsizes = struct.unpack('B' * segments, fh.read(segments))
+
+        packet = b""  # also called "first page"
+
+        total = 0
+        for segsize in segsizes:  # read all segments
+            total += segsize
+            if total < 255:  # less than 255 bytes means end of page
+                packet = fh.read(total)
+                break
+
+        # packet[0:8] -> first 64 bits (8 bytes)
+        if packet[0:8] != b"OpusHead":
+            raise ValueError("packet must be OpusHead")
+
+        walker = io.BytesIO(packet)
+
+        # https://www.videolan.org/developers/vlc/modules/codec/opus_header.c
+        # https://mf4.xiph.org/jenkins/view/opus/job/opusfile-unix/ws/doc/html/structOpusHead.html
+        walker.seek(8, os.SEEK_CUR)  # jump over header name's 8 bytes
+        # - version number (8 bits, 1 byte -> "B")
+        # - Channels C (8 bits, 1 byte -> "B")
+        # - Pre - skip (16 bits, 2 bytes -> "H")
+        # - Sampling rate (32 bits, 4 bytes -> "I")
+        # - Gain in dB (16 bits, S7 .8, 2 bytes -> "H")
+        # - Mapping type (8 bits, 1 byte -> "B")
+        # total: 11 bytes
+        (version, channels, pre_skip, sample_rate, gain, mapping_type) = struct.unpack("<BBHIHB", walker.read(11))
+
+        if (version & 0xF0) != 0:
+            raise ValueError("only major version 0 supported")
+
+        self.sample_rate = sample_rate
+        self.parsed_header_data = {
+            "version": version,
+            "channels": channels,
+            "pre_skip": pre_skip,
+            "sample_rate": sample_rate,
+            "gain": gain,
+            "mapping_type": mapping_type
+        }
+
+    def trim_silence(self, **kwargs) -> float:
+        """Remove the silence from the file, see silence.trim() for the kwargs. If the trimmed voice fits a
+        synchronous request, it switches to the short path. Returns the removed seconds.
+
+        The trimmed audio is written to a new file, which is transcribed instead of the downloaded one: the downloaded
+        file is never rewritten, because simultaneous downloads of the same voice might be copying it (see
+        bot.utilities.downloader). It's just removed, like cleanup() would do"""
+
+        if not self.ogg_opus:
+            return 0.0
+
+        # it needs numpy: import it only if trimming is actually used
+        from . import silence
 
-        self.parse_sample_rate()
-        logger.debug("file sample rate: %d (forced: %s)", self.sample_rate, self.forced_sample_rate)
+        with io.open(self.file_path, "rb") as fh:
+            result = silence.trim(fh.read(), **kwargs)
+
+        if not result:
+            return 0.0
+
+        downloaded_file_path = self.file_path
+        name, extension = os.path.splitext(self.file_name)
+        trimmed_file_name = f"{name}_trimmed{extension}"
+
+        with io.open(os.path.join(os.path.dirname(self.file_path), trimmed_file_name), "wb") as fh:
+            fh.write(result.data)
+
+        self._use_file(trimmed_file_name)
+        try:
+            os.remove(downloaded_file_path)
+        except FileNotFoundError:
+            pass
 
+        self.duration = int(math.ceil(result.trimmed_duration))
+        if not self.short and self.duration <= 59:
+            logger.debug("voice trimmed to %d s: switching to the short path", self.duration)
+            self.short = True
+
+        return result.trimmed_seconds
+
+    def make_recognition_config(
+            self,
+            punctuation: bool = True,
+            model: Optional[str] = None,
+            use_enhanced: bool = False
+    ) -> RecognitionConfig:
         # noinspection PyTypeChecker
-        self.recognition_config = RecognitionConfig(
+        recognition_config = RecognitionConfig(
             encoding=self.audio_encoding,
             sample_rate_hertz=self.forced_sample_rate if self.forced_sample_rate else self.sample_rate,
             language_code=self.LANGUAGE,
             enable_automatic_punctuation=punctuation,
             # max_alternatives=max_alternatives,
-            profanity_filter=False
+            profanity_filter=False,
+            use_enhanced=use_enhanced
         )
+        if model:
+            recognition_config.model = model
+
+        return recognition_config
+
+    def recognize(
+            self,
+            max_alternatives: Optional[int] = None,
+            punctuation: bool = True,
+            *args,
+            upload_timeout: Optional[float] = None,
+            model: Optional[str] = None,
+            use_enhanced: bool = False,
+            **kwargs
+    ) -> Tuple[Optional[str], Optional[float]]:
+        """'upload_timeout' is only used by VoiceMessageRemote, the other kwargs are passed to
+        _recognize_short()/_recognize_long(). If 'model' is None, the API chooses the model"""
+
+        self._generate_recognition_audio()
+
+        if self.sample_rate is None:
+            # not parsed while downloading
+            self.parse_sample_rate()
+        logger.debug("file sample rate: %d (forced: %s)", self.sample_rate, self.forced_sample_rate)
+
+        self.recognition_config = self.make_recognition_config(punctuation, model, use_enhanced)
 
         if not self.short:
             return self._recognize_long(*args, **kwargs)
@@ -327,30 +481,98 @@ class VoiceMessageRemote(VoiceMessage):
         super(VoiceMessageRemote, self).__init__(*args, **kwargs)
 
         self.bucket_name = bucket_name
-        self.storage_client: StorageClient = storage_client
+        self.storage_client: StorageClient = get_storage_client()
         self.bucket = None
+        self.blob_uploaded = False
         self.gcs_uri = "gs://{}/{}".format(self.bucket_name, self.file_name)   # we can already compose it here
 
     def _generate_recognition_audio(self):
         # noinspection PyTypeChecker
         self.recognition_audio = RecognitionAudio(uri=self.gcs_uri)
 
-    def _upload_blob(self):
-        blob = self.bucket.blob(self.file_path)
+    def _use_file(self, file_name: str):
+        super(VoiceMessageRemote, self)._use_file(file_name)
+
+        self.gcs_uri = "gs://{}/{}".format(self.bucket_name, self.file_name)
 
-        blob.upload_from_filename(self.file_path)
+    def _upload_blob(self, timeout: Optional[float] = None):
+        # the blob name must match gcs_uri
+        blob = self.bucket.blob(self.file_name)
+
+        blob.upload_from_filename(self.file_path, timeout=timeout or 60)
+        self.blob_uploaded = True
 
     def _delete_blob(self):
-        blob = self.bucket.blob(self.file_path)
+        if not self.blob_uploaded:
+            return
+
+        blob = self.bucket.blob(self.file_name)
 
         blob.delete()
+        self.blob_uploaded = False
+
+    def upload_stream(
+            self,
+            chunks: Iterable[bytes],
+            chunk_size: int,
+            expected_size: Optional[int] = None,
+            timeout: Optional[float] = None
+    ) -> int:
+        """Upload the file from 'chunks' instead of reading it from disk. It's a resumable upload, in chunks of
+        'chunk_size' bytes (a multiple of 256 KB): only one chunk at a time is kept in memory. The header is parsed
+        from the first chunk, before anything is uploaded. The upload is verified with its crc32c checksum (by the
+        storage client) and with 'expected_size'. Returns the uploaded bytes"""
 
-    def recognize(self, *args, **kwargs):
-        # all the network stuff goes here, not in __init__
         self.bucket = self.storage_client.get_bucket(self.bucket_name)
-        self._upload_blob()
+        blob = self.bucket.blob(self.file_name, chunk_size=chunk_size)
+
+        writer = None
+        size = 0
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    self.parse_header(chunk)
+                    writer = blob.open("wb", chunk_size=chunk_size, checksum="crc32c", timeout=timeout or 60)
+
+                writer.write(chunk)
+                size += len(chunk)
+        finally:
+            if hasattr(chunks, "close"):
+                # stop the download if we are not going to consume it
+                chunks.close()
+
+        if writer is None:
+            raise UnsupportedFormat("empty file")
+
+        # if anything above raised, the resumable upload is never finalized and no object is created
+        writer.close()
+        self.blob_uploaded = True
+
+        if expected_size and size != expected_size:
+            self._delete_blob()
+            raise ValueError(f"uploaded {size} bytes, expected {expected_size}")
 
-        return super(VoiceMessageRemote, self).recognize(*args, **kwargs)
+        return size
+
+    def trim_silence(self, **kwargs) -> float:
+        if self.blob_uploaded:
+            # streamed to GCS: there is no local file to trim
+            return 0.0
+
+        return super(VoiceMessageRemote, self).trim_silence(**kwargs)
+
+    def recognize(self, *args, upload_timeout: Optional[float] = None, **kwargs):
+        # all the network stuff goes here, not in __init__
+        if not self.blob_uploaded:
+            self.bucket = self.storage_client.get_bucket(self.bucket_name)
+            self._upload_blob(timeout=upload_timeout)
+
+        try:
+            return super(VoiceMessageRemote, self).recognize(*args, **kwargs)
+        except (RecognitionCancelled, RecognitionTimeout):
+            # nobody is going to need the blob anymore
+            self._delete_blob()
+            raise
 
     def cleanup(self, remove_from_bucket=True):
         if remove_from_bucket:
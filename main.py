@@ -1,3 +1,5 @@
 import bot
 
-bot.main()
+# the transcription workers are started with 'spawn': they import this module too
+if __name__ == '__main__':
+    bot.main()